@@ -73,7 +73,7 @@ export class AuthorizationStack extends Construct {
 
     const authorizerHandlerFunction = new lambda.Function(this, 'AuthorizationFunction', {
       runtime: lambda.Runtime.PYTHON_3_12, // Choose any supported Node.js runtime
-      code: lambda.Code.fromAsset(path.join(__dirname, 'websocket-api-authorizer')), // Points to the lambda directory
+      code: lambda.Code.fromAsset(path.join(__dirname, 'websocket-api-authorizer'), { followSymlinks: cdk.SymlinkFollowMode.ALWAYS }), // Points to the lambda directory
       handler: 'lambda_function.lambda_handler', // Points to the 'hello' file in the lambda directory
       environment: {
         "USER_POOL_ID" : userPool.userPoolId,
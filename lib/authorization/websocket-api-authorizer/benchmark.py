@@ -0,0 +1,248 @@
+"""
+Micro-benchmarks for the websocket authorizer on synthetic tokens, run from this directory so
+the bundled packages are used.
+
+Usage:
+    python benchmark.py --keys [--tokens 3000]
+    python benchmark.py --parse [--tokens 10000]
+    python benchmark.py --importtime [--runs 5] [--top 15]
+    python benchmark.py --logging [--tokens 500] [--rounds 5]
+
+Tokens are signed with a throwaway RSA key whose JWKS is loaded with seed_jwks, so no network
+access or Cognito user pool is needed.
+
+--keys times one signature check per token, first constructing the public key for every token
+like the authorizer used to, then with the verifier kept by get_public_key. The per-token keys
+are built with jose's rsa backend, the one jwk.construct picks in the Lambda bundle, which does
+not ship cryptography.
+
+--parse times decoding header, claims and signature of every token, first the way the
+authorizer used to (jwt.get_unverified_headers, jwt.get_unverified_claims and a separate
+signature split, each decoding the token again), then with parse_token. Parsing does not check
+signatures, so these tokens get random signature bytes.
+
+--importtime runs python -X importtime in fresh processes for a few cold-start scenarios and
+prints the total import time of each, then the most expensive modules of every scenario with
+their own (self) and cumulative import time. Times are medians over --runs processes. jose
+probes for cryptography, so when it is installed locally the eager scenario costs more than it
+does in the Lambda bundle.
+
+--logging sends every token through lambda_handler at LOG_LEVEL INFO and at DEBUG, with the
+verified-token cache off so each call does the full verification, and records go to an
+in-memory handler like the Lambda runtime's. It prints the time per invocation and the bytes
+logged per invocation at each level. Rounds alternate between the levels and the fastest round
+of each level is reported.
+"""
+import argparse
+import base64
+import io
+import json
+import logging
+import os
+import re
+import statistics
+import subprocess
+import sys
+import time
+
+os.environ.setdefault('USER_POOL_ID', 'benchmark-pool')
+os.environ.setdefault('APP_CLIENT_ID', 'benchmark-client')
+
+import rsa
+
+import lambda_function
+import lambda_logging
+
+KID = 'benchmark-kid'
+
+
+def b64(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+def synthetic_keys(bits=2048):
+    public_key, private_key = rsa.newkeys(bits)
+
+    def int_b64(value):
+        return b64(value.to_bytes((value.bit_length() + 7) // 8, 'big'))
+    jwk = {'kid': KID, 'alg': 'RS256', 'kty': 'RSA', 'use': 'sig', 'n': int_b64(public_key.n), 'e': int_b64(public_key.e)}
+    return jwk, private_key
+
+
+def synthetic_tokens(private_key, count):
+    """Signed tokens, or tokens with a random 256-byte signature when private_key is None."""
+    header = b64(json.dumps({'kid': KID, 'alg': 'RS256'}).encode())
+    tokens = []
+    for i in range(count):
+        claims = {'sub': f'user-{i % 50}', 'aud': os.environ['APP_CLIENT_ID'], 'exp': time.time() + 3600,
+                  'custom:role': '["Admin"]', 'jti': str(i)}
+        payload = b64(json.dumps(claims).encode())
+        if private_key is None:
+            signature = os.urandom(256)
+        else:
+            signature = rsa.sign(f'{header}.{payload}'.encode(), private_key, 'SHA-256')
+        tokens.append(f'{header}.{payload}.{b64(signature)}')
+    return tokens
+
+
+def per_token(seconds, count):
+    return f'{seconds:6.2f}s  {seconds / count * 1e6:8.1f} us/token'
+
+
+def keys_benchmark(jwk, tokens):
+    from jose.backends.rsa_backend import RSAKey
+
+    def construct(key):
+        return RSAKey(key, key['alg'])
+
+    parsed = [lambda_function.parse_token(token) for token in tokens]
+    keys_url = lambda_function.get_keys_url()
+    lambda_function.seed_jwks(keys_url, {'keys': [jwk]})
+
+    start = time.perf_counter()
+    for token in parsed:
+        assert construct(jwk).verify(token.signing_input, token.signature)
+    constructed = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for token in parsed:
+        assert lambda_function.get_public_key(keys_url, KID).verify(token.signing_input, token.signature)
+    cached = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for _ in parsed:
+        construct(jwk)
+    construct_only = time.perf_counter() - start
+
+    print(f'{len(tokens)} tokens')
+    print(f'construct + verify:   {per_token(constructed, len(tokens))}')
+    print(f'cached key + verify:  {per_token(cached, len(tokens))}')
+    print(f'construct only:       {per_token(construct_only, len(tokens))}')
+
+
+def parse_benchmark(tokens):
+    from jose import jwt
+    from jose.utils import base64url_decode
+
+    start = time.perf_counter()
+    for token in tokens:
+        header = jwt.get_unverified_headers(token)
+        message, encoded_signature = token.rsplit('.', 1)
+        signature = base64url_decode(encoded_signature.encode('utf-8'))
+        claims = jwt.get_unverified_claims(token)
+        assert header['kid'] and claims['sub'] and message and signature
+    separate = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for token in tokens:
+        parsed = lambda_function.parse_token(token)
+        assert parsed.header['kid'] and parsed.claims['sub'] and parsed.signing_input and parsed.signature
+    single_pass = time.perf_counter() - start
+
+    print(f'{len(tokens)} tokens')
+    print(f'separate decodes:     {per_token(separate, len(tokens))}')
+    print(f'parse_token:          {per_token(single_pass, len(tokens))}  ({separate / single_pass:.1f}x)')
+
+
+# What a cold start imports in each scenario. "eager" is the import list the authorizer had before
+# imports were made lazy.
+IMPORT_SCENARIOS = {
+    'eager (before)': 'import json, requests, time, os\nfrom jose import jwt, jwk\nfrom jose.utils import base64url_decode',
+    'module only': 'import lambda_function',
+    'RS256 key': "import lambda_function\nlambda_function.construct_public_key({'kty': 'RSA', 'alg': 'RS256', 'n': 'AQAB', 'e': 'AQAB'})",
+    'RS256 key + JWKS fetch': "import lambda_function\nlambda_function.construct_public_key({'kty': 'RSA', 'alg': 'RS256', 'n': 'AQAB', 'e': 'AQAB'})\nlambda_function._get_http_session()",
+}
+IMPORTTIME_LINE = re.compile(r'import time:\s+(\d+) \|\s+(\d+) \| (\s*)(\S+)')
+
+
+def import_times(code):
+    """Run code in a fresh interpreter with -X importtime. Returns {module: (self us, cumulative us, depth)}."""
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], capture_output=True, text=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__)), check=True)
+    modules = {}
+    for line in result.stderr.splitlines():
+        match = IMPORTTIME_LINE.match(line)
+        if match:
+            modules[match.group(4)] = (int(match.group(1)), int(match.group(2)), len(match.group(3)) // 2)
+    return modules
+
+
+def importtime_benchmark(runs, top):
+    # the interpreter's own startup imports (encodings, site, ...) are the same in every scenario
+    baseline = set(import_times('pass'))
+    reports = {}
+    for name, code in IMPORT_SCENARIOS.items():
+        samples = [import_times(code) for _ in range(runs)]
+        modules = {module: (statistics.median(sample[module][0] for sample in samples if module in sample),
+                            statistics.median(sample[module][1] for sample in samples if module in sample))
+                   for module in samples[0] if module not in baseline}
+        reports[name] = modules
+        print(f'{name:<26} {len(modules):>4} modules  {sum(own for own, _ in modules.values()) / 1000:8.1f} ms')
+
+    for name, modules in reports.items():
+        print(f'\n{name}: top {top} modules by own import time')
+        print(f'  {"module":<44} {"self ms":>8} {"cumul ms":>9}')
+        for module, (own, cumulative) in sorted(modules.items(), key=lambda entry: -entry[1][0])[:top]:
+            print(f'  {module:<44} {own / 1000:>8.2f} {cumulative / 1000:>9.2f}')
+
+
+def logging_benchmark(jwk, tokens, rounds):
+    lambda_function.seed_jwks(lambda_function.get_keys_url(), {'keys': [jwk]})
+    lambda_function.VERIFIED_TOKEN_CACHE_SIZE = 0
+    stream = io.StringIO()
+    handler = logging.StreamHandler(stream)
+    handler.setFormatter(logging.Formatter('[%(levelname)s] %(asctime)s %(message)s'))
+    logging.getLogger().addHandler(handler)
+    events = [{'queryStringParameters': {'Authorization': token},
+               'methodArn': 'arn:aws:execute-api:us-east-1:000000000000:benchmark/prod/$connect'} for token in tokens]
+
+    best = {}
+    logged = {}
+    for _ in range(rounds):
+        for level in ('INFO', 'DEBUG'):
+            lambda_logging.LOG_LEVEL = level
+            stream.seek(0)
+            stream.truncate()
+            start = time.perf_counter()
+            for event in events:
+                assert lambda_function.lambda_handler(event, None)
+            best[level] = min(best.get(level, float('inf')), time.perf_counter() - start)
+            logged[level] = stream.tell()
+    logging.getLogger().removeHandler(handler)
+
+    print(f'{len(tokens)} invocations per round, {rounds} rounds')
+    for level in ('INFO', 'DEBUG'):
+        print(f'{level:<6} {best[level] / len(tokens) * 1e6:8.1f} us/invocation  {logged[level] / len(tokens):7.0f} bytes logged/invocation')
+    print(f'DEBUG overhead: {(best["DEBUG"] - best["INFO"]) / len(tokens) * 1e6:.1f} us/invocation')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--keys', action='store_true', help='per-verify key construction against cached verifiers')
+    parser.add_argument('--parse', action='store_true', help='separate jose decodes against one parse_token call')
+    parser.add_argument('--importtime', action='store_true', help='cold import cost per module and scenario')
+    parser.add_argument('--logging', action='store_true', help='per-invocation cost of logging at INFO and DEBUG')
+    parser.add_argument('--tokens', type=int, help='number of synthetic tokens, 3000 for --keys, 10000 for --parse and 500 for --logging')
+    parser.add_argument('--runs', type=int, default=5, help='fresh interpreters per --importtime scenario')
+    parser.add_argument('--top', type=int, default=15, help='modules listed per --importtime scenario')
+    parser.add_argument('--rounds', type=int, default=5, help='rounds per level for --logging')
+    args = parser.parse_args()
+
+    if args.importtime:
+        importtime_benchmark(args.runs, args.top)
+        return
+
+    if args.keys:
+        jwk, private_key = synthetic_keys()
+        keys_benchmark(jwk, synthetic_tokens(private_key, args.tokens or 3000))
+    elif args.logging:
+        jwk, private_key = synthetic_keys()
+        logging_benchmark(jwk, synthetic_tokens(private_key, args.tokens or 500), args.rounds)
+    elif args.parse:
+        parse_benchmark(synthetic_tokens(None, args.tokens or 10000))
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,72 +1,669 @@
+import base64
 import json
-from jose import jwt, jwk
-from jose.utils import base64url_decode
-import requests
+from collections import OrderedDict, namedtuple
+from contextlib import contextmanager, nullcontext
+import hashlib
+import threading
 import time
 import os
+from lambda_logging import get_logger, sample_log_level
 
-def lambda_handler(event, context):
-    token = event['queryStringParameters']['Authorization']
-    print(token)
+# Levels and per-invocation DEBUG sampling come from LOG_LEVEL and LOG_DEBUG_SAMPLE_RATE, see lambda_logging
+logger = get_logger(__name__)
+
+
+# How long a downloaded JWKS is considered fresh, and how much longer a stale copy
+# may still be served while a background refresh fetches a new one
+JWKS_TTL_SECONDS = int(os.environ.get('JWKS_TTL_SECONDS', 3600))
+JWKS_STALE_SECONDS = int(os.environ.get('JWKS_STALE_SECONDS', 3600))
+# Minimum time between refreshes triggered by a token with an unknown kid
+JWKS_MIN_REFRESH_SECONDS = int(os.environ.get('JWKS_MIN_REFRESH_SECONDS', 30))
+# How long a kid that is not in the JWKS is remembered as unknown
+UNKNOWN_KID_TTL_SECONDS = int(os.environ.get('UNKNOWN_KID_TTL_SECONDS', 300))
+# Maximum number of unknown kids remembered, so callers sending random kids cannot grow it without bound
+UNKNOWN_KID_CACHE_SIZE = int(os.environ.get('UNKNOWN_KID_CACHE_SIZE', 1024))
+# Maximum number of already verified tokens remembered per container
+VERIFIED_TOKEN_CACHE_SIZE = int(os.environ.get('VERIFIED_TOKEN_CACHE_SIZE', 2048))
+
+# Outbound HTTP (JWKS downloads): short timeouts and a few retries, so a hung Cognito endpoint
+# cannot use up the lambda timeout
+HTTP_CONNECT_TIMEOUT_SECONDS = float(os.environ.get('HTTP_CONNECT_TIMEOUT_SECONDS', 2))
+HTTP_READ_TIMEOUT_SECONDS = float(os.environ.get('HTTP_READ_TIMEOUT_SECONDS', 3))
+HTTP_RETRIES = int(os.environ.get('HTTP_RETRIES', 2))
+
+# Set AUTHORIZER_TIMINGS=true to emit one CloudWatch embedded metric format (EMF) record per
+# invocation with the time spent in each phase of the authorizer
+AUTHORIZER_TIMINGS = os.environ.get('AUTHORIZER_TIMINGS', 'false').lower() == 'true'
+AUTHORIZER_METRICS_NAMESPACE = os.environ.get('AUTHORIZER_METRICS_NAMESPACE', 'WebsocketAuthorizer')
+# Phases in the order they run, each reported as "<phase>_ms"
+TIMED_PHASES = ('jwks', 'parse', 'key', 'verify', 'claims', 'policy')
+
+# Set AUTHORIZER_WILDCARD_POLICY=true to allow every route of the stage instead of only the
+# methodArn being authorized, which lets API Gateway's authorizer cache reuse the decision
+AUTHORIZER_WILDCARD_POLICY = os.environ.get('AUTHORIZER_WILDCARD_POLICY', 'false').lower() == 'true'
+
+# Hash each RSA signing algorithm has to use, as reported by rsa.verify
+RSA_HASH_METHODS = {'RS256': 'SHA-256', 'RS384': 'SHA-384', 'RS512': 'SHA-512'}
+
+# Heavy packages (requests, jose, rsa) are imported inside the functions that need them so a
+# cold start only pays for what the invocation actually uses. Cognito signs with RS256, which
+# is verified with the rsa package alone; jose and its backend probing are only loaded for
+# other key types, and requests only when a JWKS download is needed.
+
+# Module-level caches survive across warm invocations of the same container
+# keys_url -> {"keys": {kid: jwk dict}, "public_keys": {kid: constructed key}, "fetched_at": epoch seconds}
+_jwks_cache = {}
+# (keys_url, kid) -> epoch seconds until which the kid is treated as unknown, oldest first
+_unknown_kids = OrderedDict()
+_unknown_kids_lock = threading.Lock()
+# Only one refresh per user pool runs at a time, callers wait on the lock instead of fetching again
+_jwks_locks = {}
+_jwks_locks_guard = threading.Lock()
+_background_refreshes = set()
+# Pooled keep-alive session for outbound calls, created on first use
+_http_session = None
+_http_session_lock = threading.Lock()
+# sha256 of a token -> (principalId, role, exp) for tokens that passed full verification
+_verified_tokens = OrderedDict()
+_verified_tokens_lock = threading.Lock()
+
+
+def get_keys_url(region='us-east-1'):
     user_pool_id = os.environ.get('USER_POOL_ID')
-    region = 'us-east-1'
-    app_client_id = os.environ.get('APP_CLIENT_ID')
-    keys_url = f'https://cognito-idp.{region}.amazonaws.com/{user_pool_id}/.well-known/jwks.json'
-    
+    return f'https://cognito-idp.{region}.amazonaws.com/{user_pool_id}/.well-known/jwks.json'
+
+
+def seed_jwks(keys_url, jwks_document):
+    """Load a JWKS document into the cache without downloading it, e.g. for offline replays."""
+    with _get_jwks_lock(keys_url):
+        _jwks_cache[keys_url] = {
+            'keys': {key['kid']: key for key in jwks_document['keys']},
+            'public_keys': {},
+            'fetched_at': time.time()
+        }
+
+
+def _get_jwks_lock(keys_url):
+    with _jwks_locks_guard:
+        if keys_url not in _jwks_locks:
+            _jwks_locks[keys_url] = threading.Lock()
+        return _jwks_locks[keys_url]
+
+
+def _get_http_session():
+    """
+    Return the module-level requests session used for every outbound call.
+
+    The session keeps its TLS connection to Cognito alive between JWKS refreshes, and its
+    adapter retries connection errors and 429/5xx answers a bounded number of times.
+    """
+    global _http_session
+    with _http_session_lock:
+        if _http_session is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+            from urllib3.util.retry import Retry
+
+            retry = Retry(
+                total=HTTP_RETRIES,
+                backoff_factor=0.1,
+                status_forcelist=(429, 500, 502, 503, 504),
+                allowed_methods=frozenset(['GET']),
+                raise_on_status=False
+            )
+            adapter = HTTPAdapter(pool_connections=2, pool_maxsize=4, max_retries=retry)
+            session = requests.Session()
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _http_session = session
+        return _http_session
+
+
+def _fetch_jwks(keys_url):
     # Download JWKs and transform them to a key dictionary
-    response = requests.get(keys_url)
-    keys = response.json()['keys']
-    key_dict = {key['kid']: json.dumps(key) for key in keys}
-
-    # Decode and validate the token
-    headers = jwt.get_unverified_headers(token)
-    print(key_dict)
-    print(headers)
-    key = json.loads(key_dict[headers['kid']])
-    public_key = jwk.construct(key)
-    print(public_key)
+    response = _get_http_session().get(keys_url, timeout=(HTTP_CONNECT_TIMEOUT_SECONDS, HTTP_READ_TIMEOUT_SECONDS))
+    response.raise_for_status()
+    return {key['kid']: key for key in response.json()['keys']}
 
-    # Validate the token
+
+def _refresh_jwks(keys_url, requested_at):
+    """
+    Refresh the JWKS for a user pool, making sure only one fetch is in flight.
+
+    Args:
+        keys_url (str): The jwks.json URL of the user pool.
+        requested_at (float): When the caller decided a refresh was needed. If another
+            caller already refreshed after this point, its result is reused instead.
+
+    Returns:
+        dict: The cache entry for the user pool.
+    """
+    with _get_jwks_lock(keys_url):
+        entry = _jwks_cache.get(keys_url)
+        if entry and entry['fetched_at'] >= requested_at:
+            return entry
+        # constructed keys live on the entry, so replacing it drops keys from the old JWKS
+        entry = {'keys': _fetch_jwks(keys_url), 'public_keys': {}, 'fetched_at': time.time()}
+        _jwks_cache[keys_url] = entry
+        # a new key set may contain kids we previously rejected
+        with _unknown_kids_lock:
+            for cached_url, kid in list(_unknown_kids):
+                if cached_url == keys_url:
+                    del _unknown_kids[(cached_url, kid)]
+        return entry
+
+
+def _background_refresh(keys_url):
+    try:
+        _refresh_jwks(keys_url, time.time())
+    except Exception as e:
+        logger.warning('Background JWKS refresh failed: %s', e)
+    finally:
+        _background_refreshes.discard(keys_url)
+
+
+def get_jwks(keys_url):
+    """
+    Return the cached key set for a user pool, fetching it only when it is missing or too old.
+
+    A fresh entry is returned as is. A stale entry (past the TTL but within the stale window)
+    is returned immediately while a background thread fetches a new copy. Anything older is
+    refreshed inline, falling back to the old copy if Cognito cannot be reached.
+    """
+    now = time.time()
+    entry = _jwks_cache.get(keys_url)
+    if entry is None:
+        return _refresh_jwks(keys_url, now)
+
+    age = now - entry['fetched_at']
+    if age <= JWKS_TTL_SECONDS:
+        return entry
+    if age <= JWKS_TTL_SECONDS + JWKS_STALE_SECONDS:
+        if keys_url not in _background_refreshes:
+            _background_refreshes.add(keys_url)
+            threading.Thread(target=_background_refresh, args=(keys_url,), daemon=True).start()
+        return entry
+    try:
+        return _refresh_jwks(keys_url, now)
+    except Exception as e:
+        logger.warning('JWKS refresh failed, using cached keys: %s', e)
+        return entry
+
+
+def _remember_unknown_kid(keys_url, kid, now):
+    with _unknown_kids_lock:
+        _unknown_kids.pop((keys_url, kid), None)
+        # every entry gets the same TTL, so the oldest entries expire first: drop expired ones and,
+        # when full, the oldest live one
+        while _unknown_kids:
+            oldest = next(iter(_unknown_kids))
+            if _unknown_kids[oldest] > now and len(_unknown_kids) < UNKNOWN_KID_CACHE_SIZE:
+                break
+            del _unknown_kids[oldest]
+        _unknown_kids[(keys_url, kid)] = now + UNKNOWN_KID_TTL_SECONDS
+
+
+def get_signing_key(keys_url, kid):
+    """
+    Look up the JWK for a kid, refreshing the key set once if the kid is not known yet.
+
+    Kids that are still missing after a refresh are remembered for UNKNOWN_KID_TTL_SECONDS,
+    so tokens with made-up kids cannot force a JWKS download on every request. At most
+    UNKNOWN_KID_CACHE_SIZE kids are remembered.
+
+    Returns:
+        dict or None: The JWK, or None if the user pool has no key with this kid.
+    """
+    entry = get_jwks(keys_url)
+    key = entry['keys'].get(kid)
+    if key is not None:
+        return key
+
+    now = time.time()
+    if _unknown_kids.get((keys_url, kid), 0) > now:
+        return None
+
+    # Cognito rotated its keys, so fetch again unless we just did
+    if now - entry['fetched_at'] >= JWKS_MIN_REFRESH_SECONDS:
+        entry = _refresh_jwks(keys_url, now)
+        key = entry['keys'].get(kid)
+        if key is not None:
+            return key
+
+    _remember_unknown_kid(keys_url, kid, now)
+    return None
+
+
+def base64url_decode(data):
+    # JWTs strip the base64 padding, add it back before decoding
+    return base64.urlsafe_b64decode(data + b'=' * (-len(data) % 4))
+
+
+class RSAPublicKey:
+    """
+    RSA verifier for the RS256/RS384/RS512 JWKs Cognito publishes.
+
+    It does the same PKCS#1 v1.5 check as jose's rsa backend, but going straight to the rsa
+    package avoids importing jose.backends, which probes cryptography, ecdsa and pyasn1 at import.
+    """
+
+    def __init__(self, key):
+        import rsa
+
+        self._rsa = rsa
+        self.algorithm = key['alg']
+        self.hash_method = RSA_HASH_METHODS[self.algorithm]
+        self.public_key = rsa.PublicKey(
+            int.from_bytes(base64url_decode(key['n'].encode('ascii')), 'big'),
+            int.from_bytes(base64url_decode(key['e'].encode('ascii')), 'big'))
+
+    def verify(self, msg, sig):
+        try:
+            return self._rsa.verify(msg, sig, self.public_key) == self.hash_method
+        except self._rsa.VerificationError:
+            return False
+
+    def __repr__(self):
+        return f'RSAPublicKey({self.algorithm}, {self.public_key.n.bit_length()} bits)'
+
+
+def construct_public_key(key):
+    """Build a verifier for a JWK, only loading jose for keys that are not plain RSA."""
+    if key.get('kty') == 'RSA' and key.get('alg') in RSA_HASH_METHODS:
+        return RSAPublicKey(key)
+    from jose import jwk
+
+    return jwk.construct(key)
+
+
+def get_public_key(keys_url, kid):
+    """
+    Return a ready-to-use verifier for a kid, constructing it at most once per JWKS download.
+
+    Constructing a key rebuilds the RSA modulus/exponent (or EC point) and the backend key
+    object, so the result is kept next to the JWK it was built from.
+
+    Returns:
+        RSAPublicKey, jose.backends.base.Key or None: The public key, or None if the kid is unknown.
+    """
+    key = get_signing_key(keys_url, kid)
+    if key is None:
+        return None
+    public_keys = _jwks_cache[keys_url]['public_keys']
+    public_key = public_keys.get(kid)
+    # the JWKS may have been refreshed since the key was built, only reuse it if it still matches
+    if public_key is None or public_key[0] is not key:
+        public_key = (key, construct_public_key(key))
+        public_keys[kid] = public_key
+    return public_key[1]
+
+
+def _token_digest(token):
+    return hashlib.sha256(token.encode('utf-8')).digest()
+
+
+def get_verified_token(token):
+    """
+    Return the cached decision for a token verified earlier in this container.
+
+    The expiry is checked again on every hit, and expired entries are evicted. Any change to
+    the token (header, claims or signature) changes its digest, so tampered tokens always go
+    through full verification.
+
+    Returns:
+        tuple or None: (principalId, role, exp), or None if the token has to be verified.
+    """
+    digest = _token_digest(token)
+    with _verified_tokens_lock:
+        decision = _verified_tokens.get(digest)
+        if decision is None:
+            return None
+        if time.time() > decision[2]:
+            del _verified_tokens[digest]
+            return None
+        _verified_tokens.move_to_end(digest)
+        return decision
+
+
+def remember_verified_token(token, principal_id, role, exp):
+    """Store the decision for a fully verified token, evicting the least recently used one when full."""
+    if VERIFIED_TOKEN_CACHE_SIZE <= 0:
+        return
+    digest = _token_digest(token)
+    with _verified_tokens_lock:
+        _verified_tokens[digest] = (principal_id, role, exp)
+        _verified_tokens.move_to_end(digest)
+        while len(_verified_tokens) > VERIFIED_TOKEN_CACHE_SIZE:
+            _verified_tokens.popitem(last=False)
+
+
+# A compact JWT decoded once: header and claims as dicts, the signed "header.claims" bytes and the raw signature
+ParsedToken = namedtuple('ParsedToken', ['header', 'claims', 'signing_input', 'signature'])
+
+
+def parse_token(token):
+    """
+    Split and decode a compact JWT in a single pass.
+
+    jose.jwt.get_unverified_headers and get_unverified_claims each re-split and re-decode the
+    whole token, so the pieces are decoded here once and reused for the kid lookup, the
+    signature check and the claim checks.
+
+    Raises:
+        ValueError: If the token is not a well-formed compact JWT.
+    """
+    if not isinstance(token, str):
+        raise ValueError("Token must be a string")
+    signing_input, _, encoded_signature = token.rpartition('.')
+    encoded_header, _, encoded_claims = signing_input.partition('.')
+    if not encoded_header or not encoded_claims or '.' in encoded_claims:
+        raise ValueError("Token is not a compact JWT")
     try:
-        message, encoded_signature = str(token).rsplit('.', 1)
-        
-        # decode the signature
-        decoded_signature = base64url_decode(encoded_signature.encode('utf-8'))
-
-        # verify the signature
-        if not public_key.verify(message.encode("utf8"), decoded_signature):
-            print('Signature verification failed')
-            raise Exception("Failed")
-        print('Signature successfully verified')
-
-        claims = jwt.get_unverified_claims(token)
-        
+        header = json.loads(base64url_decode(encoded_header.encode('ascii')))
+        claims = json.loads(base64url_decode(encoded_claims.encode('ascii')))
+        signature = base64url_decode(encoded_signature.encode('ascii'))
+    except (TypeError, ValueError, UnicodeError) as e:
+        raise ValueError(f"Token could not be decoded: {str(e)}")
+    if not isinstance(header, dict) or not isinstance(claims, dict):
+        raise ValueError("Token header and claims must be JSON objects")
+    # the kid is used as a cache and grouping key, so anything but a string is malformed
+    if not isinstance(header.get('kid'), str):
+        raise ValueError("Token header has no string kid")
+    return ParsedToken(header, claims, signing_input.encode('ascii'), signature)
+
+
+class PhaseTimer:
+    """
+    Collects how long each phase of one authorizer invocation takes.
+
+    A disabled timer hands out a shared no-op context, so timing costs nothing unless it is
+    switched on.
+    """
+
+    _noop = nullcontext()
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.timings = {}
+        self.outcome = None
+
+    @contextmanager
+    def _timed(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[name] = self.timings.get(name, 0.0) + (time.perf_counter() - start) * 1000
+
+    def phase(self, name):
+        if not self.enabled:
+            return self._noop
+        return self._timed(name)
+
+    def emf_record(self):
+        """Return the timings as a CloudWatch embedded metric format record."""
+        record = {
+            '_aws': {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': AUTHORIZER_METRICS_NAMESPACE,
+                    'Dimensions': [['Outcome']],
+                    'Metrics': [{'Name': f'{name}_ms', 'Unit': 'Milliseconds'} for name in self.timings]
+                }]
+            },
+            'Outcome': self.outcome or 'error'
+        }
+        for name, elapsed in self.timings.items():
+            record[f'{name}_ms'] = round(elapsed, 3)
+        return record
+
+    def emit(self):
+        if self.enabled:
+            # EMF records must be written to stdout as a single bare JSON line
+            print(json.dumps(self.emf_record()))
+
+
+def wildcard_method_arn(method_arn):
+    """
+    Widen a methodArn to every route of the same API stage.
+
+    arn:aws:execute-api:{region}:{account}:{apiId}/{stage}/{route...} becomes
+    arn:aws:execute-api:{region}:{account}:{apiId}/{stage}/*, so a cached decision covers
+    every route of the stage instead of only the one that was first authorized. ARNs that do
+    not look like an execute-api method ARN are returned unchanged.
+    """
+    parts = method_arn.split(':', 5)
+    if len(parts) != 6 or parts[0] != 'arn' or parts[2] != 'execute-api':
+        return method_arn
+    path = parts[5].split('/')
+    if len(path) < 3 or not path[0] or not path[1]:
+        return method_arn
+    return ':'.join(parts[:5]) + f':{path[0]}/{path[1]}/*'
+
+
+# The policy document only depends on the resource, so one shared document per resource is
+# built and reused. Callers must not mutate it.
+POLICY_DOCUMENT_CACHE_SIZE = 256
+_policy_documents = {}
+
+
+def _policy_document(resource):
+    document = _policy_documents.get(resource)
+    if document is None:
+        document = {
+            'Version': '2012-10-17',
+            'Statement': [{
+                'Action': 'execute-api:Invoke',
+                'Effect': 'Allow',
+                'Resource': resource
+            }]
+        }
+        if len(_policy_documents) < POLICY_DOCUMENT_CACHE_SIZE:
+            _policy_documents[resource] = document
+    return document
+
+
+def build_policy(principal_id, role, method_arn):
+    # Generate policy document, optionally for the whole stage so API Gateway can cache it across routes
+    resource = wildcard_method_arn(method_arn) if AUTHORIZER_WILDCARD_POLICY else method_arn
+    return {
+        'principalId': principal_id,
+        'context' : {"role" : role},
+        'policyDocument': _policy_document(resource)
+    }
+
+
+class TokenValidationError(Exception):
+    """Raised when a token is rejected. reason is a short code that batch replays can count."""
+
+    def __init__(self, reason, message):
+        super().__init__(message)
+        self.reason = reason
+
+
+def verify_parsed_token(parsed, keys_url, app_client_id, timer=None, now=None):
+    """
+    Check the signature and claims of an already parsed token.
+
+    Args:
+        parsed (ParsedToken): The token as returned by parse_token.
+        keys_url (str): The jwks.json URL of the user pool that issued the token.
+        app_client_id (str): The expected audience.
+        timer (PhaseTimer): Optional timer for the key, verify and claims phases.
+        now (float): Epoch seconds to check the expiry against, defaults to the current time.
+
+    Returns:
+        tuple: (principalId, role, exp) of the verified token.
+
+    Raises:
+        TokenValidationError: If the token is rejected.
+    """
+    timer = timer or PhaseTimer(enabled=False)
+    # a kid missing from the cached key set triggers a refresh, which is counted here
+    with timer.phase('key'):
+        public_key = get_public_key(keys_url, parsed.header.get('kid'))
+    if public_key is None:
+        raise TokenValidationError('unknown_kid', 'Token was signed with an unknown key')
+    logger.debug('Public key: %s', public_key)
+
+    # verify the signature
+    with timer.phase('verify'):
+        verified = public_key.verify(parsed.signing_input, parsed.signature)
+    if not verified:
+        raise TokenValidationError('bad_signature', 'Signature verification failed')
+    logger.debug('Signature successfully verified')
+
+    with timer.phase('claims'):
+        claims = parsed.claims
+
         # additionally we can verify the token expiration
-        if time.time() > claims['exp']:
-            print('Token is expired')
-            raise Exception("Expired")
-        
+        if not isinstance(claims.get('exp'), (int, float)) or (now or time.time()) > claims['exp']:
+            raise TokenValidationError('expired', 'Token is expired')
+
         # and the Audience  (use claims['client_id'] if verifying an access token)
-        if claims['aud'] != app_client_id:
-            print('Token was not issued for this audience')
-            raise Exception("Wrong audience")
-                
-        principalId = claims['sub']
-        role = claims.get('custom:role','')
-
-        # Generate policy document
-        policy_document = {
-            'principalId': principalId,
-            'context' : {"role" : role},
-            'policyDocument': {
-                'Version': '2012-10-17',
-                'Statement': [{
-                    'Action': 'execute-api:Invoke',
-                    'Effect': 'Allow',
-                    'Resource': event['methodArn']
-                }]
-            }
-        }        
-        return policy_document
+        if claims.get('aud') != app_client_id:
+            raise TokenValidationError('wrong_audience', 'Token was not issued for this audience')
+
+        if 'sub' not in claims:
+            raise TokenValidationError('malformed', 'Token has no subject')
+
+    return claims['sub'], claims.get('custom:role',''), claims['exp']
+
+
+def verify_token(token, keys_url, app_client_id, timer=None, now=None):
+    """Parse and verify a compact JWT, see verify_parsed_token."""
+    timer = timer or PhaseTimer(enabled=False)
+    # Decode header, claims and signature once
+    with timer.phase('parse'):
+        try:
+            parsed = parse_token(token)
+        except ValueError as e:
+            raise TokenValidationError('malformed', str(e))
+    logger.debug('Token header: %s', parsed.header)
+    return verify_parsed_token(parsed, keys_url, app_client_id, timer, now)
+
+
+def _verify_group(keys_url, app_client_id, parsed_tokens, now):
+    accepted = 0
+    rejected = {}
+    for parsed in parsed_tokens:
+        try:
+            verify_parsed_token(parsed, keys_url, app_client_id, now=now)
+            accepted += 1
+        except TokenValidationError as e:
+            rejected[e.reason] = rejected.get(e.reason, 0) + 1
+        except Exception as e:
+            # one odd token must not abort the whole replay
+            logger.warning('Unexpected error verifying token: %s', e)
+            rejected['error'] = rejected.get('error', 0) + 1
+    return accepted, rejected
+
+
+def _verify_group_in_worker(keys_url, jwks_document, app_client_id, parsed_tokens, now):
+    # Worker processes start with their own empty caches
+    seed_jwks(keys_url, jwks_document)
+    return _verify_group(keys_url, app_client_id, parsed_tokens, now)
+
+
+def verify_tokens(tokens, keys_url=None, app_client_id=None, now=None, processes=0):
+    """
+    Verify many tokens in one call, e.g. to replay captured $connect traffic offline.
+
+    Tokens are grouped by kid, so each public key is constructed once per process, and the
+    groups are optionally split across a process pool. The verified-token cache is not used,
+    so every token pays for the full signature check.
+
+    Args:
+        tokens (list): Compact JWTs.
+        keys_url (str): The jwks.json URL, defaults to the one of USER_POOL_ID.
+        app_client_id (str): The expected audience, defaults to APP_CLIENT_ID.
+        now (float): Epoch seconds to check expiries against, e.g. the capture time.
+        processes (int): Number of worker processes, 0 verifies in this process.
+
+    Returns:
+        dict: {"tokens", "accepted", "rejected": {reason: count}, "seconds", "tokens_per_second"}.
+            Tokens that fail with anything but a TokenValidationError are counted as "error".
+    """
+    keys_url = keys_url or get_keys_url()
+    app_client_id = app_client_id if app_client_id is not None else os.environ.get('APP_CLIENT_ID')
+    start = time.perf_counter()
+
+    # parse and group by kid up front, malformed tokens are rejected right away
+    groups = {}
+    rejected = {}
+    for token in tokens:
+        try:
+            parsed = parse_token(token)
+        except ValueError:
+            rejected['malformed'] = rejected.get('malformed', 0) + 1
+            continue
+        groups.setdefault(parsed.header.get('kid'), []).append(parsed)
+
+    if processes and processes > 1:
+        from concurrent.futures import ProcessPoolExecutor
+
+        # every worker gets the key set up front instead of downloading it again
+        jwks_document = {'keys': list(get_jwks(keys_url)['keys'].values())}
+        chunks = []
+        for group in groups.values():
+            size = max(1, -(-len(group) // processes))
+            chunks.extend(group[i:i + size] for i in range(0, len(group), size))
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            results = list(pool.map(_verify_group_in_worker, [keys_url] * len(chunks), [jwks_document] * len(chunks),
+                                    [app_client_id] * len(chunks), chunks, [now] * len(chunks)))
+    else:
+        results = [_verify_group(keys_url, app_client_id, group, now) for group in groups.values()]
+
+    accepted = 0
+    for group_accepted, group_rejected in results:
+        accepted += group_accepted
+        for reason, count in group_rejected.items():
+            rejected[reason] = rejected.get(reason, 0) + count
+
+    elapsed = time.perf_counter() - start
+    return {
+        'tokens': len(tokens),
+        'accepted': accepted,
+        'rejected': rejected,
+        'seconds': elapsed,
+        'tokens_per_second': len(tokens) / elapsed if elapsed else 0.0
+    }
+
+
+def lambda_handler(event, context):
+    sample_log_level(logger)
+    timer = PhaseTimer(AUTHORIZER_TIMINGS)
+    try:
+        return authorize(event, timer)
+    finally:
+        timer.emit()
+
+
+def authorize(event, timer):
+    token = event['queryStringParameters']['Authorization']
+    app_client_id = os.environ.get('APP_CLIENT_ID')
+    keys_url = get_keys_url()
+
+    # Skip the signature check for a token this container has already verified
+    decision = get_verified_token(token)
+    if decision is not None:
+        logger.debug('Token already verified')
+        timer.outcome = 'cached'
+        with timer.phase('policy'):
+            return build_policy(decision[0], decision[1], event['methodArn'])
+
+    # Validate the token
+    try:
+        # Make sure the key set is loaded, this is the only phase that may hit the network
+        with timer.phase('jwks'):
+            get_jwks(keys_url)
+
+        principalId, role, exp = verify_token(token, keys_url, app_client_id, timer)
+        remember_verified_token(token, principalId, role, exp)
+
+        timer.outcome = 'allow'
+        with timer.phase('policy'):
+            return build_policy(principalId, role, event['methodArn'])
     except Exception as e:
-        print(f'Token validation error: {str(e)}')
\ No newline at end of file
+        timer.outcome = 'deny'
+        logger.info('Token validation error: %s', e)
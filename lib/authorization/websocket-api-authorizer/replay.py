@@ -0,0 +1,90 @@
+"""
+Replay a corpus of captured $connect tokens through the authorizer and print how long each
+phase takes.
+
+Usage:
+    USER_POOL_ID=... APP_CLIENT_ID=... python replay.py tokens.txt [--jwks jwks.json] [--no-token-cache]
+    USER_POOL_ID=... APP_CLIENT_ID=... python replay.py tokens.txt --batch [--processes 4] [--at 1718000000]
+
+tokens.txt holds one ID token per line. Passing the pool's jwks.json keeps the replay offline;
+without it the key set is downloaded from Cognito once, like a cold container would.
+
+--batch verifies the whole corpus through verify_tokens and reports throughput and reject
+reasons instead of per-phase latencies. --at checks expiries against a fixed time, so a
+corpus captured yesterday is not rejected as expired today.
+"""
+import argparse
+import json
+import time
+
+import lambda_function
+
+
+def percentile(values, pct):
+    # nearest-rank percentile, good enough for latency summaries
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def replay(tokens, method_arn):
+    """
+    Run every token through the authorizer with phase timing switched on.
+
+    Returns:
+        tuple: ({phase: [milliseconds, ...]}, {outcome: count}, elapsed seconds)
+    """
+    timings = {phase: [] for phase in lambda_function.TIMED_PHASES}
+    outcomes = {}
+    start = time.perf_counter()
+    for token in tokens:
+        timer = lambda_function.PhaseTimer()
+        event = {'queryStringParameters': {'Authorization': token}, 'methodArn': method_arn}
+        lambda_function.authorize(event, timer)
+        for phase, elapsed in timer.timings.items():
+            timings[phase].append(elapsed)
+        outcomes[timer.outcome] = outcomes.get(timer.outcome, 0) + 1
+    return timings, outcomes, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('tokens', help='file with one token per line')
+    parser.add_argument('--jwks', help='jwks.json of the user pool, loaded instead of downloading it')
+    parser.add_argument('--method-arn', default='arn:aws:execute-api:us-east-1:000000000000:replay/prod/$connect')
+    parser.add_argument('--no-token-cache', action='store_true', help='verify every token in full, even repeats')
+    parser.add_argument('--batch', action='store_true', help='report throughput and reject reasons only')
+    parser.add_argument('--processes', type=int, default=0, help='worker processes for --batch')
+    parser.add_argument('--at', type=float, help='epoch seconds to check expiries against in --batch')
+    args = parser.parse_args()
+
+    with open(args.tokens) as f:
+        tokens = [line.strip() for line in f if line.strip()]
+    if args.jwks:
+        with open(args.jwks) as f:
+            lambda_function.seed_jwks(lambda_function.get_keys_url(), json.load(f))
+    if args.no_token_cache:
+        lambda_function.VERIFIED_TOKEN_CACHE_SIZE = 0
+
+    if args.batch:
+        result = lambda_function.verify_tokens(tokens, now=args.at, processes=args.processes)
+        print(f'{result["tokens"]} tokens in {result["seconds"]:.2f}s ({result["tokens_per_second"]:.0f} tokens/s)')
+        print(f'accepted: {result["accepted"]}')
+        for reason, count in sorted(result['rejected'].items()):
+            print(f'rejected ({reason}): {count}')
+        return
+
+    timings, outcomes, elapsed = replay(tokens, args.method_arn)
+
+    print(f'{len(tokens)} tokens in {elapsed:.2f}s ({len(tokens) / elapsed:.0f} tokens/s)')
+    print('outcomes: ' + ', '.join(f'{outcome}={count}' for outcome, count in sorted(outcomes.items())))
+    print(f'{"phase":<8}{"count":>8}{"p50 ms":>10}{"p90 ms":>10}{"p99 ms":>10}{"max ms":>10}')
+    for phase, values in timings.items():
+        if not values:
+            continue
+        print(f'{phase:<8}{len(values):>8}' + ''.join(
+            f'{percentile(values, pct):>10.3f}' for pct in (50, 90, 99)) + f'{max(values):>10.3f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,437 @@
+"""
+Tests for the websocket authorizer, run from this directory so the bundled packages are used:
+
+    python -m unittest test_lambda_function
+
+Tokens are signed with a throwaway RSA key and the key set is served by a local HTTP server
+that counts how often it is downloaded, so no Cognito user pool is needed.
+"""
+import base64
+import http.server
+import json
+import os
+import shutil
+import ssl
+import subprocess
+import tempfile
+import threading
+import time
+import unittest
+
+os.environ.setdefault('USER_POOL_ID', 'test-pool')
+os.environ.setdefault('APP_CLIENT_ID', 'test-client')
+
+import rsa
+
+import lambda_function
+
+KID = 'test-kid'
+APP_CLIENT_ID = os.environ['APP_CLIENT_ID']
+METHOD_ARN = 'arn:aws:execute-api:us-east-1:000000000000:test-api/prod/$connect'
+
+
+def b64(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+def jwk(public_key, kid=KID):
+    def int_b64(value):
+        return b64(value.to_bytes((value.bit_length() + 7) // 8, 'big'))
+    return {'kid': kid, 'alg': 'RS256', 'kty': 'RSA', 'use': 'sig', 'n': int_b64(public_key.n), 'e': int_b64(public_key.e)}
+
+
+PUBLIC_KEY, PRIVATE_KEY = rsa.newkeys(1024)
+
+
+def make_token(claims=None, kid=KID, private_key=PRIVATE_KEY):
+    claims = dict({'sub': 'user-1', 'aud': APP_CLIENT_ID, 'exp': time.time() + 600, 'custom:role': '["Admin"]'}, **(claims or {}))
+    header = b64(json.dumps({'kid': kid, 'alg': 'RS256'}).encode())
+    payload = b64(json.dumps(claims).encode())
+    signature = rsa.sign(f'{header}.{payload}'.encode(), private_key, 'SHA-256')
+    return f'{header}.{payload}.{b64(signature)}'
+
+
+class FakeJwksServer:
+    """Serves a JWKS document over HTTP on a free local port and counts the downloads."""
+
+    def __init__(self, keys):
+        self.keys = keys
+        self.fetches = 0
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                server.fetches += 1
+                body = json.dumps({'keys': server.keys}).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self.httpd.server_address[1]}/{os.environ["USER_POOL_ID"]}/.well-known/jwks.json'
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def reset_caches():
+    lambda_function._jwks_cache.clear()
+    lambda_function._unknown_kids.clear()
+    lambda_function._background_refreshes.clear()
+    lambda_function._verified_tokens.clear()
+
+
+class AuthorizerTestCase(unittest.TestCase):
+    def setUp(self):
+        reset_caches()
+        self.server = FakeJwksServer([jwk(PUBLIC_KEY)])
+        self.addCleanup(self.server.close)
+
+    def patch(self, name, value):
+        original = getattr(lambda_function, name)
+        setattr(lambda_function, name, value)
+        self.addCleanup(setattr, lambda_function, name, original)
+
+
+class JwksCacheTest(AuthorizerTestCase):
+    def test_warm_lookups_do_not_fetch(self):
+        for _ in range(50):
+            self.assertEqual(lambda_function.get_signing_key(self.server.url, KID)['kid'], KID)
+        self.assertEqual(self.server.fetches, 1)
+
+    def test_verifying_tokens_fetches_once(self):
+        for _ in range(20):
+            lambda_function.verify_token(make_token(), self.server.url, APP_CLIENT_ID)
+        self.assertEqual(self.server.fetches, 1)
+
+    def test_concurrent_cold_lookups_share_one_fetch(self):
+        threads = [threading.Thread(target=lambda_function.get_signing_key, args=(self.server.url, KID)) for _ in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.server.fetches, 1)
+
+    def test_unknown_kid_refreshes_once_then_is_cached(self):
+        lambda_function.get_signing_key(self.server.url, KID)
+        self.patch('JWKS_MIN_REFRESH_SECONDS', 0)
+        for _ in range(10):
+            self.assertIsNone(lambda_function.get_signing_key(self.server.url, 'made-up-kid'))
+        self.assertEqual(self.server.fetches, 2)
+
+    def test_rotated_key_is_picked_up(self):
+        lambda_function.get_signing_key(self.server.url, KID)
+        self.patch('JWKS_MIN_REFRESH_SECONDS', 0)
+        new_public_key, new_private_key = rsa.newkeys(1024)
+        self.server.keys = [jwk(PUBLIC_KEY), jwk(new_public_key, 'rotated-kid')]
+        token = make_token(kid='rotated-kid', private_key=new_private_key)
+        self.assertEqual(lambda_function.verify_token(token, self.server.url, APP_CLIENT_ID)[0], 'user-1')
+        self.assertEqual(self.server.fetches, 2)
+
+    def test_refresh_is_rate_limited(self):
+        lambda_function.get_signing_key(self.server.url, KID)
+        for i in range(10):
+            lambda_function.get_signing_key(self.server.url, f'kid-{i}')
+        self.assertEqual(self.server.fetches, 1)
+
+    def test_unknown_kid_cache_is_bounded(self):
+        self.patch('UNKNOWN_KID_CACHE_SIZE', 100)
+        lambda_function.get_signing_key(self.server.url, KID)
+        for i in range(5000):
+            lambda_function.get_signing_key(self.server.url, f'random-{i}')
+        self.assertEqual(len(lambda_function._unknown_kids), 100)
+        # the most recent kids are the ones kept
+        self.assertIn((self.server.url, 'random-4999'), lambda_function._unknown_kids)
+        self.assertEqual(self.server.fetches, 1)
+
+    def test_expired_unknown_kids_are_pruned(self):
+        lambda_function.get_signing_key(self.server.url, KID)
+        self.patch('UNKNOWN_KID_TTL_SECONDS', -1)
+        for i in range(50):
+            lambda_function.get_signing_key(self.server.url, f'random-{i}')
+        self.assertEqual(len(lambda_function._unknown_kids), 1)
+
+    def test_stale_key_set_is_served_while_refreshing(self):
+        lambda_function.get_signing_key(self.server.url, KID)
+        lambda_function._jwks_cache[self.server.url]['fetched_at'] -= lambda_function.JWKS_TTL_SECONDS + 1
+        self.assertEqual(lambda_function.get_signing_key(self.server.url, KID)['kid'], KID)
+        for _ in range(100):
+            if self.server.fetches == 2:
+                break
+            time.sleep(0.01)
+        self.assertEqual(self.server.fetches, 2)
+
+
+def authorize(token):
+    """Run one $connect through the authorizer. Returns (policy or None, outcome)."""
+    timer = lambda_function.PhaseTimer()
+    event = {'queryStringParameters': {'Authorization': token}, 'methodArn': METHOD_ARN}
+    return lambda_function.authorize(event, timer), timer.outcome
+
+
+def tamper_claims(token, **claims):
+    # swap in different claims but keep the original signature
+    header, payload, signature = token.split('.')
+    decoded = json.loads(base64.urlsafe_b64decode(payload + '=' * (-len(payload) % 4)))
+    decoded.update(claims)
+    return f'{header}.{b64(json.dumps(decoded).encode())}.{signature}'
+
+
+class VerifiedTokenCacheTest(AuthorizerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.patch('get_keys_url', lambda region='us-east-1': self.server.url)
+
+    def test_repeat_token_is_served_from_cache(self):
+        token = make_token()
+        self.assertEqual(authorize(token)[1], 'allow')
+        policy, outcome = authorize(token)
+        self.assertEqual(outcome, 'cached')
+        self.assertEqual(policy['principalId'], 'user-1')
+
+    def test_expired_token_is_never_cached(self):
+        token = make_token({'exp': time.time() - 1})
+        for _ in range(3):
+            self.assertEqual(authorize(token), (None, 'deny'))
+        self.assertEqual(len(lambda_function._verified_tokens), 0)
+
+    def test_cached_token_is_rejected_once_it_expires(self):
+        token = make_token({'exp': time.time() + 600})
+        self.assertEqual(authorize(token)[1], 'allow')
+        digest = lambda_function._token_digest(token)
+        principal_id, role, _ = lambda_function._verified_tokens[digest]
+        lambda_function._verified_tokens[digest] = (principal_id, role, time.time() - 1)
+        self.assertIsNone(lambda_function.get_verified_token(token))
+        self.assertNotIn(digest, lambda_function._verified_tokens)
+
+    def test_cached_token_expiring_mid_cache_goes_through_full_verification(self):
+        token = make_token({'exp': time.time() + 1})
+        self.assertEqual(authorize(token)[1], 'allow')
+        time.sleep(1.1)
+        self.assertEqual(authorize(token), (None, 'deny'))
+
+    def test_tampered_claims_are_never_cached(self):
+        token = make_token()
+        self.assertEqual(authorize(token)[1], 'allow')
+        tampered = tamper_claims(token, sub='someone-else', **{'custom:role': '["Admin","Owner"]'})
+        self.assertEqual(authorize(tampered), (None, 'deny'))
+        self.assertIsNone(lambda_function.get_verified_token(tampered))
+        self.assertEqual(len(lambda_function._verified_tokens), 1)
+
+    def test_tampered_signature_is_never_cached(self):
+        token = make_token()
+        self.assertEqual(authorize(token)[1], 'allow')
+        header, payload, signature = token.split('.')
+        flipped = bytearray(base64.urlsafe_b64decode(signature + '=' * (-len(signature) % 4)))
+        flipped[0] ^= 1
+        self.assertEqual(authorize(f'{header}.{payload}.{b64(bytes(flipped))}'), (None, 'deny'))
+        self.assertEqual(len(lambda_function._verified_tokens), 1)
+
+    def test_cache_is_capped(self):
+        self.patch('VERIFIED_TOKEN_CACHE_SIZE', 10)
+        tokens = [make_token({'jti': str(i)}) for i in range(25)]
+        for token in tokens:
+            self.assertEqual(authorize(token)[1], 'allow')
+        self.assertEqual(len(lambda_function._verified_tokens), 10)
+        # least recently used tokens were evicted, the newest are still cached
+        self.assertIsNone(lambda_function.get_verified_token(tokens[0]))
+        self.assertEqual(authorize(tokens[-1])[1], 'cached')
+
+
+def token_with_header(header):
+    return f'{b64(json.dumps(header).encode())}.{make_token().split(".", 1)[1]}'
+
+
+class VerifyTokensTest(AuthorizerTestCase):
+    def test_counts_every_token_under_a_reason(self):
+        tokens = [make_token(), make_token(), make_token({'exp': time.time() - 1}), 'not-a-jwt',
+                  token_with_header({'kid': ['x'], 'alg': 'RS256'}), token_with_header({'alg': 'RS256'})]
+        result = lambda_function.verify_tokens(tokens, self.server.url, APP_CLIENT_ID)
+        self.assertEqual(result['tokens'], 6)
+        self.assertEqual(result['accepted'], 2)
+        self.assertEqual(result['rejected'], {'expired': 1, 'malformed': 3})
+
+    def test_unexpected_error_is_counted_not_raised(self):
+        def broken(parsed, *args, **kwargs):
+            raise RuntimeError('boom')
+        self.patch('verify_parsed_token', broken)
+        result = lambda_function.verify_tokens([make_token(), make_token()], self.server.url, APP_CLIENT_ID)
+        self.assertEqual((result['accepted'], result['rejected']), (0, {'error': 2}))
+
+
+class PolicyTest(unittest.TestCase):
+    def test_wildcard_method_arn(self):
+        cases = {
+            'arn:aws:execute-api:us-east-1:123456789012:abc123/prod/$connect':
+                'arn:aws:execute-api:us-east-1:123456789012:abc123/prod/*',
+            'arn:aws:execute-api:us-east-1:123456789012:abc123/prod/GET/user-feedback/download-feedback':
+                'arn:aws:execute-api:us-east-1:123456789012:abc123/prod/*',
+            'arn:aws-us-gov:execute-api:us-gov-west-1:123456789012:abc123/dev/sendMessage':
+                'arn:aws-us-gov:execute-api:us-gov-west-1:123456789012:abc123/dev/*',
+            'arn:aws:execute-api:us-east-1:123456789012:abc123/prod/*':
+                'arn:aws:execute-api:us-east-1:123456789012:abc123/prod/*',
+        }
+        for method_arn, expected in cases.items():
+            self.assertEqual(lambda_function.wildcard_method_arn(method_arn), expected)
+
+    def test_unexpected_arns_are_unchanged(self):
+        for method_arn in [
+            '',
+            'not-an-arn',
+            'arn:aws:lambda:us-east-1:123456789012:function:abc/prod/$connect',
+            'arn:aws:execute-api:us-east-1:123456789012:abc123',
+            'arn:aws:execute-api:us-east-1:123456789012:abc123/prod',
+            'arn:aws:execute-api:us-east-1:123456789012:/prod/$connect',
+            'arn:aws:execute-api:us-east-1:123456789012:abc123//$connect',
+        ]:
+            self.assertEqual(lambda_function.wildcard_method_arn(method_arn), method_arn)
+
+    def test_build_policy_uses_wildcard_only_when_enabled(self):
+        method_arn = 'arn:aws:execute-api:us-east-1:123456789012:abc123/prod/$connect'
+        policy = lambda_function.build_policy('user-1', '["Admin"]', method_arn)
+        self.assertEqual(policy['policyDocument']['Statement'][0]['Resource'], method_arn)
+
+        original = lambda_function.AUTHORIZER_WILDCARD_POLICY
+        lambda_function.AUTHORIZER_WILDCARD_POLICY = True
+        self.addCleanup(setattr, lambda_function, 'AUTHORIZER_WILDCARD_POLICY', original)
+        policy = lambda_function.build_policy('user-2', '["User"]', method_arn)
+        self.assertEqual(policy['principalId'], 'user-2')
+        self.assertEqual(policy['context'], {'role': '["User"]'})
+        self.assertEqual(policy['policyDocument']['Statement'][0],
+                         {'Action': 'execute-api:Invoke', 'Effect': 'Allow', 'Resource': 'arn:aws:execute-api:us-east-1:123456789012:abc123/prod/*'})
+
+    def test_policy_documents_are_shared_per_resource(self):
+        first = lambda_function.build_policy('user-1', '', METHOD_ARN)
+        second = lambda_function.build_policy('user-2', '', METHOD_ARN)
+        self.assertIs(first['policyDocument'], second['policyDocument'])
+        self.assertNotEqual(first['principalId'], second['principalId'])
+
+
+class CountingHttpsServer:
+    """
+    HTTPS stand-in for the Cognito JWKS endpoint that counts TLS handshakes and requests.
+
+    The first `failures` requests get a 503, and every answer waits `delay` seconds first.
+    """
+
+    def __init__(self, certfile, keyfile, keys):
+        self.keys = keys
+        self.handshakes = 0
+        self.requests = 0
+        self.failures = 0
+        self.delay = 0
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            # HTTP/1.1 keeps the connection open between requests
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                server.requests += 1
+                time.sleep(server.delay)
+                if server.failures:
+                    server.failures -= 1
+                    status, body = 503, b'{}'
+                else:
+                    status, body = 200, json.dumps({'keys': server.keys}).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        class Server(http.server.ThreadingHTTPServer):
+            daemon_threads = True
+
+            def get_request(self):
+                # the listening socket is wrapped, so accept() completes one TLS handshake
+                request = super().get_request()
+                server.handshakes += 1
+                return request
+
+            def handle_error(self, request, client_address):
+                # clients that time out close the connection mid-answer, which is expected here
+                pass
+
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(certfile, keyfile)
+        self.httpd = Server(('127.0.0.1', 0), Handler)
+        self.httpd.socket = context.wrap_socket(self.httpd.socket, server_side=True)
+        self.url = f'https://127.0.0.1:{self.httpd.server_address[1]}/{os.environ["USER_POOL_ID"]}/.well-known/jwks.json'
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+@unittest.skipUnless(shutil.which('openssl'), 'needs the openssl command to create a test certificate')
+class PooledHttpSessionTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp()
+        cls.certfile = os.path.join(cls.directory, 'cert.pem')
+        cls.keyfile = os.path.join(cls.directory, 'key.pem')
+        subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1', '-subj', '/CN=127.0.0.1',
+                        '-addext', 'subjectAltName=IP:127.0.0.1', '-keyout', cls.keyfile, '-out', cls.certfile],
+                       check=True, capture_output=True)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.directory)
+
+    def setUp(self):
+        reset_caches()
+        # every test starts without a pooled session, and requests trusts the test certificate
+        lambda_function._http_session = None
+        self.addCleanup(setattr, lambda_function, '_http_session', None)
+        previous = os.environ.get('REQUESTS_CA_BUNDLE')
+        os.environ['REQUESTS_CA_BUNDLE'] = self.certfile
+        self.addCleanup(lambda: os.environ.pop('REQUESTS_CA_BUNDLE') if previous is None else os.environ.update(REQUESTS_CA_BUNDLE=previous))
+        self.server = CountingHttpsServer(self.certfile, self.keyfile, [jwk(PUBLIC_KEY)])
+        self.addCleanup(self.server.close)
+
+    def patch(self, name, value):
+        original = getattr(lambda_function, name)
+        setattr(lambda_function, name, value)
+        self.addCleanup(setattr, lambda_function, name, original)
+
+    def test_refreshes_reuse_one_tls_connection(self):
+        for i in range(5):
+            lambda_function._refresh_jwks(self.server.url, time.time() + 1)
+        self.assertEqual(self.server.requests, 5)
+        self.assertEqual(self.server.handshakes, 1)
+
+    def test_server_errors_are_retried(self):
+        self.server.failures = 2
+        self.assertIn(KID, lambda_function._fetch_jwks(self.server.url))
+        self.assertEqual(self.server.requests, 3)
+
+    def test_retries_are_bounded(self):
+        self.server.failures = lambda_function.HTTP_RETRIES + 1
+        with self.assertRaises(Exception):
+            lambda_function._fetch_jwks(self.server.url)
+        self.assertEqual(self.server.requests, lambda_function.HTTP_RETRIES + 1)
+
+    def test_hung_endpoint_times_out(self):
+        self.patch('HTTP_READ_TIMEOUT_SECONDS', 0.2)
+        self.server.delay = 2
+        start = time.perf_counter()
+        with self.assertRaises(Exception):
+            lambda_function._fetch_jwks(self.server.url)
+        # one try and HTTP_RETRIES retries, each cut off by the read timeout
+        self.assertLess(time.perf_counter() - start, 1.5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,20 @@
+"""
+Move feedback written before AnyIndex was sharded from the single "YES" partition to its shard.
+
+Usage:
+    FEEDBACK_TABLE=<feedback table name> python backfill_any_shards.py
+
+Run once after the sharded feedback handler is deployed, in a maintenance window: an admin paging
+through feedback or an export job running while items move between partitions can see an item
+twice or miss it. Reads keep querying the "YES" partition next to the shards, so no feedback is
+hidden before or after the move, and running it again is harmless.
+"""
+import os
+
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+import lambda_function
+
+
+if __name__ == '__main__':
+    print(f'moved {lambda_function.backfill_any_shards()} feedback items to AnyIndex shards')
@@ -0,0 +1,207 @@
+"""
+Benchmark the feedback CSV export on synthetic feedback rows.
+
+Usage:
+    python benchmark.py [--rows 100000] [--part-size 8388608] [--out feedback.csv]
+    python benchmark.py --scan [--rows 100000] [--segments 8] [--page-rows 500] [--latency-ms 40]
+    python benchmark.py --burst [--posts 10000] [--threads 64]
+
+Rows are generated in memory and written through write_feedback_csv into a LocalFileUpload, so
+no AWS access is needed. The old export, which built the whole CSV with string concatenation,
+is timed on the same rows for comparison. Peak memory is measured with tracemalloc and covers
+the export only, not the generated rows.
+
+--scan compares reading every row through one query partition, one page after the other, with
+parallel_scan over --segments segments. The table stand-in serves --page-rows rows per request
+and waits --latency-ms per request, like a DynamoDB round trip for a 1 MB page.
+
+--burst sends --posts feedback submissions on one topic through post_feedback from --threads
+threads at once, into a stand-in that overwrites items with the same key like DynamoDB does. It
+reports how many items were stored and how many the old second-resolution CreatedAt key would
+have kept, then deletes one item by its key.
+"""
+import argparse
+import csv
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+
+os.environ.setdefault('FEEDBACK_TABLE', 'FeedbackBenchmark')
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+import lambda_function
+
+TOPICS = ['Grants', 'Loans', 'Tax Credits', 'Workforce', 'N/A (Good Response)']
+WORDS = 'program eligibility deadline apply "quoted" business, loan grant\nnew-line funding small'.split(' ')
+
+
+def synthetic_items(rows):
+    def text(n):
+        return ' '.join(random.choice(WORDS) for _ in range(n))
+    return [{
+        'FeedbackID': f'{i:08x}-feedback',
+        'SessionID': f'{i % 997:08x}-session',
+        'UserPrompt': text(15),
+        'FeedbackComments': text(10),
+        'Topic': random.choice(TOPICS),
+        'Problem': text(3),
+        'Feedback': Decimal(random.randint(0, 1)),
+        'ChatbotMessage': text(150),
+        'CreatedAt': f'2024-06-{1 + i % 28:02d}T12:00:{i % 60:02d}Z',
+    } for i in range(rows)]
+
+
+def concatenated_export(items):
+    # The export as it was before the streaming writer: one growing string
+    def clean_csv(field):
+        return str(field).replace('"', '""').replace('\n', '').replace(',', '')
+    csv_content = "FeedbackID, SessionID, UserPrompt, FeedbackComment, Topic, Problem, Feedback, ChatbotMessage, CreatedAt\n"
+    for item in items:
+        csv_content += ', '.join(clean_csv(item[attribute]) for _, attribute in lambda_function.EXPORT_COLUMNS) + '\n'
+    return csv_content
+
+
+class PagedTableStandIn:
+    """Serves synthetic items page by page for query and segmented scan, with a fixed delay per request."""
+
+    def __init__(self, items, page_rows, latency_ms):
+        self.items = items
+        self.page_rows = page_rows
+        self.latency = latency_ms / 1000
+
+    def _page(self, rows, kwargs):
+        time.sleep(self.latency)
+        start = kwargs.get('ExclusiveStartKey', {}).get('offset', 0)
+        response = {'Items': rows[start:start + self.page_rows]}
+        if start + self.page_rows < len(rows):
+            response['LastEvaluatedKey'] = {'offset': start + self.page_rows}
+        return response
+
+    def query(self, **kwargs):
+        return self._page(self.items, kwargs)
+
+    def scan(self, **kwargs):
+        return self._page(self.items[kwargs['Segment']::kwargs['TotalSegments']], kwargs)
+
+
+class KeyedTableStandIn:
+    """Stores items by (Topic, CreatedAt), so a put with an existing key replaces the item."""
+
+    def __init__(self):
+        self.items = {}
+        self.lock = threading.Lock()
+
+    def put_item(self, Item):
+        with self.lock:
+            self.items[(Item['Topic'], Item['CreatedAt'])] = Item
+
+    def delete_item(self, Key):
+        with self.lock:
+            self.items.pop((Key['Topic'], Key['CreatedAt']), None)
+
+
+def burst_benchmark(posts, threads):
+    stand_in = KeyedTableStandIn()
+    lambda_function.table = stand_in
+    event = {'body': json.dumps({'feedbackData': {
+        'sessionId': 'burst-session', 'prompt': 'How do I apply?', 'comment': 'burst', 'topic': 'Grants',
+        'problem': 'Other', 'feedback': 0, 'completion': 'Apply online.', 'sources': [],
+    }})}
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        responses = list(executor.map(lambda _: lambda_function.post_feedback(event), range(posts)))
+    seconds = time.perf_counter() - start
+
+    accepted = sum(1 for response in responses if response['statusCode'] == 200)
+    items = list(stand_in.items.values())
+    old_keys = {(item['Topic'], lambda_function.created_time(item['CreatedAt'])) for item in items}
+    by_key = sorted(items, key=lambda item: item['CreatedAt'])
+    print(f'{posts} posts from {threads} threads in {seconds:6.2f}s: {accepted} accepted, {len(items)} stored')
+    print(f'second-resolution CreatedAt keys would have kept {len(old_keys)} of them')
+    print(f'CreatedAt order matches FeedbackID order: {by_key == sorted(items, key=lambda item: item["FeedbackID"])}')
+
+    victim = by_key[len(by_key) // 2]
+    response = lambda_function.delete_feedback({'queryStringParameters': {'topic': victim['Topic'], 'createdAt': victim['CreatedAt']}})
+    print(f'delete by key: status {response["statusCode"]}, {len(stand_in.items)} stored')
+
+
+def scan_benchmark(items, segments, page_rows, latency_ms):
+    stand_in = PagedTableStandIn(items, page_rows, latency_ms)
+    lambda_function.table = stand_in
+
+    start = time.perf_counter()
+    queried = sum(1 for _ in lambda_function.query_all({}))
+    query_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    scanned = sum(len(page) for page in lambda_function.parallel_scan(segments, table_factory=lambda: stand_in))
+    scan_seconds = time.perf_counter() - start
+
+    print(f'single-partition query: {queried} rows in {query_seconds:6.2f}s')
+    print(f'parallel scan ({segments} segments): {scanned} rows in {scan_seconds:6.2f}s ({query_seconds / scan_seconds:.1f}x)')
+
+    if lambda_function.parquet_available():
+        path = os.path.join(tempfile.mkdtemp(), 'feedback.parquet')
+        start = time.perf_counter()
+        rows = lambda_function.write_feedback_parquet(
+            lambda_function.parallel_scan(segments, table_factory=lambda: stand_in), lambda_function.LocalFileUpload(path))
+        print(f'parallel scan to Parquet: {rows} rows, {os.path.getsize(path) / 1e6:.1f} MB in {time.perf_counter() - start:6.2f}s')
+        os.remove(path)
+
+
+def measure(function, *args):
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = function(*args)
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--part-size', type=int, default=lambda_function.EXPORT_PART_SIZE)
+    parser.add_argument('--out', help='keep the exported CSV at this path')
+    parser.add_argument('--scan', action='store_true', help='compare parallel_scan with a single-partition query')
+    parser.add_argument('--segments', type=int, default=lambda_function.SCAN_SEGMENTS)
+    parser.add_argument('--page-rows', type=int, default=500)
+    parser.add_argument('--latency-ms', type=float, default=40)
+    parser.add_argument('--burst', action='store_true', help='post feedback concurrently and count what was stored')
+    parser.add_argument('--posts', type=int, default=10000)
+    parser.add_argument('--threads', type=int, default=64)
+    args = parser.parse_args()
+
+    if args.burst:
+        burst_benchmark(args.posts, args.threads)
+        return
+
+    items = synthetic_items(args.rows)
+    if args.scan:
+        scan_benchmark(items, args.segments, args.page_rows, args.latency_ms)
+        return
+    path = args.out or os.path.join(tempfile.mkdtemp(), 'feedback.csv')
+
+    upload = lambda_function.LocalFileUpload(path)
+    rows, streamed_seconds, streamed_peak = measure(lambda_function.write_feedback_csv, items, upload, args.part_size)
+    with open(path, newline='', encoding='utf-8') as f:
+        read_back = sum(1 for _ in csv.reader(f)) - 1
+    _, concat_seconds, concat_peak = measure(concatenated_export, items)
+
+    print(f'{rows} rows, {os.path.getsize(path) / 1e6:.1f} MB in {upload.parts} parts, {read_back} rows read back')
+    print(f'streaming export:     {streamed_seconds:6.2f}s  peak {streamed_peak / 1e6:7.1f} MB')
+    print(f'concatenated export:  {concat_seconds:6.2f}s  peak {concat_peak / 1e6:7.1f} MB')
+    if not args.out:
+        os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
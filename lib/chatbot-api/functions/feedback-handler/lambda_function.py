@@ -1,13 +1,75 @@
+import csv
+import heapq
 import json
+import time
 import uuid
 import boto3
 import os
-from datetime import datetime
+import queue
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from itertools import islice
 from boto3.dynamodb.conditions import Key, Attr
+from botocore.exceptions import ClientError
+from lambda_logging import get_logger, sample_log_level
+
+# Levels and per-invocation DEBUG sampling come from LOG_LEVEL and LOG_DEBUG_SAMPLE_RATE, see lambda_logging
+logger = get_logger(__name__)
 
 # Initialize DynamoDB client
 dynamodb = boto3.resource('dynamodb')
 table = dynamodb.Table(os.environ.get('FEEDBACK_TABLE'))
+s3 = boto3.client('s3')
+
+# Exports are uploaded in parts of this many bytes, so memory use does not grow with the export.
+# S3 requires every part but the last to be at least 5 MB
+EXPORT_PART_SIZE = int(os.environ.get('EXPORT_PART_SIZE', 8 * 1024 * 1024))
+# Queue of asynchronous export jobs. Without it, download requests export inline as before
+FEEDBACK_EXPORT_QUEUE_URL = os.environ.get('FEEDBACK_EXPORT_QUEUE_URL')
+# Export job state (and the unfinished last part of a paused export) lives under this prefix of the download bucket
+EXPORT_JOB_PREFIX = 'export-jobs/'
+# A worker checkpoints and hands the job to the next invocation when less time than this is left
+EXPORT_CHECKPOINT_MARGIN_MS = int(os.environ.get('EXPORT_CHECKPOINT_MARGIN_MS', 30000))
+# Rows exported between two looks at the remaining time, a few pages of reading
+EXPORT_CHECKPOINT_ROWS = 1000
+# Parallel Scan segments (and threads) of a whole-table "scan" export
+SCAN_SEGMENTS = int(os.environ.get('SCAN_SEGMENTS', 8))
+# Rows per Parquet row group in a scan export
+PARQUET_ROW_GROUP_SIZE = int(os.environ.get('PARQUET_ROW_GROUP_SIZE', 10000))
+# Scan exports are written as Parquet only when this is set to 1. pyarrow is not part of the Lambda
+# asset, so only set it where pyarrow is installed (e.g. from a layer), otherwise scan exports are CSV
+EXPORT_PARQUET = os.environ.get('EXPORT_PARQUET') == '1'
+# Content-Type of exported files by extension
+EXPORT_CONTENT_TYPES = {'.csv': 'text/csv', '.parquet': 'application/vnd.apache.parquet'}
+# AnyIndex partitions are spread over this many shard keys, "YES#0" to "YES#<n-1>". Reads query
+# every shard, so the count can be raised later but not lowered without moving items first
+ANY_SHARDS = int(os.environ.get('ANY_SHARDS', 8))
+# The single AnyIndex partition used before sharding. It is still read until backfill_any_shards has emptied it
+ANY_LEGACY_PARTITION = "YES"
+# Cursor value of a query that has been read to the end
+QUERY_DONE = "done"
+# CreatedAt sort keys are "<timestamp>#<FeedbackID>", so feedback posted on the same topic in the same
+# second gets its own item. Range ends get this appended to include every suffix of the end timestamp
+CREATED_AT_SEPARATOR = "#"
+RANGE_END_SUFFIX = "\uffff"
+# Crockford base32, the ULID alphabet
+ULID_ALPHABET = '0123456789ABCDEFGHJKMNPQRSTVWXYZ'
+# Feedback rows per page in the admin view
+FEEDBACK_PAGE_SIZE = 10
+# (CSV header, item attribute) of every exported column
+EXPORT_COLUMNS = [
+    ('FeedbackID', 'FeedbackID'),
+    ('SessionID', 'SessionID'),
+    ('UserPrompt', 'UserPrompt'),
+    ('FeedbackComment', 'FeedbackComments'),
+    ('Topic', 'Topic'),
+    ('Problem', 'Problem'),
+    ('Feedback', 'Feedback'),
+    ('ChatbotMessage', 'ChatbotMessage'),
+    ('CreatedAt', 'CreatedAt'),
+]
 
 from decimal import Decimal
 
@@ -19,29 +81,35 @@ class DecimalEncoder(json.JSONEncoder):
     
 
 def lambda_handler(event, context):
+    sample_log_level(logger)
     # Determine the type of HTTP method
     admin = False
     try:
         claims = event["requestContext"]["authorizer"]["jwt"]["claims"]
         roles = json.loads(claims['custom:role'])
         if "Admin" in roles:                        
-            print("admin granted!")
+            logger.debug("admin granted!")
             admin = True
         else:
-            print("Caught error: attempted unauthorized admin access")
+            logger.warning("Caught error: attempted unauthorized admin access")
             admin = False
     except:
-        print("Caught error: admin access and user roles are not present")
+        logger.warning("Caught error: admin access and user roles are not present")
         # return {
         #         'statusCode': 500,
         #         'headers': {'Access-Control-Allow-Origin': '*'},
         #         'body': json.dumps('Unable to check user role, please ensure you have Cognito configured correctly with a custom:role attribute.')
         #     }
     http_method = event.get('routeKey')
+    download_path = event.get('rawPath') == '/user-feedback/download-feedback'
     if 'POST' in http_method:
-        if event.get('rawPath') == '/user-feedback/download-feedback' and admin:
+        if download_path and admin:
+            if FEEDBACK_EXPORT_QUEUE_URL:
+                return start_export_job(event, S3JobStore(os.environ["FEEDBACK_S3_DOWNLOAD"]), SqsJobQueue(FEEDBACK_EXPORT_QUEUE_URL))
             return download_feedback(event)
         return post_feedback(event)
+    elif 'GET' in http_method and download_path and admin:
+        return export_status(event, S3JobStore(os.environ["FEEDBACK_S3_DOWNLOAD"]))
     elif 'GET' in http_method and admin:
         return get_feedback(event)
     elif 'DELETE' in http_method and admin:
@@ -56,9 +124,10 @@ def post_feedback(event):
     try:
         # Load JSON data from the event body
         feedback_data = json.loads(event['body'])
-        # Generate a unique feedback ID and current timestamp
-        feedback_id = str(uuid.uuid4())
-        timestamp = datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')
+        # Generate a unique, time-ordered feedback ID and the current timestamp
+        feedback_id = new_ulid()
+        # Take the timestamp from the ID, so CreatedAt sorts in FeedbackID order
+        timestamp = datetime.fromtimestamp(ulid_time(feedback_id), timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
         # Prepare the item to store in DynamoDB
         feedback_data = feedback_data['feedbackData']
         item = {
@@ -71,13 +140,13 @@ def post_feedback(event):
             'Feedback': feedback_data["feedback"],
             'ChatbotMessage': feedback_data['completion'],
             'Sources' : feedback_data['sources'],
-            'CreatedAt': timestamp,
-            'Any' : "YES"
+            'CreatedAt': f"{timestamp}{CREATED_AT_SEPARATOR}{feedback_id}",
+            'Any' : any_shard(feedback_id)
         }
         # Put the item into the DynamoDB table
         table.put_item(Item=item)
         if feedback_data["feedback"] == 0:
-            print("Negative feedback placed")
+            logger.info("Negative feedback placed")
         return {
             'headers' : {
                 'Access-Control-Allow-Origin' : "*"
@@ -86,8 +155,7 @@ def post_feedback(event):
             'body': json.dumps({'FeedbackID': feedback_id})
         }
     except Exception as e:
-        print(e)
-        print("Caught error: DynamoDB error - could not add feedback")
+        logger.error("Caught error: DynamoDB error - could not add feedback: %s", e)
         return {
             'headers' : {
                 'Access-Control-Allow-Origin' : "*"
@@ -97,6 +165,327 @@ def post_feedback(event):
         }
         
     
+# The last ULID made in this container, so ids of the same millisecond keep increasing
+_last_ulid = 0
+_ulid_lock = threading.Lock()
+
+
+def new_ulid(now=None):
+    """
+    A ULID: 48 bits of milliseconds and 80 random bits in Crockford base32, so ids sort by creation time.
+
+    Within one container the ids are strictly increasing: an id made in the same millisecond as
+    the previous one (or after the clock stepped back) is the previous id plus one, as in the ULID
+    spec's monotonic mode. Ids from different containers in the same millisecond sort arbitrarily.
+    """
+    global _last_ulid
+    milliseconds = int((time.time() if now is None else now) * 1000)
+    value = (milliseconds << 80) | int.from_bytes(os.urandom(10), 'big')
+    with _ulid_lock:
+        if value <= _last_ulid:
+            value = _last_ulid + 1
+        _last_ulid = value
+    return ''.join(ULID_ALPHABET[(value >> shift) & 31] for shift in range(125, -1, -5))
+
+
+def ulid_time(ulid):
+    """The creation time of a ULID, in seconds since the epoch."""
+    milliseconds = 0
+    for character in ulid[:10]:
+        milliseconds = milliseconds * 32 + ULID_ALPHABET.index(character)
+    return milliseconds / 1000
+
+
+def created_time(created_at):
+    """The timestamp part of a CreatedAt sort key. Feedback from before the suffix has only the timestamp."""
+    return created_at.split(CREATED_AT_SEPARATOR, 1)[0]
+
+
+def any_shard(feedback_id):
+    """AnyIndex partition key of a feedback item. Derived from the FeedbackID so the backfill and new writes agree."""
+    return f"{ANY_LEGACY_PARTITION}#{zlib.crc32(feedback_id.encode()) % ANY_SHARDS}"
+
+
+def any_partitions():
+    return [ANY_LEGACY_PARTITION] + [f"{ANY_LEGACY_PARTITION}#{shard}" for shard in range(ANY_SHARDS)]
+
+
+def feedback_queries(topic, start_time, end_time):
+    """
+    Build the queries that together read the feedback in a CreatedAt range, by name.
+    A topic is a single query on the table, "any" is one query per AnyIndex partition, named by the partition.
+    """
+    end_time = f"{end_time}{RANGE_END_SUFFIX}"
+    if not topic or topic=="any":
+        return {
+            partition: {
+                'IndexName': 'AnyIndex',
+                'KeyConditionExpression': Key('Any').eq(partition) & Key('CreatedAt').between(start_time, end_time)
+            }
+            for partition in any_partitions()
+        }
+    return {
+        topic: {
+            'KeyConditionExpression': Key('Topic').eq(topic) & Key('CreatedAt').between(start_time, end_time),
+        }
+    }
+
+
+# Runs the concurrent shard queries of MergedQuery. Threads and their tables are kept by the container
+query_executor = ThreadPoolExecutor(max_workers=ANY_SHARDS + 1)
+_thread_tables = threading.local()
+
+
+def _thread_table():
+    # boto3 resources are not thread safe, so every executor thread gets its own table once
+    if getattr(_thread_tables, 'table', None) is None:
+        _thread_tables.table = boto3.session.Session().resource('dynamodb').Table(table.name)
+    return _thread_tables.table
+
+
+class MergedQuery:
+    """
+    Reads several feedback queries as one stream ordered by CreatedAt, e.g. all AnyIndex shards.
+
+    The first page of every query is requested concurrently, later pages when a query runs out
+    (or right away with prefetch). cursors holds the key of the last item handed out for every
+    query, or QUERY_DONE, and a MergedQuery built with the same cursors continues right after it.
+    Items fetched but not yet handed out are simply read again, so page tokens and export
+    checkpoints never skip or repeat a row.
+    """
+
+    def __init__(self, queries, descending=False, cursors=None, page_limit=None, prefetch=False, table_factory=None):
+        """
+        Args:
+            queries (dict): Query arguments by name, as built by feedback_queries.
+            descending (bool): Newest first instead of oldest first.
+            cursors (dict): Read position by query name, from an earlier MergedQuery.
+            page_limit (int): Limit of every query request. Keeps one page of a paged view from
+                reading full 1 MB pages of every shard.
+            prefetch (bool): Request the next page of a query while its current page is read.
+            table_factory (callable): Returns the table used on an executor thread.
+        """
+        self.queries = queries
+        self.descending = descending
+        self.cursors = dict(cursors or {})
+        self.page_limit = page_limit
+        self.prefetch = prefetch
+        self.table_factory = table_factory or _thread_table
+
+    def _query(self, kwargs):
+        return self.table_factory().query(**kwargs)
+
+    def _position(self, name, item):
+        # The key of item as an ExclusiveStartKey of query name. AnyIndex queries are named by their
+        # partition, so this also places an item of another partition in this one
+        position = {'Topic': item['Topic'], 'CreatedAt': item['CreatedAt']}
+        if 'IndexName' in self.queries[name]:
+            position['Any'] = name
+        return position
+
+    def _stream(self, name, kwargs, page):
+        while True:
+            response = page.result()
+            last_key = response.get('LastEvaluatedKey')
+            if last_key:
+                kwargs = dict(kwargs, ExclusiveStartKey=last_key)
+                if self.prefetch:
+                    page = query_executor.submit(self._query, kwargs)
+            for item in response['Items']:
+                yield name, item
+            if not last_key:
+                # heapq.merge only gets here after the last item of this query was handed out
+                self.cursors[name] = QUERY_DONE
+                return
+            if not self.prefetch:
+                page = query_executor.submit(self._query, kwargs)
+
+    def __iter__(self):
+        streams = []
+        for name, query_kwargs in self.queries.items():
+            cursor = self.cursors.get(name)
+            if cursor == QUERY_DONE:
+                continue
+            kwargs = dict(query_kwargs, ScanIndexForward=not self.descending)
+            if self.page_limit:
+                kwargs['Limit'] = self.page_limit
+            if cursor:
+                kwargs['ExclusiveStartKey'] = cursor
+            streams.append(self._stream(name, kwargs, query_executor.submit(self._query, kwargs)))
+        handed_out = False
+        for name, item in heapq.merge(*streams, key=lambda entry: entry[1]['CreatedAt'], reverse=self.descending):
+            if not handed_out:
+                # Queries with nothing handed out yet continue from the first item, so feedback
+                # added ahead of it after this read does not show up on a later page
+                for other in self.queries:
+                    self.cursors.setdefault(other, self._position(other, item))
+                handed_out = True
+            self.cursors[name] = self._position(name, item)
+            yield item
+
+
+def backfill_any_shards():
+    """
+    Move feedback written before AnyIndex was sharded from the "YES" partition to its shard.
+    Returns the number of items moved.
+
+    Run it in a maintenance window, while nobody pages through get_feedback and no export job is
+    running. Page tokens and export checkpoints keep a cursor per partition, so an item moved
+    between two pages can be returned twice or skipped. Running it again is harmless, and
+    feedback posted meanwhile already goes to its shard.
+    """
+    moved = 0
+    legacy = query_all({
+        'IndexName': 'AnyIndex',
+        'KeyConditionExpression': Key('Any').eq(ANY_LEGACY_PARTITION),
+        'ProjectionExpression': 'Topic, CreatedAt, FeedbackID',
+    })
+    for item in legacy:
+        try:
+            table.update_item(
+                Key={'Topic': item['Topic'], 'CreatedAt': item['CreatedAt']},
+                UpdateExpression='SET #any = :shard',
+                # Skips items deleted or already moved since the index page was read
+                ConditionExpression='#any = :legacy',
+                ExpressionAttributeNames={'#any': 'Any'},
+                ExpressionAttributeValues={':shard': any_shard(item['FeedbackID']), ':legacy': ANY_LEGACY_PARTITION}
+            )
+            moved += 1
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+    logger.info("Moved %d feedback items to AnyIndex shards", moved)
+    return moved
+
+
+def query_all(query_kwargs):
+    """Yield every item of a query, following LastEvaluatedKey past the 1 MB page limit."""
+    query_kwargs = dict(query_kwargs)
+    while True:
+        response = table.query(**query_kwargs)
+        yield from response['Items']
+        if 'LastEvaluatedKey' not in response:
+            return
+        query_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+class S3MultipartUpload:
+    """Uploads an export to S3 part by part."""
+
+    def __init__(self, bucket, key, client=None, upload_id=None, parts=None):
+        self.client = client or s3
+        self.bucket = bucket
+        self.key = key
+        # An upload_id and its parts resume an upload started by an earlier invocation
+        content_type = EXPORT_CONTENT_TYPES.get(os.path.splitext(key)[1], 'application/octet-stream')
+        self.upload_id = upload_id or self.client.create_multipart_upload(Bucket=bucket, Key=key, ContentType=content_type)['UploadId']
+        self.parts = list(parts or [])
+
+    def upload_part(self, data):
+        part_number = len(self.parts) + 1
+        response = self.client.upload_part(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id, PartNumber=part_number, Body=data)
+        self.parts.append({'PartNumber': part_number, 'ETag': response['ETag']})
+
+    def complete(self):
+        if not self.parts:
+            # S3 needs at least one part, even for an empty export
+            self.upload_part(b'')
+        self.client.complete_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id, MultipartUpload={'Parts': self.parts})
+
+    def abort(self):
+        self.client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+
+
+class LocalFileUpload:
+    """Local stand-in for S3MultipartUpload that appends the parts to a file."""
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'wb')
+        self.parts = 0
+
+    def upload_part(self, data):
+        self.file.write(data)
+        self.parts += 1
+
+    def complete(self):
+        self.file.close()
+
+    def abort(self):
+        self.file.close()
+        os.remove(self.path)
+
+
+class PartWriter:
+    """File-like object for csv.writer that hands the encoded text to an upload in parts of part_size bytes."""
+
+    def __init__(self, upload, part_size=None):
+        self.upload = upload
+        self.part_size = part_size or EXPORT_PART_SIZE
+        self.buffer = bytearray()
+
+    closed = False
+
+    def write(self, data):
+        self.buffer += data.encode('utf-8') if isinstance(data, str) else data
+        if len(self.buffer) >= self.part_size:
+            # The full buffer is handed over as the part and a new one started, copying it would double the peak
+            part, self.buffer = self.buffer, bytearray()
+            self.upload.upload_part(part)
+        return len(data)
+
+    def flush(self):
+        # Parts are only sent once they reach part_size
+        pass
+
+    def close(self):
+        if self.buffer:
+            part, self.buffer = self.buffer, bytearray()
+            self.upload.upload_part(part)
+        self.upload.complete()
+        self.closed = True
+
+
+EXPORT_HEADER = [header for header, _ in EXPORT_COLUMNS]
+
+
+def export_value(item, attribute):
+    value = item.get(attribute, '')
+    # Exports show when feedback was given, the FeedbackID column already holds the suffix
+    return created_time(value) if attribute == 'CreatedAt' else value
+
+
+def csv_row(item):
+    return [export_value(item, attribute) for _, attribute in EXPORT_COLUMNS]
+
+
+def write_feedback_csv(items, upload, part_size=None):
+    """
+    Write feedback items as CSV to an upload. The csv module quotes fields holding commas,
+    quotes or line breaks, so the text is exported unchanged.
+
+    Args:
+        items (iterable): Feedback items, e.g. from query_all.
+        upload: S3MultipartUpload, LocalFileUpload or another object with upload_part/complete/abort.
+
+    Returns:
+        int: The number of rows written.
+    """
+    writer = PartWriter(upload, part_size)
+    rows = 0
+    try:
+        csv_writer = csv.writer(writer)
+        csv_writer.writerow(EXPORT_HEADER)
+        for item in items:
+            csv_writer.writerow(csv_row(item))
+            rows += 1
+        writer.close()
+    except Exception:
+        upload.abort()
+        raise
+    return rows
+
+
 def download_feedback(event):
 
     # load parameters
@@ -104,24 +493,16 @@ def download_feedback(event):
     start_time = data.get('startTime')
     end_time = data.get('endTime')
     topic = data.get('topic')
-        
-    response = None
 
-    # if topic is any, use the appropriate index
-    if not topic or topic=="any":                
-        query_kwargs = {
-            'IndexName': 'AnyIndex',
-            'KeyConditionExpression': Key('Any').eq("YES") & Key('CreatedAt').between(start_time, end_time)
-        }
-    else:
-        query_kwargs = {
-            'KeyConditionExpression': Key('CreatedAt').between(start_time, end_time) & Key('Topic').eq(topic),            
-        }   
+    S3_DOWNLOAD_BUCKET = os.environ["FEEDBACK_S3_DOWNLOAD"]
+    file_name = f"feedback-{start_time}-{end_time}.csv"
 
     try:
-        response = table.query(**query_kwargs)
+        items = MergedQuery(feedback_queries(topic, start_time, end_time), prefetch=True)
+        rows = write_feedback_csv(items, S3MultipartUpload(S3_DOWNLOAD_BUCKET, file_name))
+        logger.info("Exported %d feedback rows to %s", rows, file_name)
     except Exception as e:
-        print("Caught error: DynamoDB error - could not load feedback for download")
+        logger.error("Caught error: could not export feedback for download: %s", e)
         return {
             'headers': {
                 'Access-Control-Allow-Origin': "*"
@@ -129,30 +510,11 @@ def download_feedback(event):
             'statusCode': 500,
             'body': json.dumps('Failed to retrieve feedback for download: ' + str(e))
         }
-    
-    
-    def clean_csv(field):
-        print("working")
-        field = str(field).replace('"', '""')
-        field = field.replace('\n','').replace(',', '')
-        return f'{field}'
-    
-    csv_content = "FeedbackID, SessionID, UserPrompt, FeedbackComment, Topic, Problem, Feedback, ChatbotMessage, CreatedAt\n"
-    
-    for item in response['Items']:
-        csv_content += f"{clean_csv(item['FeedbackID'])}, {clean_csv(item['SessionID'])}, {clean_csv(item['UserPrompt'])}, {clean_csv(item['FeedbackComments'])}, {clean_csv(item['Topic'])}, {clean_csv(item['Problem'])}, {clean_csv(item['Feedback'])}, {clean_csv(item['ChatbotMessage'])}, {clean_csv(item['CreatedAt'])}\n"
-        print(csv_content)
-    
-    s3 = boto3.client('s3')
-    S3_DOWNLOAD_BUCKET = os.environ["FEEDBACK_S3_DOWNLOAD"]
 
     try:
-        file_name = f"feedback-{start_time}-{end_time}.csv"
-        s3.put_object(Bucket=S3_DOWNLOAD_BUCKET, Key=file_name, Body=csv_content)
         presigned_url = s3.generate_presigned_url('get_object', Params={'Bucket': S3_DOWNLOAD_BUCKET, 'Key': file_name}, ExpiresIn=3600)
-
     except Exception as e:
-        print("Caught error: S3 error - could not generate download link")
+        logger.error("Caught error: S3 error - could not generate download link")
         return {
             'headers': {
                 'Access-Control-Allow-Origin': "*"
@@ -169,6 +531,378 @@ def download_feedback(event):
     }
         
 
+def _scan_segment(segment_table, segment, total_segments, scan_kwargs, pages, stop):
+    # Runs on a worker thread: pages through one Scan segment and hands every page to the consumer
+    def put(value):
+        while not stop.is_set():
+            try:
+                pages.put(value, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    kwargs = dict(scan_kwargs, Segment=segment, TotalSegments=total_segments)
+    try:
+        while not stop.is_set():
+            response = segment_table.scan(**kwargs)
+            put(response['Items'])
+            if 'LastEvaluatedKey' not in response:
+                break
+            kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+        put(None)
+    except Exception as e:
+        put(e)
+
+
+def parallel_scan(total_segments=None, scan_kwargs=None, table_factory=None):
+    """
+    Yield pages of items from a parallel Scan of the whole feedback table, one thread per segment.
+    Pages arrive in completion order. At most two pages per segment wait in memory.
+
+    Args:
+        total_segments (int): Number of Scan segments. Defaults to SCAN_SEGMENTS.
+        scan_kwargs (dict): Extra Scan arguments, e.g. a FilterExpression.
+        table_factory (callable): Returns the table object for one segment. Each thread gets its own,
+            boto3 resources are not thread safe.
+    """
+    total_segments = total_segments or SCAN_SEGMENTS
+    table_factory = table_factory or (lambda: boto3.session.Session().resource('dynamodb').Table(table.name))
+    pages = queue.Queue(maxsize=total_segments * 2)
+    stop = threading.Event()
+    with ThreadPoolExecutor(max_workers=total_segments) as executor:
+        for segment in range(total_segments):
+            executor.submit(_scan_segment, table_factory(), segment, total_segments, scan_kwargs or {}, pages, stop)
+        try:
+            finished = 0
+            while finished < total_segments:
+                page = pages.get()
+                if page is None:
+                    finished += 1
+                elif isinstance(page, Exception):
+                    raise page
+                else:
+                    yield page
+        finally:
+            # Lets the segment threads exit if the consumer stopped early or a segment failed
+            stop.set()
+
+
+def write_feedback_parquet(pages, upload, part_size=None):
+    """
+    Write pages of feedback items as a Parquet file to an upload, PARQUET_ROW_GROUP_SIZE rows per row group.
+    Every column is written as a string, like in the CSV export.
+
+    Returns:
+        int: The number of rows written.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = pa.schema([(header, pa.string()) for header in EXPORT_HEADER])
+    writer = PartWriter(upload, part_size)
+    rows = 0
+    try:
+        parquet = pq.ParquetWriter(writer, schema, compression='snappy')
+        batch = []
+
+        def write_batch():
+            columns = {header: [str(export_value(item, attribute)) for item in batch] for header, attribute in EXPORT_COLUMNS}
+            parquet.write_table(pa.Table.from_pydict(columns, schema=schema))
+            batch.clear()
+
+        for page in pages:
+            batch.extend(page)
+            rows += len(page)
+            if len(batch) >= PARQUET_ROW_GROUP_SIZE:
+                write_batch()
+        if batch:
+            write_batch()
+        parquet.close()
+        writer.close()
+    except Exception:
+        upload.abort()
+        raise
+    return rows
+
+
+def parquet_available():
+    try:
+        import pyarrow.parquet  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+def pages_before_deadline(pages, remaining_ms):
+    """Pass pages on until less than EXPORT_CHECKPOINT_MARGIN_MS is left, then stop the scan and raise TimeoutError."""
+    try:
+        for page in pages:
+            if remaining_ms() < EXPORT_CHECKPOINT_MARGIN_MS:
+                raise TimeoutError("The scan export did not finish within one worker invocation, export a topic or a shorter range instead")
+            yield page
+    finally:
+        pages.close()
+
+
+def export_scan(start_time, end_time, upload, file_format, total_segments=None, remaining_ms=None):
+    """
+    Export every feedback row across all topics with a parallel Scan, optionally limited to a CreatedAt range.
+
+    Args:
+        file_format (str): "csv", or "parquet" where pyarrow is installed.
+        remaining_ms (callable): Returns the milliseconds left in this invocation. If given, the
+            export is aborted with TimeoutError when it would not finish in time.
+
+    Returns:
+        int: The number of rows written.
+    """
+    scan_kwargs = {}
+    if start_time and end_time:
+        scan_kwargs['FilterExpression'] = Attr('CreatedAt').between(start_time, f"{end_time}{RANGE_END_SUFFIX}")
+    pages = parallel_scan(total_segments, scan_kwargs)
+    if remaining_ms:
+        pages = pages_before_deadline(pages, remaining_ms)
+    if file_format == 'parquet':
+        return write_feedback_parquet(pages, upload)
+    return write_feedback_csv((item for page in pages for item in page), upload)
+
+
+class S3JobStore:
+    """Keeps export job state as JSON objects in the download bucket."""
+
+    def __init__(self, bucket, client=None):
+        self.client = client or s3
+        self.bucket = bucket
+
+    def get(self, job_id):
+        try:
+            response = self.client.get_object(Bucket=self.bucket, Key=f"{EXPORT_JOB_PREFIX}{job_id}.json")
+        except self.client.exceptions.NoSuchKey:
+            return None
+        return json.loads(response['Body'].read())
+
+    def put(self, job):
+        job['updated_at'] = datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+        self.client.put_object(Bucket=self.bucket, Key=f"{EXPORT_JOB_PREFIX}{job['job_id']}.json", Body=json.dumps(job), ContentType='application/json')
+
+    def get_buffer(self, job_id):
+        try:
+            response = self.client.get_object(Bucket=self.bucket, Key=f"{EXPORT_JOB_PREFIX}{job_id}.buffer")
+        except self.client.exceptions.NoSuchKey:
+            return b''
+        return response['Body'].read()
+
+    def put_buffer(self, job_id, data):
+        self.client.put_object(Bucket=self.bucket, Key=f"{EXPORT_JOB_PREFIX}{job_id}.buffer", Body=bytes(data))
+
+    def delete_buffer(self, job_id):
+        self.client.delete_object(Bucket=self.bucket, Key=f"{EXPORT_JOB_PREFIX}{job_id}.buffer")
+
+
+class SqsJobQueue:
+    """Sends export job ids to the export worker."""
+
+    def __init__(self, queue_url):
+        self.queue_url = queue_url
+        self.client = boto3.client('sqs')
+
+    def send(self, job_id):
+        self.client.send_message(QueueUrl=self.queue_url, MessageBody=json.dumps({'job_id': job_id}))
+
+
+class InMemoryJobQueue:
+    """Local stand-in for SqsJobQueue. receive() returns records shaped like an SQS event."""
+
+    def __init__(self):
+        self.messages = []
+
+    def send(self, job_id):
+        self.messages.append({'body': json.dumps({'job_id': job_id})})
+
+    def receive(self):
+        messages, self.messages = self.messages, []
+        return messages
+
+
+def start_export_job(event, store, queue):
+    """Record a new export job and queue it for the worker. Returns the job id right away."""
+    data = json.loads(event['body'])
+    # "scan" exports all topics with a parallel Scan, written as Parquet where EXPORT_PARQUET is on and pyarrow is installed
+    mode = 'scan' if data.get('mode') == 'scan' else 'query'
+    extension = 'parquet' if mode == 'scan' and EXPORT_PARQUET and parquet_available() else 'csv'
+    job_id = str(uuid.uuid4())
+    # The job id keeps concurrent exports of the same range from writing to the same object
+    prefix = 'feedback-scan' if mode == 'scan' else 'feedback'
+    job = {
+        'job_id': job_id,
+        'status': 'queued',
+        'mode': mode,
+        'topic': data.get('topic'),
+        'start_time': data.get('startTime'),
+        'end_time': data.get('endTime'),
+        'file_name': f"{prefix}-{data.get('startTime')}-{data.get('endTime')}-{job_id}.{extension}",
+        'rows': 0,
+        'upload_id': None,
+        'parts': [],
+        'cursors': {},
+    }
+    store.put(job)
+    queue.send(job['job_id'])
+    return {
+        'headers': {
+            'Access-Control-Allow-Origin': "*"
+        },
+        'statusCode': 202,
+        'body': json.dumps({'job_id': job['job_id'], 'status': job['status']})
+    }
+
+
+def run_export_job(job_id, store, queue, remaining_ms, s3_client=None):
+    """
+    Continue an export job from its last checkpoint.
+
+    Rows are exported until the queries are done or less than EXPORT_CHECKPOINT_MARGIN_MS is left.
+    In that case the upload id, its parts, the unfinished last part and the MergedQuery cursors are
+    saved and the job is queued again, so the next invocation picks up where this one stopped.
+    A job redelivered after its invocation died continues from the last checkpoint, or starts over
+    in the same upload if it had none.
+
+    Args:
+        remaining_ms (callable): Returns the milliseconds left in this invocation.
+    """
+    job = store.get(job_id)
+    if not job or job['status'] in ('done', 'failed'):
+        return job
+    bucket = os.environ["FEEDBACK_S3_DOWNLOAD"]
+    if job.get('mode') == 'scan':
+        return run_scan_export_job(job, store, bucket, remaining_ms, s3_client)
+    upload = None
+    try:
+        upload = S3MultipartUpload(bucket, job['file_name'], s3_client, job['upload_id'], job['parts'])
+        writer = PartWriter(upload)
+        csv_writer = csv.writer(writer)
+        if job['cursors']:
+            writer.buffer += store.get_buffer(job_id)
+        else:
+            csv_writer.writerow(EXPORT_HEADER)
+        if not job['upload_id']:
+            # Saved before any row is read, so the upload can still be aborted if this invocation dies
+            job.update(status='running', upload_id=upload.upload_id)
+            store.put(job)
+
+        items = MergedQuery(feedback_queries(job['topic'], job['start_time'], job['end_time']), cursors=job.get('cursors'), prefetch=True)
+        for item in items:
+            csv_writer.writerow(csv_row(item))
+            job['rows'] += 1
+            if job['rows'] % EXPORT_CHECKPOINT_ROWS == 0 and remaining_ms() < EXPORT_CHECKPOINT_MARGIN_MS:
+                job['cursors'] = dict(items.cursors)
+                job['parts'] = upload.parts
+                store.put_buffer(job_id, writer.buffer)
+                store.put(job)
+                queue.send(job_id)
+                logger.info("Export job %s checkpointed after %d rows", job_id, job['rows'])
+                return job
+        writer.close()
+        job.update(status='done', parts=upload.parts, cursors=dict(items.cursors))
+        store.put(job)
+        store.delete_buffer(job_id)
+        logger.info("Export job %s done, %d rows", job_id, job['rows'])
+        return job
+    except Exception as e:
+        logger.error("Caught error: export job %s failed: %s", job_id, e)
+        if upload:
+            try:
+                upload.abort()
+            except Exception as abort_error:
+                logger.error("Caught error: could not abort the upload of export job %s: %s", job_id, abort_error)
+        job.update(status='failed', error=str(e))
+        store.put(job)
+        return job
+
+
+def run_scan_export_job(job, store, bucket, remaining_ms, s3_client=None):
+    # Scan exports are not checkpointed, a Parquet file cannot be continued by another invocation.
+    # An export that is not done EXPORT_CHECKPOINT_MARGIN_MS before the timeout fails instead
+    try:
+        # A redelivered job writes its parts again into the upload of the earlier attempt
+        upload = S3MultipartUpload(bucket, job['file_name'], s3_client, job['upload_id'])
+        if not job['upload_id']:
+            job.update(status='running', upload_id=upload.upload_id)
+            store.put(job)
+        file_format = 'parquet' if job['file_name'].endswith('.parquet') else 'csv'
+        job['rows'] = export_scan(job['start_time'], job['end_time'], upload, file_format, remaining_ms=remaining_ms)
+        job['status'] = 'done'
+        logger.info("Scan export job %s done, %d rows", job['job_id'], job['rows'])
+    except Exception as e:
+        logger.error("Caught error: scan export job %s failed: %s", job['job_id'], e)
+        job.update(status='failed', error=str(e))
+    store.put(job)
+    return job
+
+
+def fail_export_job(job_id, store, error, s3_client=None):
+    """Mark an unfinished export job failed and abort its upload. Returns the job."""
+    job = store.get(job_id)
+    if not job or job['status'] in ('done', 'failed'):
+        return job
+    if job.get('upload_id'):
+        try:
+            S3MultipartUpload(os.environ["FEEDBACK_S3_DOWNLOAD"], job['file_name'], s3_client, job['upload_id']).abort()
+            store.delete_buffer(job_id)
+        except Exception as e:
+            logger.error("Caught error: could not abort the upload of export job %s: %s", job_id, e)
+    job.update(status='failed', error=error)
+    store.put(job)
+    return job
+
+
+def export_status(event, store, s3_client=None):
+    query_params = event.get('queryStringParameters') or {}
+    job = store.get(query_params.get('jobId'))
+    if not job:
+        return {
+            'headers': {
+                'Access-Control-Allow-Origin': "*"
+            },
+            'statusCode': 404,
+            'body': json.dumps('Export job not found')
+        }
+    body = {'job_id': job['job_id'], 'status': job['status'], 'rows': job['rows']}
+    if job['status'] == 'done':
+        body['download_url'] = (s3_client or s3).generate_presigned_url('get_object', Params={'Bucket': os.environ["FEEDBACK_S3_DOWNLOAD"], 'Key': job['file_name']}, ExpiresIn=3600)
+    elif job['status'] == 'failed':
+        body['error'] = job.get('error')
+    return {
+        'headers': {
+            'Access-Control-Allow-Origin': "*"
+        },
+        'statusCode': 200,
+        'body': json.dumps(body)
+    }
+
+
+def export_worker_handler(event, context):
+    """Entry point of the export worker function, fed by the export queue."""
+    sample_log_level(logger)
+    store = S3JobStore(os.environ["FEEDBACK_S3_DOWNLOAD"])
+    queue = SqsJobQueue(FEEDBACK_EXPORT_QUEUE_URL)
+    for record in event['Records']:
+        run_export_job(json.loads(record['body'])['job_id'], store, queue, context.get_remaining_time_in_millis)
+
+
+def export_dead_letter_handler(event, context):
+    """
+    Entry point of the function fed by the export dead-letter queue. A job lands there when its
+    worker crashed or timed out on every delivery, so it is marked failed instead of staying running.
+    """
+    sample_log_level(logger)
+    store = S3JobStore(os.environ["FEEDBACK_S3_DOWNLOAD"])
+    for record in event['Records']:
+        job_id = json.loads(record['body'])['job_id']
+        logger.error("Caught error: export job %s was moved to the dead-letter queue", job_id)
+        fail_export_job(job_id, store, 'The export worker stopped before the export finished')
+
+
 def get_feedback(event):
     try:
         # Extract query parameters
@@ -176,35 +910,25 @@ def get_feedback(event):
         start_time = query_params.get('startTime')
         end_time = query_params.get('endTime')
         topic = query_params.get('topic')
-        exclusive_start_key = query_params.get('nextPageToken')  # Pagination token        
-        
-        response = None        
-        
-        if not topic or topic=="any":        
-            query_kwargs = {
-                'IndexName' : 'AnyIndex',
-                'KeyConditionExpression': Key('Any').eq("YES") & Key('CreatedAt').between(start_time, end_time),
-                'ScanIndexForward' : False,
-                'Limit' : 10
-            } 
-        else:
-            query_kwargs = {
-                'KeyConditionExpression': Key('CreatedAt').between(start_time, end_time) & Key('Topic').eq(topic),
-                'ScanIndexForward' : False,
-                'Limit' : 10
-            }
+        page_token = query_params.get('nextPageToken')  # Pagination token, the cursors of the shard queries
+
+        reader = MergedQuery(
+            feedback_queries(topic, start_time, end_time),
+            descending=True,
+            cursors=json.loads(page_token) if page_token else None,
+            page_limit=FEEDBACK_PAGE_SIZE,
+        )
+        items = iter(reader)
+        page = list(islice(items, FEEDBACK_PAGE_SIZE))
+        # Copied before looking one item ahead, so the next page starts right after this one
+        cursors = dict(reader.cursors)
 
-        if exclusive_start_key:
-            query_kwargs['ExclusiveStartKey'] = json.loads(exclusive_start_key)
-        
-        response = table.query(**query_kwargs)
-        
         body = {
-            'Items':  response['Items'],            
+            'Items':  page,
         }
-        
-        if 'LastEvaluatedKey' in response:
-            body['NextPageToken'] = json.dumps(response['LastEvaluatedKey'])
+
+        if next(items, None) is not None:
+            body['NextPageToken'] = json.dumps(cursors)
 
         return {
             'headers': {
@@ -214,7 +938,7 @@ def get_feedback(event):
             'body': json.dumps(body, cls=DecimalEncoder)
         }
     except Exception as e:
-        print("Caught error: DynamoDB error - could not get feedback")
+        logger.error("Caught error: DynamoDB error - could not get feedback")
         return {
             'headers': {
                 'Access-Control-Allow-Origin': "*"
@@ -225,19 +949,18 @@ def get_feedback(event):
         
 def delete_feedback(event):
     try:
-        # Extract FeedbackID from the event
-        # feedback_id = json.loads(event['body']).get('FeedbackID')
+        # Topic and the full CreatedAt sort key, suffix included, identify exactly one feedback item
         query_params = event.get('queryStringParameters', {})
         topic = query_params.get('topic')
         created_at = query_params.get('createdAt')
         
-        if not topic:
+        if not topic or not created_at:
             return {
                 'headers': {
                     'Access-Control-Allow-Origin': '*'
                 },
                 'statusCode': 400,
-                'body': json.dumps('Missing FeedbackID')
+                'body': json.dumps('Missing topic or createdAt')
             }
         # Delete the item from the DynamoDB table
         response = table.delete_item(
@@ -254,7 +977,7 @@ def delete_feedback(event):
             'body': json.dumps({'message': 'Feedback deleted successfully'})
         }
     except Exception as e:
-        print("Caught error: DynamoDB error - could not delete feedback")
+        logger.error("Caught error: DynamoDB error - could not delete feedback")
         return {
             'headers': {
                 'Access-Control-Allow-Origin': '*'
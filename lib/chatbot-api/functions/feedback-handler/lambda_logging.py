@@ -0,0 +1 @@
+../../../shared/python/lambda_logging.py
\ No newline at end of file
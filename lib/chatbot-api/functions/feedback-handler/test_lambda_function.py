@@ -0,0 +1,309 @@
+"""
+Tests for the feedback handler, run from this directory against moto's in-process DynamoDB and
+S3 mocks (pip install moto):
+
+    python -m unittest test_lambda_function
+
+Feedback is posted through post_feedback, so every item has the sharded AnyIndex key. Some of it is
+then moved back to the single "YES" partition, like feedback posted before sharding. The burst test
+posts into benchmark.py's stand-in, which overwrites items with the same key like DynamoDB does.
+"""
+import csv
+import json
+import os
+import random
+import threading
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+os.environ.setdefault('FEEDBACK_TABLE', 'FeedbackHandlerTest')
+os.environ.setdefault('FEEDBACK_S3_DOWNLOAD', 'feedback-handler-test')
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+os.environ.setdefault('AWS_ACCESS_KEY_ID', 'test')
+os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'test')
+
+import boto3
+from moto import mock_aws
+
+import lambda_function
+from benchmark import KeyedTableStandIn
+
+TOPICS = ['Grants', 'Loans', 'Tax Credits']
+ALL_TIME = {'startTime': '2000-01-01', 'endTime': '2100-01-01'}
+
+
+def create_feedback_table(client):
+    client.create_table(
+        TableName=os.environ['FEEDBACK_TABLE'],
+        KeySchema=[{'AttributeName': 'Topic', 'KeyType': 'HASH'}, {'AttributeName': 'CreatedAt', 'KeyType': 'RANGE'}],
+        AttributeDefinitions=[{'AttributeName': name, 'AttributeType': 'S'} for name in ('Topic', 'CreatedAt', 'Any')],
+        GlobalSecondaryIndexes=[{
+            'IndexName': 'AnyIndex',
+            'KeySchema': [{'AttributeName': 'Any', 'KeyType': 'HASH'}, {'AttributeName': 'CreatedAt', 'KeyType': 'RANGE'}],
+            'Projection': {'ProjectionType': 'ALL'},
+        }],
+        BillingMode='PAY_PER_REQUEST',
+    )
+
+
+def post(topic, prompt='How do I apply?'):
+    feedback = {'sessionId': 'test-session', 'prompt': prompt, 'topic': topic, 'feedback': 0,
+                'completion': 'Apply online.', 'sources': []}
+    response = lambda_function.post_feedback({'body': json.dumps({'feedbackData': feedback})})
+    return json.loads(response['body'])['FeedbackID']
+
+
+class FeedbackTestCase(unittest.TestCase):
+    def setUp(self):
+        mock = mock_aws()
+        mock.start()
+        self.addCleanup(mock.stop)
+        create_feedback_table(boto3.client('dynamodb'))
+        boto3.client('s3').create_bucket(Bucket=os.environ['FEEDBACK_S3_DOWNLOAD'])
+        self.patch('table', boto3.resource('dynamodb').Table(os.environ['FEEDBACK_TABLE']))
+        self.patch('s3', boto3.client('s3'))
+        # executor threads build their own tables again, against this test's mock
+        self.patch('_thread_tables', threading.local())
+
+    def patch(self, name, value):
+        original = getattr(lambda_function, name)
+        setattr(lambda_function, name, value)
+        self.addCleanup(setattr, lambda_function, name, original)
+
+    def add_feedback(self, count, legacy_share=0.3):
+        """Post count feedback items over TOPICS and move a share of them to the legacy partition."""
+        random.seed(count)
+        for i in range(count):
+            post(random.choice(TOPICS), f'question {i}')
+        items = lambda_function.table.scan()['Items']
+        self.assertEqual(len(items), count)
+        for item in random.sample(items, int(count * legacy_share)):
+            self.move_to_legacy(item)
+        self.newest_first = [item['FeedbackID'] for item in sorted(items, key=lambda item: item['CreatedAt'], reverse=True)]
+        self.topic_of = {item['FeedbackID']: item['Topic'] for item in items}
+
+    def move_to_legacy(self, item):
+        lambda_function.table.update_item(Key={'Topic': item['Topic'], 'CreatedAt': item['CreatedAt']},
+                                          UpdateExpression='SET #any = :legacy', ExpressionAttributeNames={'#any': 'Any'},
+                                          ExpressionAttributeValues={':legacy': lambda_function.ANY_LEGACY_PARTITION})
+
+    def page_through(self, topic):
+        """Read every page of get_feedback, requesting every page twice. Returns the pages as lists of FeedbackIDs."""
+        pages = []
+        token = None
+        while True:
+            params = dict(ALL_TIME, topic=topic)
+            if token:
+                params['nextPageToken'] = token
+            first, again = (json.loads(lambda_function.get_feedback({'queryStringParameters': params})['body']) for _ in range(2))
+            self.assertEqual(first, again, f'page token {token} returned different pages')
+            pages.append([item['FeedbackID'] for item in first['Items']])
+            token = first.get('NextPageToken')
+            if not token:
+                return pages
+
+    def assertPages(self, pages, expected):
+        # every item exactly once, newest first, in full pages until the last
+        self.assertEqual([feedback_id for page in pages for feedback_id in page], expected)
+        self.assertTrue(all(len(page) == lambda_function.FEEDBACK_PAGE_SIZE for page in pages[:-1]))
+
+    def export(self):
+        """Run an export job to the end, checkpointing every EXPORT_CHECKPOINT_ROWS rows. Returns (job, FeedbackIDs, invocations)."""
+        store = lambda_function.S3JobStore(os.environ['FEEDBACK_S3_DOWNLOAD'])
+        job_queue = lambda_function.InMemoryJobQueue()
+        response = lambda_function.start_export_job({'body': json.dumps(dict(ALL_TIME, topic='any'))}, store, job_queue)
+        job_id = json.loads(response['body'])['job_id']
+        invocations = 0
+        while job_queue.receive():
+            invocations += 1
+            # no time left, so every invocation stops at the first checkpoint
+            job = lambda_function.run_export_job(job_id, store, job_queue, lambda: 0)
+        body = lambda_function.s3.get_object(Bucket=store.bucket, Key=job['file_name'])['Body'].read().decode('utf-8')
+        return job, [row[0] for row in list(csv.reader(body.splitlines()))[1:]], invocations
+
+
+class MergedQueryTest(FeedbackTestCase):
+    def setUp(self):
+        super().setUp()
+        self.add_feedback(60)
+
+    def test_merges_every_shard_and_the_legacy_partition_newest_first(self):
+        queries = lambda_function.feedback_queries('any', ALL_TIME['startTime'], ALL_TIME['endTime'])
+        self.assertEqual(sorted(queries), sorted(['YES'] + [f'YES#{shard}' for shard in range(8)]))
+        # a small page limit makes every shard read several pages
+        merged = lambda_function.MergedQuery(queries, descending=True, page_limit=2)
+        self.assertEqual([item['FeedbackID'] for item in merged], self.newest_first)
+
+    def test_oldest_first(self):
+        merged = lambda_function.MergedQuery(lambda_function.feedback_queries('any', ALL_TIME['startTime'], ALL_TIME['endTime']))
+        self.assertEqual([item['FeedbackID'] for item in merged], self.newest_first[::-1])
+
+    def test_resumes_from_cursors(self):
+        queries = lambda_function.feedback_queries('any', ALL_TIME['startTime'], ALL_TIME['endTime'])
+        ids = []
+        cursors = None
+        while len(ids) < len(self.newest_first):
+            merged = lambda_function.MergedQuery(queries, descending=True, cursors=cursors, page_limit=3)
+            items = iter(merged)
+            ids.extend(item['FeedbackID'] for _, item in zip(range(7), items))
+            cursors = dict(merged.cursors)
+        self.assertEqual(ids, self.newest_first)
+
+
+class GetFeedbackPaginationTest(FeedbackTestCase):
+    def setUp(self):
+        super().setUp()
+        self.add_feedback(75)
+
+    def test_pages_of_all_topics(self):
+        self.assertPages(self.page_through('any'), self.newest_first)
+
+    def test_pages_of_one_topic(self):
+        expected = [feedback_id for feedback_id in self.newest_first if self.topic_of[feedback_id] == 'Grants']
+        self.assertPages(self.page_through('Grants'), expected)
+
+    def test_pages_after_backfill(self):
+        self.assertEqual(lambda_function.backfill_any_shards(), int(75 * 0.3))
+        self.assertEqual(lambda_function.backfill_any_shards(), 0)
+        self.assertPages(self.page_through('any'), self.newest_first)
+
+    def test_feedback_posted_between_pages_does_not_shift_them(self):
+        pages = self.page_through('any')
+        first = json.loads(lambda_function.get_feedback({'queryStringParameters': dict(ALL_TIME, topic='any')})['body'])
+        # new feedback in a shard that had nothing on the first page, where the second page starts fresh
+        first_page_shards = {item['Any'] for item in first['Items']}
+        while lambda_function.any_shard(post('Grants')) in first_page_shards:
+            pass
+        params = dict(ALL_TIME, topic='any', nextPageToken=first['NextPageToken'])
+        second = json.loads(lambda_function.get_feedback({'queryStringParameters': params})['body'])
+        self.assertEqual([item['FeedbackID'] for item in second['Items']], pages[1])
+
+
+class ExportResumptionTest(FeedbackTestCase):
+    def test_checkpointed_export_writes_every_row_once_oldest_first(self):
+        self.patch('EXPORT_CHECKPOINT_ROWS', 10)
+        self.add_feedback(45)
+        job, exported, invocations = self.export()
+        self.assertEqual(job['status'], 'done')
+        self.assertEqual(exported, self.newest_first[::-1])
+        self.assertEqual(invocations, 5)
+
+
+class ScanExportTest(FeedbackTestCase):
+    def setUp(self):
+        super().setUp()
+        self.add_feedback(30)
+        self.store = lambda_function.S3JobStore(os.environ['FEEDBACK_S3_DOWNLOAD'])
+        self.job_queue = lambda_function.InMemoryJobQueue()
+        response = lambda_function.start_export_job({'body': json.dumps({'mode': 'scan'})}, self.store, self.job_queue)
+        self.job_id = json.loads(response['body'])['job_id']
+        self.job_queue.receive()
+
+    def test_scan_export_writes_every_row(self):
+        job = lambda_function.run_export_job(self.job_id, self.store, self.job_queue, lambda: 600000)
+        self.assertEqual(job['status'], 'done')
+        self.assertTrue(job['file_name'].endswith('.csv'))
+        body = lambda_function.s3.get_object(Bucket=self.store.bucket, Key=job['file_name'])['Body'].read().decode('utf-8')
+        self.assertEqual(sorted(row[0] for row in list(csv.reader(body.splitlines()))[1:]), sorted(self.newest_first))
+
+    def test_scan_export_out_of_time_fails_and_aborts_its_upload(self):
+        job = lambda_function.run_export_job(self.job_id, self.store, self.job_queue, lambda: 0)
+        self.assertEqual(job['status'], 'failed')
+        self.assertIn('did not finish', job['error'])
+        self.assertEqual(self.store.get(self.job_id)['status'], 'failed')
+        self.assertEqual(lambda_function.s3.list_multipart_uploads(Bucket=self.store.bucket).get('Uploads', []), [])
+        # failed cleanly, so the job is not queued again
+        self.assertEqual(self.job_queue.receive(), [])
+
+
+class WorkerDied(BaseException):
+    """Stands in for an invocation killed by its timeout, which no except clause of the worker sees."""
+
+
+def dying_clock():
+    raise WorkerDied()
+
+
+class ExportJobFailureTest(FeedbackTestCase):
+    def setUp(self):
+        super().setUp()
+        self.patch('EXPORT_CHECKPOINT_ROWS', 10)
+        self.add_feedback(25)
+        self.store = lambda_function.S3JobStore(os.environ['FEEDBACK_S3_DOWNLOAD'])
+        self.job_queue = lambda_function.InMemoryJobQueue()
+        response = lambda_function.start_export_job({'body': json.dumps(dict(ALL_TIME, topic='any'))}, self.store, self.job_queue)
+        self.job_id = json.loads(response['body'])['job_id']
+
+    def open_uploads(self):
+        return lambda_function.s3.list_multipart_uploads(Bucket=self.store.bucket).get('Uploads', [])
+
+    def test_upload_id_is_saved_before_the_first_checkpoint(self):
+        with self.assertRaises(WorkerDied):
+            lambda_function.run_export_job(self.job_id, self.store, self.job_queue, dying_clock)
+        job = self.store.get(self.job_id)
+        self.assertEqual(job['status'], 'running')
+        self.assertEqual([upload['UploadId'] for upload in self.open_uploads()], [job['upload_id']])
+
+    def test_redelivered_job_starts_over_in_the_same_upload(self):
+        with self.assertRaises(WorkerDied):
+            lambda_function.run_export_job(self.job_id, self.store, self.job_queue, dying_clock)
+        job = lambda_function.run_export_job(self.job_id, self.store, self.job_queue, lambda: 60000)
+        self.assertEqual(job['status'], 'done')
+        body = lambda_function.s3.get_object(Bucket=self.store.bucket, Key=job['file_name'])['Body'].read().decode('utf-8')
+        rows = list(csv.reader(body.splitlines()))
+        self.assertEqual(rows[0], lambda_function.EXPORT_HEADER)
+        self.assertEqual([row[0] for row in rows[1:]], self.newest_first[::-1])
+        self.assertEqual(self.open_uploads(), [])
+
+    def test_dead_lettered_job_is_failed_and_its_upload_aborted(self):
+        lambda_function.run_export_job(self.job_id, self.store, self.job_queue, lambda: 0)
+        with self.assertRaises(WorkerDied):
+            lambda_function.run_export_job(self.job_id, self.store, self.job_queue, dying_clock)
+        lambda_function.export_dead_letter_handler({'Records': self.job_queue.receive()}, None)
+        job = self.store.get(self.job_id)
+        self.assertEqual(job['status'], 'failed')
+        self.assertEqual(self.open_uploads(), [])
+        status = json.loads(lambda_function.export_status({'queryStringParameters': {'jobId': self.job_id}}, self.store)['body'])
+        self.assertEqual(status['status'], 'failed')
+        # a late redelivery leaves the failed job alone
+        self.assertEqual(lambda_function.run_export_job(self.job_id, self.store, self.job_queue, lambda: 60000)['status'], 'failed')
+
+
+class FeedbackKeyTest(unittest.TestCase):
+    def setUp(self):
+        self.stand_in = KeyedTableStandIn()
+        for name, value in (('table', self.stand_in), ('_last_ulid', 0)):
+            self.addCleanup(setattr, lambda_function, name, getattr(lambda_function, name))
+            setattr(lambda_function, name, value)
+
+    def test_burst_of_concurrent_posts_keeps_every_item(self):
+        with ThreadPoolExecutor(max_workers=64) as executor:
+            feedback_ids = list(executor.map(lambda _: post('Grants'), range(10000)))
+        items = list(self.stand_in.items.values())
+        self.assertEqual(len(items), 10000)
+        self.assertEqual(len(set(feedback_ids)), 10000)
+        by_created_at = [item['FeedbackID'] for item in sorted(items, key=lambda item: item['CreatedAt'])]
+        self.assertEqual(by_created_at, sorted(feedback_ids))
+
+        victim = items[5000]
+        response = lambda_function.delete_feedback({'queryStringParameters': {'topic': victim['Topic'], 'createdAt': victim['CreatedAt']}})
+        self.assertEqual(response['statusCode'], 200)
+        self.assertEqual(len(self.stand_in.items), 9999)
+        self.assertNotIn((victim['Topic'], victim['CreatedAt']), self.stand_in.items)
+
+    def test_ids_increase_within_a_millisecond_and_when_the_clock_steps_back(self):
+        ids = [lambda_function.new_ulid(1700000000.5) for _ in range(1000)]
+        ids += [lambda_function.new_ulid(1700000000.0) for _ in range(10)]
+        self.assertEqual(ids, sorted(set(ids)))
+        self.assertEqual(lambda_function.ulid_time(ids[0]), 1700000000.5)
+        self.assertEqual(lambda_function.ulid_time(ids[-1]), 1700000000.5)
+
+    def test_created_at_is_the_id_time_and_the_id(self):
+        feedback_id = post('Grants')
+        (created_at,) = (item['CreatedAt'] for item in self.stand_in.items.values())
+        ulid_time = lambda_function.ulid_time(feedback_id)
+        self.assertEqual(created_at, f"{time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(ulid_time))}#{feedback_id}")
+
+if __name__ == '__main__':
+    unittest.main()
@@ -8,7 +8,11 @@ import * as iam from 'aws-cdk-lib/aws-iam';
 import { Table } from 'aws-cdk-lib/aws-dynamodb';
 import * as s3 from "aws-cdk-lib/aws-s3";
 import * as bedrock from "aws-cdk-lib/aws-bedrock";
-import { S3EventSource } from 'aws-cdk-lib/aws-lambda-event-sources';
+import { S3EventSource, SqsEventSource } from 'aws-cdk-lib/aws-lambda-event-sources';
+import * as sqs from 'aws-cdk-lib/aws-sqs';
+import * as events from 'aws-cdk-lib/aws-events';
+import * as targets from 'aws-cdk-lib/aws-events-targets';
+import { SESSION_WRITE_BEHIND } from '../../constants';
 
 
 interface LambdaFunctionStackProps {  
@@ -37,9 +41,10 @@ export class LambdaFunctionStack extends cdk.Stack {
   constructor(scope: Construct, id: string, props: LambdaFunctionStackProps) {
     super(scope, id);    
 
+    // The Python handlers link to the shared lambda_logging module, the assets copy the linked file
     const sessionAPIHandlerFunction = new lambda.Function(scope, 'SessionHandlerFunction', {
       runtime: lambda.Runtime.PYTHON_3_12, // Choose any supported Node.js runtime
-      code: lambda.Code.fromAsset(path.join(__dirname, 'session-handler')), // Points to the lambda directory
+      code: lambda.Code.fromAsset(path.join(__dirname, 'session-handler'), { followSymlinks: cdk.SymlinkFollowMode.ALWAYS }), // Points to the lambda directory
       handler: 'lambda_function.lambda_handler', // Points to the 'hello' file in the lambda directory
       environment: {
         "DDB_TABLE_NAME" : props.sessionTable.tableName
@@ -54,6 +59,7 @@ export class LambdaFunctionStack extends cdk.Stack {
         'dynamodb:PutItem',
         'dynamodb:UpdateItem',
         'dynamodb:DeleteItem',
+        'dynamodb:BatchWriteItem',
         'dynamodb:Query',
         'dynamodb:Scan'
       ],
@@ -62,6 +68,65 @@ export class LambdaFunctionStack extends cdk.Stack {
 
     this.sessionFunction = sessionAPIHandlerFunction;
 
+    // Write-behind queue for chat turns, only created when SESSION_WRITE_BEHIND is on. FIFO groups
+    // (one per session) keep each session's turns in order, and the session handler appends all
+    // turns of a session in a batch with one header update
+    let sessionWriteQueue: sqs.Queue | undefined;
+    if (SESSION_WRITE_BEHIND) {
+      const sessionWriteDeadLetterQueue = new sqs.Queue(scope, 'SessionWriteDeadLetterQueue', {
+        fifo: true,
+        retentionPeriod: cdk.Duration.days(14)
+      });
+      sessionWriteQueue = new sqs.Queue(scope, 'SessionWriteQueue', {
+        fifo: true,
+        visibilityTimeout: cdk.Duration.seconds(180), // six times the session handler timeout
+        deadLetterQueue: { queue: sessionWriteDeadLetterQueue, maxReceiveCount: 5 }
+      });
+      sessionAPIHandlerFunction.addEventSource(new SqsEventSource(sessionWriteQueue, {
+        batchSize: 10,
+        reportBatchItemFailures: true
+      }));
+      // lets the enqueue_turn operation queue turns as well
+      sessionWriteQueue.grantSendMessages(sessionAPIHandlerFunction);
+      sessionAPIHandlerFunction.addEnvironment("SESSION_WRITE_QUEUE_URL", sessionWriteQueue.queueUrl);
+    }
+
+    // Generates titles for sessions saved without one, outside of the chat request
+    const sessionTitleWorkerFunction = new lambda.Function(scope, 'SessionTitleWorkerFunction', {
+      runtime: lambda.Runtime.PYTHON_3_12,
+      code: lambda.Code.fromAsset(path.join(__dirname, 'session-title-worker'), { followSymlinks: cdk.SymlinkFollowMode.ALWAYS }),
+      handler: 'lambda_function.lambda_handler',
+      environment: {
+        "DDB_TABLE_NAME" : props.sessionTable.tableName,
+        "UNTITLED_INDEX_NAME" : "UntitledIndex"
+      },
+      timeout: cdk.Duration.seconds(60)
+    });
+
+    sessionTitleWorkerFunction.addToRolePolicy(new iam.PolicyStatement({
+      effect: iam.Effect.ALLOW,
+      actions: [
+        'dynamodb:GetItem',
+        'dynamodb:UpdateItem',
+        'dynamodb:Query'
+      ],
+      resources: [props.sessionTable.tableArn, props.sessionTable.tableArn + "/index/*"]
+    }));
+
+    sessionTitleWorkerFunction.addToRolePolicy(new iam.PolicyStatement({
+      effect: iam.Effect.ALLOW,
+      actions: [
+        'bedrock:InvokeModel'
+      ],
+      resources: ["*"]
+    }));
+
+    // Run the title worker every minute, untitled sessions keep the placeholder title until then
+    new events.Rule(scope, 'SessionTitleWorkerSchedule', {
+      schedule: events.Schedule.rate(cdk.Duration.minutes(1)),
+      targets: [new targets.LambdaFunction(sessionTitleWorkerFunction)]
+    });
+
         // Define the Lambda function resource
         const websocketAPIFunction = new lambda.Function(scope, 'ChatHandlerFunction', {
           runtime: lambda.Runtime.NODEJS_20_X, // Choose any supported Node.js runtime
@@ -117,6 +182,10 @@ export class LambdaFunctionStack extends cdk.Stack {
           },
           timeout: cdk.Duration.seconds(300)
         });
+        if (sessionWriteQueue) {
+          websocketAPIFunction.addEnvironment("SESSION_WRITE_QUEUE_URL", sessionWriteQueue.queueUrl);
+          sessionWriteQueue.grantSendMessages(websocketAPIFunction);
+        }
         websocketAPIFunction.addToRolePolicy(new iam.PolicyStatement({
           effect: iam.Effect.ALLOW,
           actions: [
@@ -146,7 +215,7 @@ export class LambdaFunctionStack extends cdk.Stack {
 
     const feedbackAPIHandlerFunction = new lambda.Function(scope, 'FeedbackHandlerFunction', {
       runtime: lambda.Runtime.PYTHON_3_12, // Choose any supported Node.js runtime
-      code: lambda.Code.fromAsset(path.join(__dirname, 'feedback-handler')), // Points to the lambda directory
+      code: lambda.Code.fromAsset(path.join(__dirname, 'feedback-handler'), { followSymlinks: cdk.SymlinkFollowMode.ALWAYS }), // Points to the lambda directory
       handler: 'lambda_function.lambda_handler', // Points to the 'hello' file in the lambda directory
       environment: {
         "FEEDBACK_TABLE" : props.feedbackTable.tableName,
@@ -177,6 +246,77 @@ export class LambdaFunctionStack extends cdk.Stack {
     }));
 
     this.feedbackFunction = feedbackAPIHandlerFunction;
+
+    // Feedback downloads run as export jobs: the API queues a job and returns its id, and this
+    // worker writes the CSV, checkpointing and re-queueing the job before it runs out of time.
+    // A job message whose worker keeps crashing is moved to the dead-letter queue, whose function marks the job failed
+    const feedbackExportDeadLetterQueue = new sqs.Queue(scope, 'FeedbackExportDeadLetterQueue', {
+      retentionPeriod: cdk.Duration.days(14)
+    });
+    const feedbackExportQueue = new sqs.Queue(scope, 'FeedbackExportQueue', {
+      visibilityTimeout: cdk.Duration.minutes(30), // twice the worker timeout
+      deadLetterQueue: { queue: feedbackExportDeadLetterQueue, maxReceiveCount: 3 }
+    });
+
+    const feedbackExportWorkerFunction = new lambda.Function(scope, 'FeedbackExportWorkerFunction', {
+      runtime: lambda.Runtime.PYTHON_3_12,
+      code: lambda.Code.fromAsset(path.join(__dirname, 'feedback-handler'), { followSymlinks: cdk.SymlinkFollowMode.ALWAYS }),
+      handler: 'lambda_function.export_worker_handler',
+      environment: {
+        "FEEDBACK_TABLE" : props.feedbackTable.tableName,
+        "FEEDBACK_S3_DOWNLOAD" : props.feedbackBucket.bucketName,
+        "FEEDBACK_EXPORT_QUEUE_URL" : feedbackExportQueue.queueUrl
+      },
+      // Query exports checkpoint before the timeout. Whole-table scan exports must finish in one invocation,
+      // otherwise they fail and abort their upload before the timeout.
+      // Scan exports are written as CSV: Parquet (EXPORT_PARQUET=1) needs pyarrow, which this asset does not ship
+      timeout: cdk.Duration.minutes(15),
+      memorySize: 1024
+    });
+
+    feedbackExportWorkerFunction.addToRolePolicy(new iam.PolicyStatement({
+      effect: iam.Effect.ALLOW,
+      actions: [
+        'dynamodb:Query',
+        'dynamodb:Scan'
+      ],
+      resources: [props.feedbackTable.tableArn, props.feedbackTable.tableArn + "/index/*"]
+    }));
+
+    feedbackExportWorkerFunction.addToRolePolicy(new iam.PolicyStatement({
+      effect: iam.Effect.ALLOW,
+      actions: [
+        's3:*'
+      ],
+      resources: [props.feedbackBucket.bucketArn,props.feedbackBucket.bucketArn+"/*"]
+    }));
+
+    feedbackExportWorkerFunction.addEventSource(new SqsEventSource(feedbackExportQueue, { batchSize: 1 }));
+    feedbackExportQueue.grantSendMessages(feedbackExportWorkerFunction);
+    feedbackExportQueue.grantSendMessages(feedbackAPIHandlerFunction);
+    feedbackAPIHandlerFunction.addEnvironment("FEEDBACK_EXPORT_QUEUE_URL", feedbackExportQueue.queueUrl);
+
+    // Marks the jobs of dead-lettered messages failed and aborts their uploads, so they do not stay running
+    const feedbackExportDeadLetterFunction = new lambda.Function(scope, 'FeedbackExportDeadLetterFunction', {
+      runtime: lambda.Runtime.PYTHON_3_12,
+      code: lambda.Code.fromAsset(path.join(__dirname, 'feedback-handler'), { followSymlinks: cdk.SymlinkFollowMode.ALWAYS }),
+      handler: 'lambda_function.export_dead_letter_handler',
+      environment: {
+        "FEEDBACK_TABLE" : props.feedbackTable.tableName,
+        "FEEDBACK_S3_DOWNLOAD" : props.feedbackBucket.bucketName
+      },
+      timeout: cdk.Duration.seconds(30)
+    });
+
+    feedbackExportDeadLetterFunction.addToRolePolicy(new iam.PolicyStatement({
+      effect: iam.Effect.ALLOW,
+      actions: [
+        's3:*'
+      ],
+      resources: [props.feedbackBucket.bucketArn,props.feedbackBucket.bucketArn+"/*"]
+    }));
+
+    feedbackExportDeadLetterFunction.addEventSource(new SqsEventSource(feedbackExportDeadLetterQueue, { batchSize: 1 }));
     
     const deleteS3APIHandlerFunction = new lambda.Function(scope, 'DeleteS3FilesHandlerFunction', {
       runtime: lambda.Runtime.PYTHON_3_12, // Choose any supported Node.js runtime
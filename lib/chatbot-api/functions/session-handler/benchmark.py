@@ -0,0 +1,357 @@
+"""
+Drive every session-handler operation against a local DynamoDB stand-in and print how long each
+operation takes.
+
+Usage:
+    python benchmark.py [--sessions 20] [--turns 10] [--rounds 50]
+    python benchmark.py --endpoint-url http://localhost:8000
+    python benchmark.py --purge [--sessions 2000] [--workers 4]
+    python benchmark.py --serialize [--turns 200] [--rounds 50]
+    python benchmark.py --compress [--sessions 20] [--turns 10]
+
+Without --endpoint-url the table lives in moto's in-process DynamoDB mock (pip install moto).
+With it, the table is created in DynamoDB Local or another DynamoDB-compatible endpoint and
+dropped again at the end. Latencies include JSON parsing, validation and response encoding,
+like a warm Lambda invocation would.
+
+--purge fills one user's partition with sessions of a header and one turn each, then removes
+them three ways, refilling in between: one delete_item per item, the way delete_user_sessions
+used to, then delete_user_sessions on a single thread and with --workers threads. moto runs in
+process, so the thread pool only pays off against a real endpoint.
+
+--serialize needs no table. It converts a session header holding a chat_history of --turns
+turns to DynamoDB's wire format and back, then encodes it as the get_session response body,
+first with boto3's TypeSerializer and TypeDeserializer (what the Table resource does on every
+call) and json.dumps, then with the handler's fast paths and shared encoder. Times are the
+fastest of --rounds conversions.
+
+--compress saves synthetic sessions through lambda_handler, checks that get_session and
+get_session_tail return every chat entry unchanged, and compares the stored size of the turn
+and source items with the same turns stored as plain chat entries. Sizes follow DynamoDB's item
+size rules, and write units count one per started KB of every item written.
+"""
+import argparse
+import contextlib
+import json
+import math
+import os
+import random
+import time
+import uuid
+
+TABLE_NAME = os.environ.setdefault('DDB_TABLE_NAME', 'SessionHandlerBenchmark')
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+
+def percentile(values, pct):
+    # nearest-rank percentile, good enough for latency summaries
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def create_table(client):
+    string_attributes = ('user_id', 'session_id', 'time_stamp', 'title_pending')
+    client.create_table(
+        TableName=TABLE_NAME,
+        KeySchema=[{'AttributeName': 'user_id', 'KeyType': 'HASH'}, {'AttributeName': 'session_id', 'KeyType': 'RANGE'}],
+        AttributeDefinitions=[{'AttributeName': name, 'AttributeType': 'S'} for name in string_attributes],
+        GlobalSecondaryIndexes=[
+            {
+                'IndexName': 'TimeIndex',
+                'KeySchema': [{'AttributeName': 'user_id', 'KeyType': 'HASH'}, {'AttributeName': 'time_stamp', 'KeyType': 'RANGE'}],
+                'Projection': {'ProjectionType': 'ALL'},
+            },
+            {
+                'IndexName': 'UntitledIndex',
+                'KeySchema': [{'AttributeName': 'title_pending', 'KeyType': 'HASH'}, {'AttributeName': 'time_stamp', 'KeyType': 'RANGE'}],
+                'Projection': {'ProjectionType': 'KEYS_ONLY'},
+            },
+        ],
+        BillingMode='PAY_PER_REQUEST',
+    )
+    client.get_waiter('table_exists').wait(TableName=TABLE_NAME)
+
+
+def chat_entry(turn):
+    answer = '\n'.join(f'{turn}. **Program {i}** - eligibility, deadlines and how to apply.' for i in range(40))
+    links = [{'title': f'page-{i}.txt (Bedrock Knowledge Base)', 'uri': f's3://knowledge-bucket/websites/page-{i}.txt'}
+             for i in random.sample(range(20), 4)]
+    return {'user': f'question {turn}', 'chatbot': answer, 'metadata': json.dumps(links, separators=(',', ':'))}
+
+
+def run(lambda_function, sessions, turns, rounds):
+    """
+    Fill the table, then call every operation through lambda_handler.
+
+    Returns:
+        dict: {operation: [milliseconds, ...]}
+    """
+    timings = {}
+
+    def call(operation, **fields):
+        event = {'body': json.dumps(dict(fields, operation=operation))}
+        start = time.perf_counter()
+        response = lambda_function.lambda_handler(event, None)
+        timings.setdefault(operation, []).append((time.perf_counter() - start) * 1000)
+        if response['statusCode'] >= 400:
+            raise RuntimeError(f'{operation} failed: {response["body"]}')
+
+    user_id = 'benchmark-user'
+    session_ids = [str(uuid.uuid4()) for _ in range(sessions)]
+    for session_id in session_ids:
+        call('add_session', user_id=user_id, session_id=session_id, new_chat_entry=chat_entry(0))
+        for turn in range(1, turns):
+            call('update_session', user_id=user_id, session_id=session_id, new_chat_entry=chat_entry(turn))
+
+    for _ in range(rounds):
+        session_id = random.choice(session_ids)
+        call('session_exists', user_id=user_id, session_id=session_id)
+        call('get_session', user_id=user_id, session_id=session_id)
+        call('get_session_tail', user_id=user_id, session_id=session_id)
+        call('list_sessions_by_user_id', user_id=user_id)
+        call('list_all_sessions_by_user_id', user_id=user_id)
+        call('enqueue_turn', user_id=user_id, session_id=session_id, new_chat_entry=chat_entry(turns))
+
+    for session_id in session_ids[:len(session_ids) // 2]:
+        call('delete_session', user_id=user_id, session_id=session_id)
+    call('delete_user_sessions', user_id=user_id)
+    return timings
+
+
+def fill_sessions(lambda_function, user_id, sessions):
+    packed, _ = lambda_function.pack_chat_entry({'user': 'question', 'chatbot': 'answer', 'metadata': '[]'})
+    write_requests = []
+    for i in range(sessions):
+        session_id = f'purge-{i:05d}'
+        write_requests.append({'PutRequest': {'Item': lambda_function.new_session_header(session_id, user_id, f'title {i}', 1)}})
+        write_requests.extend(lambda_function.turn_write_requests(session_id, user_id, 0, [packed]))
+    lambda_function.batch_write_all(write_requests)
+    return len(write_requests)
+
+
+def partition_keys(client, user_id):
+    paginator = client.get_paginator('query')
+    pages = paginator.paginate(TableName=TABLE_NAME, KeyConditionExpression='user_id = :user_id',
+                               ExpressionAttributeValues={':user_id': {'S': user_id}}, ProjectionExpression='user_id, session_id')
+    return [item for page in pages for item in page['Items']]
+
+
+def purge(lambda_function, client, sessions, workers):
+    """
+    Time purging sessions per item and with delete_user_sessions.
+
+    Returns:
+        list: (method, items deleted, seconds) per method.
+    """
+    user_id = 'purge-user'
+
+    def delete_one_by_one():
+        for key in partition_keys(client, user_id):
+            client.delete_item(TableName=TABLE_NAME, Key=key)
+
+    def delete_batched(max_workers):
+        def delete():
+            response = lambda_function.delete_user_sessions(user_id, max_workers=max_workers)
+            results = json.loads(response['body'])
+            if response['statusCode'] != 200 or not all(result['deleted'] for result in results):
+                raise RuntimeError(f'delete_user_sessions failed: {response["body"]}')
+        return delete
+
+    methods = [('delete_item per item', delete_one_by_one),
+               ('batched, 1 thread', delete_batched(1)),
+               (f'batched, {workers} threads', delete_batched(workers))]
+    results = []
+    for name, delete in methods:
+        items = fill_sessions(lambda_function, user_id, sessions)
+        start = time.perf_counter()
+        delete()
+        elapsed = time.perf_counter() - start
+        if partition_keys(client, user_id):
+            raise RuntimeError(f'{name} left items behind')
+        results.append((name, items, elapsed))
+    return results
+
+
+def serialize(lambda_function, turns, rounds):
+    """
+    Time converting one large session item with boto3's converters and with the fast paths.
+
+    Returns:
+        list: (method, seconds to serialize, to deserialize, to encode as JSON) per method.
+    """
+    from boto3.dynamodb.types import TypeDeserializer, TypeSerializer
+
+    item = lambda_function.new_session_header('serialize-session', 'serialize-user', 'title', turns)
+    item['chat_history'] = [chat_entry(turn) for turn in range(turns)]
+    serializer, deserializer = TypeSerializer(), TypeDeserializer()
+
+    def boto3_serialize(value):
+        return {k: serializer.serialize(v) for k, v in value.items()}
+
+    def boto3_deserialize(value):
+        return {k: deserializer.deserialize(v) for k, v in value.items()}
+
+    def boto3_encode(value):
+        return json.dumps(value, cls=lambda_function.DecimalEncoder)
+
+    methods = [('boto3 TypeSerializer', boto3_serialize, boto3_deserialize, boto3_encode),
+               ('fast path', lambda_function.serialize_item, lambda_function.deserialize_item, lambda_function.to_json)]
+    results = []
+    for name, to_wire, from_wire, encode in methods:
+        best = [float('inf')] * 3
+        for _ in range(rounds):
+            start = time.perf_counter()
+            wire = to_wire(item)
+            serialized = time.perf_counter()
+            value = from_wire(wire)
+            deserialized = time.perf_counter()
+            body = encode(value)
+            encoded = time.perf_counter()
+            best = [min(best[0], serialized - start), min(best[1], deserialized - serialized), min(best[2], encoded - deserialized)]
+        if json.loads(body) != json.loads(lambda_function.to_json(item)):
+            raise RuntimeError(f'{name} did not round-trip the item')
+        results.append((name, *best))
+    return results
+
+
+def attribute_size(value):
+    """Approximate stored size in bytes of an attribute value, by DynamoDB's item size rules."""
+    if isinstance(value, str):
+        return len(value.encode('utf-8'))
+    if isinstance(value, (bytes, bytearray)):
+        return len(value)
+    if isinstance(value, bool) or value is None:
+        return 1
+    if isinstance(value, (int, float)) or hasattr(value, 'as_tuple'):
+        return len(str(value).lstrip('-').replace('.', '')) // 2 + 2
+    if isinstance(value, (set, frozenset)):
+        return sum(attribute_size(v) for v in value)
+    if isinstance(value, dict):
+        return 3 + sum(1 + len(k.encode('utf-8')) + attribute_size(v) for k, v in value.items())
+    return 3 + sum(1 + attribute_size(v) for v in value)
+
+
+def item_size(item):
+    return sum(len(name.encode('utf-8')) + attribute_size(value) for name, value in item.items())
+
+
+def compress(lambda_function, sessions, turns):
+    """
+    Save sessions, check that they read back unchanged and measure their stored size.
+
+    Returns:
+        dict: Item counts, bytes and write units of the plain and the stored layout, and pack/unpack time per turn.
+    """
+    user_id = 'compress-user'
+    table = lambda_function.table
+    totals = {'plain_items': 0, 'plain_bytes': 0, 'plain_units': 0, 'stored_items': 0, 'stored_bytes': 0, 'stored_units': 0}
+    pack_seconds = unpack_seconds = 0.0
+    for i in range(sessions):
+        session_id = f'compress-{i:04d}'
+        entries = [chat_entry(turn) for turn in range(turns)]
+        for turn, entry in enumerate(entries):
+            operation = 'add_session' if turn == 0 else 'update_session'
+            response = lambda_function.lambda_handler({'body': json.dumps({'operation': operation, 'user_id': user_id, 'session_id': session_id, 'new_chat_entry': entry})}, None)
+            if response['statusCode'] != 200:
+                raise RuntimeError(f'{operation} failed: {response["body"]}')
+
+        for operation, expected in (('get_session', entries), ('get_session_tail', entries[-lambda_function.DEFAULT_TAIL_TURNS:])):
+            response = lambda_function.lambda_handler({'body': json.dumps({'operation': operation, 'user_id': user_id, 'session_id': session_id})}, None)
+            if json.loads(response['body'])['chat_history'] != expected:
+                raise RuntimeError(f'{operation} did not round-trip session {session_id}')
+
+        for turn, entry in enumerate(entries):
+            size = item_size({'user_id': user_id, 'session_id': lambda_function.turn_key(session_id, turn), 'chat_entry': entry})
+            totals['plain_items'] += 1
+            totals['plain_bytes'] += size
+            totals['plain_units'] += math.ceil(size / 1024)
+        stored = table.query(KeyConditionExpression='user_id = :user_id AND begins_with(session_id, :prefix)',
+                             ExpressionAttributeValues={':user_id': user_id, ':prefix': session_id + '#'})['Items']
+        for item in stored:
+            size = item_size(item)
+            totals['stored_items'] += 1
+            totals['stored_bytes'] += size
+            totals['stored_units'] += math.ceil(size / 1024)
+
+        start = time.perf_counter()
+        packed, sources = lambda_function.pack_turns(entries)
+        pack_seconds += time.perf_counter() - start
+        start = time.perf_counter()
+        for entry in packed:
+            lambda_function.unpack_chat_entry(entry, sources)
+        unpack_seconds += time.perf_counter() - start
+    totals['pack_us'] = pack_seconds / (sessions * turns) * 1e6
+    totals['unpack_us'] = unpack_seconds / (sessions * turns) * 1e6
+    return totals
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--endpoint-url', help='DynamoDB-compatible endpoint to use instead of the moto mock')
+    parser.add_argument('--purge', action='store_true', help='time purging a user\'s sessions per item and batched')
+    parser.add_argument('--sessions', type=int, help='sessions created before the read rounds, 20, or 2000 for --purge')
+    parser.add_argument('--serialize', action='store_true', help='time item conversion with boto3\'s converters and the fast paths')
+    parser.add_argument('--compress', action='store_true', help='check compressed sessions round-trip and measure their stored size')
+    parser.add_argument('--turns', type=int, help='turns per session, 10, or 200 for --serialize')
+    parser.add_argument('--rounds', type=int, default=50, help='rounds of read and append operations')
+    parser.add_argument('--workers', type=int, default=4, help='threads of the parallel --purge')
+    args = parser.parse_args()
+
+    if args.serialize:
+        import lambda_function
+        results = serialize(lambda_function, args.turns or 200, args.rounds)
+        print(f'{args.turns or 200} turns, fastest of {args.rounds} rounds')
+        print(f'{"method":<22} {"serialize ms":>13} {"deserialize ms":>15} {"json ms":>8} {"total ms":>9}')
+        for name, *times in results:
+            print(f'{name:<22} {times[0] * 1000:>13.2f} {times[1] * 1000:>15.2f} {times[2] * 1000:>8.2f} {sum(times) * 1000:>9.2f}')
+        return
+
+    if args.endpoint_url:
+        context = contextlib.nullcontext()
+    else:
+        from moto import mock_aws
+        os.environ.setdefault('AWS_ACCESS_KEY_ID', 'benchmark')
+        os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'benchmark')
+        context = mock_aws()
+
+    with context:
+        import boto3
+        import lambda_function
+
+        client = boto3.client('dynamodb', region_name='us-east-1', endpoint_url=args.endpoint_url)
+        lambda_function.table = lambda_function.SessionTable(client, lambda_function.DDB_TABLE_NAME)
+        create_table(client)
+        try:
+            if args.purge:
+                results = purge(lambda_function, client, args.sessions or 2000, args.workers)
+            elif args.compress:
+                totals = compress(lambda_function, args.sessions or 20, args.turns or 10)
+            else:
+                timings = run(lambda_function, args.sessions or 20, args.turns or 10, args.rounds)
+        finally:
+            if args.endpoint_url:
+                client.delete_table(TableName=TABLE_NAME)
+
+    if args.compress:
+        print(f'{args.sessions or 20} sessions of {args.turns or 10} turns, all read back unchanged')
+        print(f'{"layout":<16} {"items":>6} {"KB":>8} {"write units":>12}')
+        for layout in ('plain', 'stored'):
+            print(f'{layout:<16} {totals[layout + "_items"]:>6} {totals[layout + "_bytes"] / 1024:>8.1f} {totals[layout + "_units"]:>12}')
+        print(f'size reduction: {1 - totals["stored_bytes"] / totals["plain_bytes"]:.0%}')
+        print(f'pack {totals["pack_us"]:.1f} us/turn, unpack {totals["unpack_us"]:.1f} us/turn')
+        return
+
+    if args.purge:
+        print(f'{"method":<24} {"items":>7} {"seconds":>8} {"items/s":>8}')
+        for name, items, elapsed in results:
+            print(f'{name:<24} {items:>7} {elapsed:>8.2f} {items / elapsed:>8.0f}')
+        return
+
+    print(f'{"operation":<30} {"calls":>6} {"p50 ms":>8} {"p95 ms":>8} {"max ms":>8}')
+    for operation, values in timings.items():
+        print(f'{operation:<30} {len(values):>6} {percentile(values, 50):>8.2f} {percentile(values, 95):>8.2f} {max(values):>8.2f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,257 +1,868 @@
 import os
+import base64
 import boto3
+from boto3.dynamodb.types import TypeDeserializer, TypeSerializer
 from botocore.exceptions import ClientError 
+import hashlib
 import json
+import random
+import time
+import uuid
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from decimal import Decimal
+from lambda_logging import get_logger, sample_log_level
 
 
 
 # Retrieve DynamoDB table and secondary index names from environment variables
 DDB_TABLE_NAME = os.environ["DDB_TABLE_NAME"]
 # DDB_SECONDARY_INDEX_NAME = os.environ["DDB_SECONDARY_INDEX_NAME"]
+# FIFO queue for write-behind turn saves. Without it, enqueue_turn appends the turn right away
+SESSION_WRITE_QUEUE_URL = os.environ.get("SESSION_WRITE_QUEUE_URL")
+
+# Levels and per-invocation DEBUG sampling come from LOG_LEVEL and LOG_DEBUG_SAMPLE_RATE, see lambda_logging
+logger = get_logger(__name__)
+
+
+# Initialize a low-level DynamoDB client using boto3 with a specific AWS region. The client is
+# created once per container and, unlike boto3's Table resource, is safe to share between threads
+dynamodb_client = boto3.client("dynamodb", region_name='us-east-1')
+
+# boto3's own converters, only used for the value types the fast paths below do not handle
+_type_serializer = TypeSerializer()
+_type_deserializer = TypeDeserializer()
+
+
+def serialize_value(value):
+    """Convert a Python value to a DynamoDB attribute value, with a fast path for the JSON-like types sessions use."""
+    if isinstance(value, str):
+        return {'S': value}
+    if isinstance(value, bytes):
+        return {'B': value}
+    if isinstance(value, dict):
+        return {'M': {k: serialize_value(v) for k, v in value.items()}}
+    if isinstance(value, list):
+        return {'L': [serialize_value(v) for v in value]}
+    if isinstance(value, bool):
+        return {'BOOL': value}
+    if isinstance(value, int):
+        return {'N': str(value)}
+    if value is None:
+        return {'NULL': True}
+    return _type_serializer.serialize(value)
+
+
+def deserialize_value(attribute):
+    """Convert a DynamoDB attribute value back to Python. Whole numbers come back as int instead of Decimal."""
+    (attribute_type, value), = attribute.items()
+    if attribute_type == 'S':
+        return value
+    if attribute_type == 'M':
+        return {k: deserialize_value(v) for k, v in value.items()}
+    if attribute_type == 'L':
+        return [deserialize_value(v) for v in value]
+    if attribute_type == 'N':
+        return int(value) if value.lstrip('-').isdigit() else Decimal(value)
+    if attribute_type in ('BOOL', 'B'):
+        return value
+    if attribute_type == 'NULL':
+        return None
+    return _type_deserializer.deserialize(attribute)
+
+
+def serialize_item(item):
+    return {k: serialize_value(v) for k, v in item.items()}
+
+
+def deserialize_item(item):
+    return {k: deserialize_value(v) for k, v in item.items()}
+
+
+class SessionTable:
+    """
+    Thin wrapper over the low-level client that takes and returns plain Python values, like
+    boto3's Table resource, but converts them with the fast paths above.
+    """
+
+    def __init__(self, client, table_name):
+        self.client = client
+        self.table_name = table_name
+
+    def _request(self, kwargs):
+        request = dict(kwargs, TableName=self.table_name)
+        for name in ('Key', 'Item', 'ExclusiveStartKey', 'ExpressionAttributeValues'):
+            if name in request:
+                request[name] = serialize_item(request[name])
+        return request
+
+    def get_item(self, **kwargs):
+        response = self.client.get_item(**self._request(kwargs))
+        if 'Item' in response:
+            response['Item'] = deserialize_item(response['Item'])
+        return response
+
+    def put_item(self, **kwargs):
+        return self.client.put_item(**self._request(kwargs))
+
+    def update_item(self, **kwargs):
+        response = self.client.update_item(**self._request(kwargs))
+        if 'Attributes' in response:
+            response['Attributes'] = deserialize_item(response['Attributes'])
+        return response
+
+    def query(self, **kwargs):
+        response = self.client.query(**self._request(kwargs))
+        response['Items'] = [deserialize_item(item) for item in response.get('Items', [])]
+        if 'LastEvaluatedKey' in response:
+            response['LastEvaluatedKey'] = deserialize_item(response['LastEvaluatedKey'])
+        return response
+
+    def batch_write(self, write_requests):
+        """
+        Run up to 25 put/delete requests with BatchWriteItem, retrying unprocessed ones with exponential backoff.
+
+        Args:
+            write_requests (list): {"PutRequest": {"Item": {...}}} or {"DeleteRequest": {"Key": {...}}} dicts.
+
+        Returns:
+            list: The requests that could still not be written after the last retry.
+        """
+        pending = [
+            {operation: {name: serialize_item(value) for name, value in request.items()}}
+            for write_request in write_requests for operation, request in write_request.items()
+        ]
+        for attempt in range(BATCH_WRITE_RETRIES + 1):
+            if attempt:
+                time.sleep(min(0.05 * 2 ** attempt, 2) * random.uniform(0.5, 1))
+            try:
+                response = self.client.batch_write_item(RequestItems={self.table_name: pending})
+            except ClientError as error:
+                if error.response['Error']['Code'] not in ("ProvisionedThroughputExceededException", "ThrottlingException"):
+                    raise
+                continue
+            pending = response.get('UnprocessedItems', {}).get(self.table_name, [])
+            if not pending:
+                return []
+        return [
+            {operation: {name: deserialize_item(value) for name, value in request.items()}}
+            for write_request in pending for operation, request in write_request.items()
+        ]
+
 
-# Initialize a DynamoDB resource using boto3 with a specific AWS region
-dynamodb = boto3.resource("dynamodb", region_name='us-east-1')
 # Connect to the specified DynamoDB table
-table = dynamodb.Table(DDB_TABLE_NAME)
+table = SessionTable(dynamodb_client, DDB_TABLE_NAME)
+
+# Sessions are stored as a header item plus one item per chat turn, all under the user's partition:
+#   header: session_id = "<session_id>"                  title, time_stamp, turn_count
+#   turn:   session_id = "<session_id>#turn#<000042>"    chat_entry
+#   source: session_id = "<session_id>#src#<source id>"  source
+# Turn items have no time_stamp, so they never show up in the TimeIndex used to list sessions.
+# Sessions written before this layout keep their turns in the header's chat_history list;
+# those are read back as the oldest turns of the session.
+TURN_KEY_SEPARATOR = "#turn#"
+# The source links in a turn's metadata repeat from turn to turn, so each distinct link is stored
+# once per session as a source item and turns only keep source_refs. The header's source_ids set
+# records which source items already exist, and an id is only added once its item is written.
+SOURCE_KEY_SEPARATOR = "#src#"
+# Text fields of a chat entry at least this many bytes long are stored zlib-compressed as Binary
+COMPRESS_MIN_BYTES = int(os.environ.get("COMPRESS_MIN_BYTES", 1024))
+COMPRESSED_FIELDS = ("user", "chatbot", "metadata")
+# Header attributes returned when the full chat history is not needed
+HEADER_PROJECTION = "user_id, session_id, title, time_stamp"
+# Header attributes used by the writers and the title worker, never returned to clients
+HEADER_BOOKKEEPING = ("turn_count", "title_pending", "title_attempts", "source_ids", "queued_messages", "queued_first_turn")
+# Sessions added without a title are saved with this placeholder and a title_pending marker.
+# The marker puts the header in the sparse UntitledIndex, where the session-title-worker picks
+# it up, writes a generated title and removes the marker.
+PLACEHOLDER_TITLE = "New chat"
+TITLE_PENDING = "1"
+# Attempts to write unprocessed items of a BatchWriteItem call
+BATCH_WRITE_RETRIES = 5
+# Largest page of sessions returned by one list call
+MAX_PAGE_SIZE = 100
+# Number of turns returned by get_session_tail when the caller does not ask for a number
+DEFAULT_TAIL_TURNS = 2
+
+
+class DecimalEncoder(json.JSONEncoder):
+    # DynamoDB numbers that are not whole come back as Decimal, which json cannot serialize
+    def default(self, obj):
+        if isinstance(obj, Decimal):
+            return int(obj) if obj == obj.to_integral_value() else float(obj)
+        return json.JSONEncoder.default(self, obj)
+
+
+# One encoder shared by every operation instead of json.dumps building a new one per call
+to_json = DecimalEncoder().encode
+
+
+def respond(status_code, body):
+    # Every operation answers in this shape, with the body always encoded as a JSON string
+    return {
+        'statusCode': status_code,
+        'headers': {'Access-Control-Allow-Origin': '*'},
+        'body': to_json(body)
+    }
+
+
+def turn_key(session_id, turn):
+    return f"{session_id}{TURN_KEY_SEPARATOR}{turn:06d}"
+
+
+def source_key(session_id, source_id):
+    return f"{session_id}{SOURCE_KEY_SEPARATOR}{source_id}"
+
+
+def header_session_id(key):
+    # The session a header, turn or source item belongs to
+    return key.split(TURN_KEY_SEPARATOR, 1)[0].split(SOURCE_KEY_SEPARATOR, 1)[0]
+
+
+def compress_text(text):
+    raw = text.encode('utf-8')
+    if len(raw) < COMPRESS_MIN_BYTES:
+        return text
+    compressed = zlib.compress(raw)
+    return compressed if len(compressed) < len(raw) else text
+
+
+def decompress_text(value):
+    return zlib.decompress(value).decode('utf-8') if isinstance(value, bytes) else value
+
+
+def intern_sources(metadata):
+    """
+    Split a metadata JSON list of source links into source ids and the links they stand for.
+
+    Returns:
+        tuple: (source ids in order, {source id: link}), or None if metadata is not a list of links.
+    """
+    try:
+        links = json.loads(metadata)
+    except (TypeError, ValueError):
+        return None
+    if not isinstance(links, list) or not all(isinstance(link, dict) and isinstance(link.get('uri'), str) for link in links):
+        return None
+    source_ids = []
+    sources = {}
+    for link in links:
+        source_id = hashlib.sha1(json.dumps(link, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+        source_ids.append(source_id)
+        sources[source_id] = link
+    return source_ids, sources
+
+
+def pack_chat_entry(chat_entry):
+    """
+    Convert a chat entry to its stored form: source links interned and long text fields compressed.
+
+    Returns:
+        tuple: (stored chat entry, {source id: link} for the links it refers to).
+    """
+    packed = dict(chat_entry)
+    sources = {}
+    interned = intern_sources(packed['metadata']) if 'metadata' in packed else None
+    if interned:
+        packed['source_refs'], sources = interned
+        del packed['metadata']
+    for field in COMPRESSED_FIELDS:
+        if isinstance(packed.get(field), str):
+            packed[field] = compress_text(packed[field])
+    return packed, sources
+
+
+def unpack_chat_entry(packed, sources):
+    chat_entry = {k: decompress_text(v) for k, v in packed.items() if k != 'source_refs'}
+    if 'source_refs' in packed:
+        # JSON.stringify formatting, as the chat handler wrote it
+        links = [sources[source_id] for source_id in packed['source_refs'] if source_id in sources]
+        chat_entry['metadata'] = json.dumps(links, separators=(',', ':'), ensure_ascii=False)
+    return chat_entry
+
+
+def pack_turns(chat_entries):
+    packed_entries = []
+    sources = {}
+    for chat_entry in chat_entries:
+        packed, entry_sources = pack_chat_entry(chat_entry)
+        packed_entries.append(packed)
+        sources.update(entry_sources)
+    return packed_entries, sources
+
+
+def query_sources(session_id, user_id):
+    query_kwargs = {
+        'KeyConditionExpression': "user_id = :user_id AND begins_with(session_id, :prefix)",
+        'ExpressionAttributeValues': {":user_id": user_id, ":prefix": session_id + SOURCE_KEY_SEPARATOR},
+    }
+    sources = {}
+    while True:
+        response = table.query(**query_kwargs)
+        for item in response['Items']:
+            sources[item['session_id'][len(session_id + SOURCE_KEY_SEPARATOR):]] = item['source']
+        if 'LastEvaluatedKey' not in response:
+            return sources
+        query_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+def query_turns(session_id, user_id, last_n=None):
+    """
+    Read the turn items of a session in chronological order.
+
+    Args:
+        session_id (str): The session to read.
+        user_id (str): The owner of the session.
+        last_n (int): Only read the newest last_n turns. Reads every turn if not set.
+
+    Returns:
+        list: The chat entries, oldest first.
+    """
+    query_kwargs = {
+        'KeyConditionExpression': "user_id = :user_id AND begins_with(session_id, :prefix)",
+        'ExpressionAttributeValues': {":user_id": user_id, ":prefix": session_id + TURN_KEY_SEPARATOR},
+        'ProjectionExpression': 'chat_entry',
+    }
+    if last_n:
+        # newest first so the query can stop after last_n items
+        query_kwargs['ScanIndexForward'] = False
+        query_kwargs['Limit'] = last_n
+
+    entries = []
+    while True:
+        response = table.query(**query_kwargs)
+        entries.extend(item['chat_entry'] for item in response.get('Items', []))
+        last_evaluated_key = response.get('LastEvaluatedKey')
+        if not last_evaluated_key or (last_n and len(entries) >= last_n):
+            break
+        query_kwargs['ExclusiveStartKey'] = last_evaluated_key
+
+    if last_n:
+        entries = entries[:last_n]
+        entries.reverse()
+    sources = query_sources(session_id, user_id) if any('source_refs' in entry for entry in entries) else {}
+    return [unpack_chat_entry(entry, sources) for entry in entries]
+
+def new_session_header(session_id, user_id, title, turn_count, source_ids=None):
+    header = {
+        'user_id': user_id,  # Identifier for the user
+        'session_id': session_id,  # Unique identifier for the session
+        "title": (title or "").strip(),  # Title of the session
+        "time_stamp": str(datetime.now()),  # Current timestamp as a string
+        "turn_count": turn_count  # Number of turn items stored for the session
+    }
+    if not header["title"]:
+        # No title yet, the title worker generates one in the background
+        header["title"] = PLACEHOLDER_TITLE
+        header["title_pending"] = TITLE_PENDING
+    if source_ids:
+        header["source_ids"] = set(source_ids)
+    return header
+
+
+def turn_write_requests(session_id, user_id, first_turn, chat_entries):
+    return [
+        {'PutRequest': {'Item': {
+            'user_id': user_id,
+            'session_id': turn_key(session_id, first_turn + i),
+            'chat_entry': chat_entry
+        }}}
+        for i, chat_entry in enumerate(chat_entries)
+    ]
+
+
+def source_write_requests(session_id, user_id, sources):
+    return [
+        {'PutRequest': {'Item': {
+            'user_id': user_id,
+            'session_id': source_key(session_id, source_id),
+            'source': source
+        }}}
+        for source_id, source in sources.items()
+    ]
+
+
+def batch_write_all(write_requests):
+    # BatchWriteItem takes at most 25 requests per call
+    unprocessed = []
+    for i in range(0, len(write_requests), 25):
+        unprocessed.extend(table.batch_write(write_requests[i:i + 25]))
+    if unprocessed:
+        raise ClientError({'Error': {'Code': 'ProvisionedThroughputExceededException', 'Message': f'{len(unprocessed)} items could not be written'}}, 'BatchWriteItem')
+
+
+def write_new_sources(session_id, user_id, sources, require_session=False):
+    """
+    Write the source items a session does not have yet. Called before the ids are added to the
+    header's source_ids, so the set never names a source item that a failed write left out.
+
+    Raises:
+        ClientError: ConditionalCheckFailedException if require_session is set and the session does not exist.
+    """
+    if not sources:
+        return
+    header = table.get_item(Key={"session_id": session_id, "user_id": user_id}, ProjectionExpression="session_id, source_ids").get("Item")
+    if header is None and require_session:
+        raise ClientError({'Error': {'Code': 'ConditionalCheckFailedException', 'Message': 'The session does not exist'}}, 'GetItem')
+    known_source_ids = (header or {}).get("source_ids", set())
+    batch_write_all(source_write_requests(session_id, user_id, {k: v for k, v in sources.items() if k not in known_source_ids}))
+
+
+def reserve_turns(session_id, user_id, count, source_ids=(), message_ids=()):
+    """
+    Reserve the next count turn numbers on an existing session header and record the source ids used.
+    The source items must already be written.
+
+    The condition makes sure we never create a half-empty session that was never added, and the
+    atomic counter gives concurrent writers distinct numbers so they cannot overwrite each other.
+    Turns from the write queue pass their message ids, which replace the header's queued_messages
+    along with the first turn number they got. The update then also fails if the first message id
+    is already recorded, i.e. the batch was applied before.
+
+    Returns:
+        int: The first reserved turn number.
+
+    Raises:
+        ClientError: ConditionalCheckFailedException if the session does not exist or the messages were already applied.
+    """
+    update_expression = "ADD turn_count :count"
+    condition = "attribute_exists(session_id)"
+    values = {":count": count}
+    if source_ids:
+        update_expression += ", source_ids :source_ids"
+        values[":source_ids"] = set(source_ids)
+    if message_ids:
+        # Operands read the item as it was before the update, so this is the first reserved number
+        update_expression = "SET queued_messages = :messages, queued_first_turn = if_not_exists(turn_count, :zero) " + update_expression
+        condition += " AND NOT contains(queued_messages, :first_message)"
+        values.update({":messages": list(message_ids), ":zero": 0, ":first_message": message_ids[0]})
+    response = table.update_item(
+        Key={"session_id": session_id, "user_id": user_id},
+        UpdateExpression=update_expression,
+        ConditionExpression=condition,
+        ExpressionAttributeValues=values,
+        ReturnValues="UPDATED_OLD"
+    )
+    return response.get("Attributes", {}).get("turn_count", 0)
+
 
 # Define a function to add a session or update an existing one in the DynamoDB table
 def add_session(session_id, user_id, chat_history, title, new_chat_entry):
     try:
-        # Attempt to add an item to the DynamoDB table with provided details
-        response = table.put_item(
-            Item={
-                'user_id': user_id,  # Identifier for the user
-                'session_id': session_id,  # Unique identifier for the session
-                'chat_history': [new_chat_entry],  # List of chat history, initiating with the new entry
-                "title": title.strip(),  # Title of the session
-                "time_stamp": str(datetime.now())  # Current timestamp as a string
-            }
-        )
-        # Return any attributes returned by the DynamoDB operation, default to an empty dictionary if none
-        return response.get("Attributes", {})
+        # Write the sources first, then the session header and its first turn
+        packed_entries, sources = pack_turns([new_chat_entry])
+        batch_write_all(source_write_requests(session_id, user_id, sources))
+        try:
+            # BatchWriteItem cannot be conditional, and an unconditional put would reset the turn count
+            table.put_item(Item=new_session_header(session_id, user_id, title, 1, sources),
+                           ConditionExpression="attribute_not_exists(session_id)")
+        except ClientError as error:
+            if error.response['Error']['Code'] != "ConditionalCheckFailedException":
+                raise
+            # The session exists already, e.g. the request was retried, so the entry is appended to it
+            append_turns(session_id, user_id, [new_chat_entry])
+            return respond(200, {})
+        batch_write_all(turn_write_requests(session_id, user_id, 0, packed_entries))
+        return respond(200, {})
     except ClientError as error:
         # Check for specific DynamoDB client errors
-        print("Caught error: DynamoDB error - could not add new session")
+        logger.error("Caught error: DynamoDB error - could not add new session")
         if error.response["Error"]["Code"] == "ResourceNotFoundException":
             # Return an error message if the DynamoDB resource (e.g., table, item) is not found
-            return {'statusCode': 404,
-                'headers': {'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps(f"No record found with session id: {session_id}")}
+            return respond(404, f"No record found with session id: {session_id}")
         else:
             # Return a general error message for other client errors encountered
-            return {'statusCode': 500,
-                'headers': {'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps(str(error))}
+            return respond(500, str(error))
 
 
 # A function to retrieve a session from DynamoDB based on session_id and user_id
-def get_session(session_id, user_id):
+def get_session(session_id, user_id, last_n=None):
     # Initialize a variable to hold the response from DynamoDB
     response = {}
     try:
-        # Attempt to retrieve an item using the session_id and user_id as keys
-        response = table.get_item(Key={"session_id": session_id, "user_id": user_id})
+        key = {"session_id": session_id, "user_id": user_id}
+        if last_n:
+            # Only read the header fields, a legacy chat_history list may be large
+            response = table.get_item(Key=key, ProjectionExpression=HEADER_PROJECTION)
+        else:
+            # Attempt to retrieve the session header using the session_id and user_id as keys
+            response = table.get_item(Key=key)
+        item = response.get("Item", {})
+        if item:
+            turns = query_turns(session_id, user_id, last_n)
+            # Sessions saved in the old single-item format keep their turns on the header
+            for bookkeeping in HEADER_BOOKKEEPING:
+                item.pop(bookkeeping, None)
+            if not last_n:
+                legacy_history = item.pop('chat_history', [])
+            elif len(turns) < last_n:
+                legacy = table.get_item(Key=key, ProjectionExpression='chat_history').get("Item", {})
+                legacy_history = legacy.get('chat_history', [])[-(last_n - len(turns)):]
+            else:
+                legacy_history = []
+            item['chat_history'] = legacy_history + turns
     except ClientError as error:
-        print("Caught error: DynamoDB error - could not get session")
+        logger.error("Caught error: DynamoDB error - could not get session")
         # Handle specific error when the specified resource is not found in DynamoDB
         if error.response["Error"]["Code"] == "ResourceNotFoundException":
             # Return a 404 Not Found status code and message when the item is not found
-            return {
-                'statusCode': 404,
-                'headers': {'Access-Control-Allow-Origin': '*'},  # Allow all domains for CORS
-                'body':  json.dumps(f"No record found with session id: {session_id}")
-            }
+            return respond(404, f"No record found with session id: {session_id}")
         else:
             # Return a 500 Internal Server Error status for all other DynamoDB errors
-            return {
-                'statusCode': 500,
-                'headers': {'Access-Control-Allow-Origin': '*'},  # Allow all domains for CORS
-                'body': json.dumps('An unexpected error occurred')
-            }
+            return respond(500, 'An unexpected error occurred')
+
+    # Return the retrieved item with a 200 OK status
+    return respond(200, item)
 
-    # Prepare the response to the client with a 200 OK status if the item is successfully retrieved
-    response_to_client = {
-        'statusCode': 200,
-        'headers': {
-            'Access-Control-Allow-Origin': '*'  # Allow all domains for CORS
-        },
-        'body': json.dumps(response.get("Item", {}))  # Convert the retrieved item to JSON format
-    }
-    # Return the prepared response to the client
-    return response_to_client
+
+def session_exists(session_id, user_id):
+    # Only fetch the key of the header item, so the payload stays tiny however long the session is
+    try:
+        response = table.get_item(Key={"session_id": session_id, "user_id": user_id}, ProjectionExpression="session_id")
+    except ClientError as error:
+        logger.error("Caught error: DynamoDB error - could not check session")
+        return respond(500, 'An unexpected error occurred')
+    return respond(200, {"exists": "Item" in response})
 
             
 def update_session(session_id, user_id, new_chat_entry):
     try:
-        # Fetch current session details
-        session_response = get_session(session_id, user_id)
-        if 'statusCode' in session_response and session_response['statusCode'] != 200:
-            return session_response  # Return the error from get_session if any
+        # Write the sources the session has not used before, then reserve the next turn number on the session header
+        packed_entries, sources = pack_turns([new_chat_entry])
+        write_new_sources(session_id, user_id, sources, require_session=True)
+        turn = reserve_turns(session_id, user_id, 1, sources)
 
-        session_data = json.loads(session_response['body'])
-        
-        # Check if 'chat_history' exists in the session data
-        current_chat_history = session_data.get('chat_history', [])
-        
-        # Append the new chat entry to the existing chat history
-        updated_chat_history = current_chat_history + [new_chat_entry]
-        
-        # Update the item in DynamoDB
-        response = table.update_item(
-            Key={"session_id": session_id, "user_id": user_id},
-            UpdateExpression="set chat_history = :chat_history",
-            ExpressionAttributeValues={":chat_history": updated_chat_history},
-            ReturnValues="UPDATED_NEW"
-        )
-        return {
-            'statusCode': 200,
-            'headers': {'Access-Control-Allow-Origin': '*' },
-            'body': response.get("Attributes", {})
-        }
+        # Store the turn as its own small item, so writes do not grow with the conversation
+        batch_write_all(turn_write_requests(session_id, user_id, turn, packed_entries))
+        return respond(200, {})
     except ClientError as error:
-        print("Caught error: DynamoDB error - could not update session")
+        logger.error("Caught error: DynamoDB error - could not update session: %s", error)
         # Return a structured error message and status code
         error_code = error.response['Error']['Code']
-        if error_code == "ResourceNotFoundException":
-            return {
-                'statusCode': 404,
-                'headers': {'Access-Control-Allow-Origin': '*'},
-                'error': str(error),
-                'body': f"No record found with session id: {session_id}"
-            }
+        if error_code in ("ResourceNotFoundException", "ConditionalCheckFailedException"):
+            return respond(404, f"No record found with session id: {session_id}")
         else:
-            return {
-                'statusCode': 500,
-                'headers': {'Access-Control-Allow-Origin': '*'},
-                'error': str(error),
-                'body': 'Failed to update the session due to a database error.'
-            }
+            return respond(500, 'Failed to update the session due to a database error.')
     except Exception as general_error:
-        print("Caught error: DynamoDB error - could not update session")
+        logger.error("Caught error: DynamoDB error - could not update session: %s", general_error)
         # Return a generic error response for unexpected errors
-        return {
-            'statusCode': 500,
-            'headers': {'Access-Control-Allow-Origin': '*'},
-            'error': str(general_error),
-            'body': 'An unexpected error occurred while updating the se.'
-        }
+        return respond(500, 'An unexpected error occurred while updating the session.')
+
+
+def append_turns(session_id, user_id, chat_entries, message_ids=None):
+    """
+    Append several turns to a session in order, creating the session if it does not exist yet.
+
+    All turn numbers are reserved with one conditional header update and the turns are written
+    with BatchWriteItem, so a batch costs one header write instead of one per turn.
+
+    Args:
+        message_ids (list): Ids of the queue messages the turns came from, one per turn. A batch
+            the queue delivers again is written to the turn numbers it got the first time instead
+            of being appended twice.
+    """
+    packed_entries, sources = pack_turns(chat_entries)
+    message_ids = list(message_ids or [])
+    key = {"session_id": session_id, "user_id": user_id}
+    write_new_sources(session_id, user_id, sources)
+    try:
+        first_turn = reserve_turns(session_id, user_id, len(chat_entries), sources, message_ids)
+    except ClientError as error:
+        if error.response['Error']['Code'] != "ConditionalCheckFailedException":
+            raise
+        header = table.get_item(Key=key, ProjectionExpression="queued_messages, queued_first_turn", ConsistentRead=True).get("Item")
+        if header and message_ids and message_ids[0] in header.get("queued_messages", []):
+            replay_turns(session_id, user_id, chat_entries, message_ids, header)
+            return
+        try:
+            new_header = new_session_header(session_id, user_id, None, len(chat_entries), sources)
+            if message_ids:
+                new_header.update(queued_messages=message_ids, queued_first_turn=0)
+            table.put_item(Item=new_header, ConditionExpression="attribute_not_exists(session_id)")
+            first_turn = 0
+        except ClientError as error:
+            if error.response['Error']['Code'] != "ConditionalCheckFailedException":
+                raise
+            # Another writer created the session in the meantime, append to it instead
+            first_turn = reserve_turns(session_id, user_id, len(chat_entries), sources, message_ids)
+    batch_write_all(turn_write_requests(session_id, user_id, first_turn, packed_entries))
+
+
+def replay_turns(session_id, user_id, chat_entries, message_ids, header):
+    """
+    Write a redelivered batch again. Turns of messages the header already records go to the
+    numbers they were reserved the first time, overwriting anything a failed attempt wrote, and
+    any newer turns of the batch are appended as usual.
+    """
+    applied, first_turn = header["queued_messages"], header["queued_first_turn"]
+    write_requests = []
+    new_entries, new_message_ids = [], []
+    for chat_entry, message_id in zip(chat_entries, message_ids):
+        if message_id not in applied:
+            new_entries.append(chat_entry)
+            new_message_ids.append(message_id)
+            continue
+        # Their sources were written before the batch was recorded on the header
+        packed, _ = pack_chat_entry(chat_entry)
+        write_requests += turn_write_requests(session_id, user_id, first_turn + applied.index(message_id), [packed])
+    logger.info("Rewriting %d redelivered turns of session %s", len(message_ids) - len(new_message_ids), session_id)
+    batch_write_all(write_requests)
+    if new_entries:
+        append_turns(session_id, user_id, new_entries, new_message_ids)
+
+
+class SqsWriteQueue:
+    """Sends turns to the SQS FIFO queue the session handler consumes."""
+
+    def __init__(self, queue_url):
+        self.queue_url = queue_url
+        self.client = boto3.client("sqs", region_name='us-east-1')
+
+    def send(self, message, group_id):
+        self.client.send_message(
+            QueueUrl=self.queue_url,
+            MessageBody=json.dumps(message),
+            # Messages of one group are delivered in order, one batch at a time
+            MessageGroupId=group_id,
+            MessageDeduplicationId=str(uuid.uuid4())
+        )
+
+
+class InMemoryWriteQueue:
+    """Local stand-in for SqsWriteQueue. receive() returns records shaped like an SQS event."""
+
+    def __init__(self):
+        self.messages = deque()
+        self.sent = 0
+
+    def send(self, message, group_id):
+        self.sent += 1
+        self.messages.append({
+            'messageId': str(self.sent),
+            'body': json.dumps(message),
+            'attributes': {'MessageGroupId': group_id}
+        })
+
+    def receive(self, max_messages=10):
+        return [self.messages.popleft() for _ in range(min(max_messages, len(self.messages)))]
+
+
+write_queue = SqsWriteQueue(SESSION_WRITE_QUEUE_URL) if SESSION_WRITE_QUEUE_URL else None
+
+
+def enqueue_turn(session_id, user_id, new_chat_entry, queue=None):
+    queue = queue or write_queue
+    try:
+        if queue is None:
+            append_turns(session_id, user_id, [new_chat_entry])
+        else:
+            message = {"user_id": user_id, "session_id": session_id, "new_chat_entry": new_chat_entry}
+            queue.send(message, f"{user_id}#{session_id}")
+        return respond(200 if queue is None else 202, {})
+    except ClientError as error:
+        logger.error("Caught error: could not save turn for session %s: %s", session_id, error)
+        return respond(500, str(error))
+
+
+def process_write_records(records):
+    """
+    Consume queued turns. Turns of the same session are appended together, in the order they were
+    queued, with one append_turns call that skips messages already applied.
+
+    A record that cannot be read fails on its own, along with the records after it in the same
+    message group, so the turns of a session are never saved out of order.
+
+    Returns:
+        dict: SQS partial batch response listing the failed messages.
+    """
+    sessions = {}
+    failures = []
+    blocked_groups = set()
+    for record in records:
+        group_id = record.get('attributes', {}).get('MessageGroupId')
+        if group_id in blocked_groups:
+            failures.append({"itemIdentifier": record['messageId']})
+            continue
+        try:
+            message = json.loads(record['body'])
+            session = (message['user_id'], message['session_id'])
+            chat_entry = message['new_chat_entry']
+            if not all(isinstance(value, str) and value for value in session) or not isinstance(chat_entry, dict):
+                raise ValueError("user_id, session_id and new_chat_entry have the wrong types")
+        except (KeyError, TypeError, ValueError) as error:
+            logger.error("Caught error: could not read queued turn %s: %s", record['messageId'], error)
+            blocked_groups.add(group_id)
+            failures.append({"itemIdentifier": record['messageId']})
+            continue
+        sessions.setdefault(session, []).append((record['messageId'], chat_entry))
+
+    for (user_id, session_id), turns in sessions.items():
+        try:
+            append_turns(session_id, user_id, [chat_entry for _, chat_entry in turns], [message_id for message_id, _ in turns])
+        except Exception as error:
+            logger.error("Caught error: could not append %d turns to session %s: %s", len(turns), session_id, error)
+            failures.extend({"itemIdentifier": message_id} for message_id, _ in turns)
+    return {"batchItemFailures": failures}
 
 
 def delete_session(session_id, user_id):
     try:
-        # Attempt to delete an item from the DynamoDB table based on the provided session_id and user_id.
-        table.delete_item(Key={"session_id": session_id, "user_id": user_id})
+        # Attempt to delete the session header and all of its turn and source items
+        keys = [{"session_id": session_id, "user_id": user_id}]
+        for separator in (TURN_KEY_SEPARATOR, SOURCE_KEY_SEPARATOR):
+            query_kwargs = {
+                'KeyConditionExpression': "user_id = :user_id AND begins_with(session_id, :prefix)",
+                'ExpressionAttributeValues': {":user_id": user_id, ":prefix": session_id + separator},
+                'ProjectionExpression': 'session_id',
+            }
+            while True:
+                response = table.query(**query_kwargs)
+                keys.extend({"session_id": item['session_id'], "user_id": user_id} for item in response['Items'])
+                if 'LastEvaluatedKey' not in response:
+                    break
+                query_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+        batch_write_all([{'DeleteRequest': {'Key': key}} for key in keys])
     except ClientError as error:
-        print("Caught error: DynamoDB error - could not delete session")
+        logger.error("Caught error: DynamoDB error - could not delete session")
         # Handle specific DynamoDB client errors. If the item cannot be found or another error occurs, return the appropriate message.
         error_code = error.response['Error']['Code']
         if error_code == "ResourceNotFoundException":
-            return { 'statusCode': 404, "id": session_id, "deleted": False,'headers': {'Access-Control-Allow-Origin': '*'}, "body": json.dumps(f"No record found with session id: {session_id}")}
+            return respond(404, f"No record found with session id: {session_id}")
         else:
-            return { 'statusCode': 500, "id": session_id, "deleted": False,'headers': {'Access-Control-Allow-Origin': '*'}, "body": json.dumps(f"Error occurred: {error}")}
+            return respond(500, f"Error occurred: {error}")
 
     # If no exceptions are raised, return a response indicating that the deletion was successful.
-    return {'statusCode': 200, "id": session_id,'headers': {'Access-Control-Allow-Origin': '*'}, "deleted": True}
+    return respond(200, {"id": session_id, "deleted": True})
 
 
 
-def delete_user_sessions(user_id):
+def _batch_delete(keys):
+    # Returns the keys that could not be deleted
+    unprocessed = table.batch_write([{'DeleteRequest': {'Key': key}} for key in keys])
+    return [request['DeleteRequest']['Key'] for request in unprocessed]
+
+
+def delete_user_sessions(user_id, max_workers = 4):
     try:
-        # Fetch all sessions associated with the given user_id. This function should return a list of session dictionaries.
-        sessions = list_sessions_by_user_id(user_id)
-        ret_value = []  # Initialize a list to hold the results of the deletion attempts.
-
-        # Iterate through each session fetched from the database.
-        for session in sessions:
-            # Attempt to delete each session and capture the result.
-            result = delete_session(session["SessionId"], user_id)
-            # Append the result of the deletion attempt to the ret_value list. 
-            # This includes the session ID and whether the deletion was successful.
-            ret_value.append({"id": session["SessionId"], "deleted": result["deleted"]})
+        # Collect the keys of every item in the user's partition: session headers and their turn items
+        keys_by_session = {}
+        query_kwargs = {
+            'KeyConditionExpression': "user_id = :user_id",
+            'ExpressionAttributeValues': {":user_id": user_id},
+            'ProjectionExpression': 'session_id',
+        }
+        while True:
+            response = table.query(**query_kwargs)
+            for item in response['Items']:
+                session_id = header_session_id(item['session_id'])
+                keys_by_session.setdefault(session_id, []).append({'user_id': user_id, 'session_id': item['session_id']})
+            if 'LastEvaluatedKey' not in response:
+                break
+            query_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+        # BatchWriteItem takes at most 25 requests per call
+        keys = [key for session_keys in keys_by_session.values() for key in session_keys]
+        chunks = [keys[i:i + 25] for i in range(0, len(keys), 25)]
+
+        failed_keys = []
+        if max_workers > 1 and len(chunks) > 1:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                for unprocessed in executor.map(_batch_delete, chunks):
+                    failed_keys.extend(unprocessed)
+        else:
+            for chunk in chunks:
+                failed_keys.extend(_batch_delete(chunk))
+
+        # A session only counts as deleted when its header and all of its turns are gone
+        failed_sessions = {header_session_id(key['session_id']) for key in failed_keys}
+        ret_value = [{"id": session_id, "deleted": session_id not in failed_sessions} for session_id in keys_by_session]
+        if failed_sessions:
+            logger.error("Caught error: DynamoDB error - could not delete %d sessions", len(failed_sessions))
 
         # Return a list of dictionaries, each containing the session ID and deletion result.
-        return ret_value
+        return respond(200, ret_value)
 
-    except Exception as error:
-        # Handle any unexpected errors that might occur during the process.
-        # Return a list containing a single dictionary with an error message.
-        return [{"error": str(error)}]
+    except ClientError as error:
+        logger.error("Caught error: DynamoDB error - could not delete user sessions")
+        return respond(500, f"Error occurred: {error}")
         
         
-def list_sessions_by_user_id(user_id, limit = 15):
+def encode_page_token(last_evaluated_key):
+    # The DynamoDB key is handed to the client as an opaque url-safe string
+    return base64.urlsafe_b64encode(json.dumps(last_evaluated_key).encode('utf-8')).decode('ascii')
+
+
+def decode_page_token(page_token, user_id):
+    try:
+        key = json.loads(base64.urlsafe_b64decode(page_token.encode('ascii')))
+    except (ValueError, TypeError, UnicodeError):
+        raise ValueError("Invalid page token")
+    # a token is only valid for the user whose sessions it was issued for
+    if not isinstance(key, dict) or key.get('user_id') != user_id:
+        raise ValueError("Invalid page token")
+    return key
+
+
+def list_sessions_by_user_id(user_id, limit = 15, next_page_token = None):
     items = []  # Initialize an empty list to store the fetched session items
+    last_evaluated_key = None  # Initialize the key to control the pagination loop
 
     try:
-        last_evaluated_key = None  # Initialize the key to control the pagination loop
+        query_kwargs = {
+            'IndexName': 'TimeIndex',  # Specify the secondary index to perform the query
+            'ProjectionExpression': 'session_id, title, time_stamp',  # Limit the fields returned in the results
+            'KeyConditionExpression': "user_id = :user_id",  # Define the key condition for the query
+            'ExpressionAttributeValues': {":user_id": user_id},  # Bind the user_id value to the placeholder in KeyConditionExpression
+            'ScanIndexForward': False,  # Sort the results in descending order by the sort key
+        }
+        if next_page_token:
+            # Continue where the previous page stopped
+            query_kwargs['ExclusiveStartKey'] = decode_page_token(next_page_token, user_id)
 
-        # Keep fetching until we have 15 items or there are no more items to fetch
+        # Keep fetching until we have a full page or there are no more items to fetch
         while len(items) < limit:
-            response = table.query(
-                IndexName='TimeIndex',  # Specify the secondary index to perform the query
-                ProjectionExpression='session_id, title, time_stamp',  # Limit the fields returned in the results
-                KeyConditionExpression="user_id = :user_id",  # Define the key condition for the query
-                ExpressionAttributeValues={":user_id": user_id},  # Bind the user_id value to the placeholder in KeyConditionExpression
-                ScanIndexForward=False,  # Sort the results in descending order by the sort key
-                Limit=limit - len(items),  # Dynamically adjust the query limit based on how many items we've already retrieved
-            )
+            query_kwargs['Limit'] = limit - len(items)  # Dynamically adjust the query limit based on how many items we've already retrieved
+            response = table.query(**query_kwargs)
             items.extend(response.get("Items", []))  # Extend the items list with the newly fetched items
 
             last_evaluated_key = response.get("LastEvaluatedKey")  # Update the pagination key
             if not last_evaluated_key:  # Break the loop if there are no more items to fetch
                 break
+            query_kwargs['ExclusiveStartKey'] = last_evaluated_key
 
+    except ValueError as value_error:
+        return respond(400, str(value_error))
     except ClientError as error:
-        print("Caught error: DynamoDB error - could not list user sessions")
+        logger.error("Caught error: DynamoDB error - could not list user sessions")
         # More detailed client error handling based on DynamoDB error codes
         error_code = error.response['Error']['Code']
         if error_code == "ResourceNotFoundException":
-            return {'statusCode': 404,
-            'headers': { 'Access-Control-Allow-Origin': '*'}, 
-            'body': f"No record found for user id: {user_id}"}
+            return respond(404, f"No record found for user id: {user_id}")
         elif error_code == "ProvisionedThroughputExceededException":
-            return {'statusCode': 429,
-            'headers': {
-            'Access-Control-Allow-Origin': '*'  # CORS header allowing access from any domain
-        }, 'body': "Request limit exceeded"}
+            return respond(429, "Request limit exceeded")
         elif error_code == "ValidationException":
-            return {'statusCode': 400,
-            'headers': {
-            'Access-Control-Allow-Origin': '*'  # CORS header allowing access from any domain
-        }, 'body': "Invalid input parameters"}
+            return respond(400, "Invalid input parameters")
         else:
-            return {'statusCode': 500,
-            'headers': {
-            'Access-Control-Allow-Origin': '*'  # CORS header allowing access from any domain
-        }, 'body': "Internal server error"}
+            return respond(500, "Internal server error")
     except KeyError as key_error:
-        print("Caught error: DynamoDB error - could not list user sessions")
+        logger.error("Caught error: DynamoDB error - could not list user sessions")
         # Handle errors that might occur if expected keys are missing in the response
-        return {'statusCode': 500,
-        'headers': {
-            'Access-Control-Allow-Origin': '*'  # CORS header allowing access from any domain
-        }, 'body': f"Key error: {str(key_error)}"}
+        return respond(500, f"Key error: {str(key_error)}")
     except Exception as general_error:
-        print("Caught error: DynamoDB error - could not list user sessions")
+        logger.error("Caught error: DynamoDB error - could not list user sessions")
         # Generic error handling for any other unforeseen errors
-        return {'statusCode': 500,
-        'headers': {
-            'Access-Control-Allow-Origin': '*'  # CORS header allowing access from any domain
-        }, 'body': json.dumps(f"An unexpected error occurred: {str(general_error)}")}
-
-    # Sort the items by 'time_stamp' in descending order to ensure the latest sessions appear first
-    sorted_items = sorted(items, key=lambda x: x['time_stamp'], reverse=True)
-    sorted_items = list(map(lambda x: {"time_stamp" : x["time_stamp"], "session_id" : x["session_id"], "title" : x["title"].strip()},sorted_items))
-
-    # Prepare the HTTP response object with a status code, headers, and body
-    response = {
-        'statusCode': 200,  # HTTP status code indicating a successful operation
-        'headers': {
-            'Access-Control-Allow-Origin': '*'  # CORS header allowing access from any domain
-        },
-        'body': json.dumps(sorted_items)  # Convert the sorted list of items to JSON format for the response body
-    }
-    return response  # Return the response object
+        return respond(500, f"An unexpected error occurred: {str(general_error)}")
+
+    # The TimeIndex already returns the latest sessions first
+    sessions = [{"time_stamp" : x["time_stamp"], "session_id" : x["session_id"], "title" : x["title"].strip()} for x in items]
+
+    # Return the page of sessions and the token for the next page (null on the last page)
+    return respond(200, {
+        "sessions": sessions,
+        "next_page_token": encode_page_token(last_evaluated_key) if last_evaluated_key else None
+    })
 
 # def load_excel_from_dynamodb(session_id, user_id):
 #     try:
@@ -328,39 +939,129 @@ def list_sessions_by_user_id(user_id, limit = 15):
 #     else:
 #         return "No matching records found."
 
+class RequestError(ValueError):
+    """A request that does not match the schema of its operation. Answered with a 400."""
+
+
+# Operation name -> (handler, {field: type} of required fields, {field: type} of optional fields).
+# Handlers take the validated request and return a response built with respond().
+OPERATIONS = {}
+
+
+def register_operation(name, required=None, optional=None):
+    def register(handler):
+        OPERATIONS[name] = (handler, required or {}, optional or {})
+        return handler
+    return register
+
+
+def validate_request(data, required, optional):
+    """
+    Check the request fields against an operation's schema. Whole numbers sent as strings are
+    converted to int in place, and must be at least 1.
+
+    Raises:
+        RequestError: If a required field is missing or a field has the wrong type or value.
+    """
+    for field, field_type in required.items():
+        if data.get(field) is None or (field_type is str and not data[field]):
+            raise RequestError(f"Missing required field: {field}")
+    for field, field_type in {**required, **optional}.items():
+        value = data.get(field)
+        if value is None:
+            continue
+        if field_type is int:
+            if isinstance(value, str) and value.strip().isdigit():
+                value = data[field] = int(value)
+            if isinstance(value, bool) or not isinstance(value, int):
+                raise RequestError(f"Field {field} must be a whole number")
+            if value < 1:
+                raise RequestError(f"Field {field} must be at least 1")
+        elif not isinstance(value, field_type):
+            raise RequestError(f"Field {field} must be of type {field_type.__name__}")
+
+
+SESSION_FIELDS = {'user_id': str, 'session_id': str}
+TURN_FIELDS = {**SESSION_FIELDS, 'new_chat_entry': dict}
+PAGE_FIELDS = {'page_size': int, 'next_page_token': str}
+
+
+@register_operation('add_session', required=TURN_FIELDS, optional={'title': str, 'chat_history': list})
+def handle_add_session(data):
+    return add_session(data['session_id'], data['user_id'], data.get('chat_history'), data.get('title'), data['new_chat_entry'])
+
+
+@register_operation('get_session_tail', required=SESSION_FIELDS, optional={'last_n': int})
+def handle_get_session_tail(data):
+    return get_session(data['session_id'], data['user_id'], data.get('last_n') or DEFAULT_TAIL_TURNS)
+
+
+@register_operation('session_exists', required=SESSION_FIELDS)
+def handle_session_exists(data):
+    return session_exists(data['session_id'], data['user_id'])
+
+
+@register_operation('get_session', required=SESSION_FIELDS, optional={'last_n': int})
+def handle_get_session(data):
+    return get_session(data['session_id'], data['user_id'], data.get('last_n') or None)
+
+
+@register_operation('update_session', required=TURN_FIELDS)
+def handle_update_session(data):
+    return update_session(data['session_id'], data['user_id'], data['new_chat_entry'])
+
+
+@register_operation('enqueue_turn', required=TURN_FIELDS)
+def handle_enqueue_turn(data):
+    return enqueue_turn(data['session_id'], data['user_id'], data['new_chat_entry'])
+
+
+@register_operation('list_sessions_by_user_id', required={'user_id': str}, optional=PAGE_FIELDS)
+def handle_list_sessions_by_user_id(data):
+    return list_sessions_by_user_id(data['user_id'], page_size(data, 15), data.get('next_page_token'))
+
+
+@register_operation('list_all_sessions_by_user_id', required={'user_id': str}, optional=PAGE_FIELDS)
+def handle_list_all_sessions_by_user_id(data):
+    return list_sessions_by_user_id(data['user_id'], page_size(data, MAX_PAGE_SIZE), data.get('next_page_token'))
+
+
+@register_operation('delete_session', required=SESSION_FIELDS)
+def handle_delete_session(data):
+    return delete_session(data['session_id'], data['user_id'])
+
+
+@register_operation('delete_user_sessions', required={'user_id': str})
+def handle_delete_user_sessions(data):
+    return delete_user_sessions(data['user_id'])
+
+
+def page_size(data, default):
+    # Cap the requested page size (validated to be at least 1) so a single call cannot return an unbounded payload
+    return min(data.get('page_size') or default, MAX_PAGE_SIZE)
+
+
 def lambda_handler(event, context):
-    data = json.loads(event['body'])
-    operation = data.get('operation')
-    user_id = data.get('user_id')
-    session_id = data.get('session_id')
-    chat_history = data.get('chat_history', None)
-    new_chat_entry = data.get('new_chat_entry')
-    title = data.get('title', f"Chat on {str(datetime.now())}")
+    sample_log_level(logger)
+    if 'Records' in event:
+        # Invoked by the session write queue
+        return process_write_records(event['Records'])
+    try:
+        data = json.loads(event.get('body') or '{}')
+        if not isinstance(data, dict):
+            raise RequestError("The request body must be a JSON object")
+        operation = data.get('operation')
+        if operation not in OPERATIONS:
+            raise RequestError(f'Operation not found/allowed! Operation Sent: {operation}')
+        handler, required, optional = OPERATIONS[operation]
+        validate_request(data, required, optional)
+    except ValueError as error:
+        # Covers malformed JSON as well as RequestError
+        logger.info("Rejected request: %s", error)
+        return respond(400, str(error))
+
     if operation != 'list_sessions_by_user_id':
-        print(operation)
-    print(data)
-    print(new_chat_entry)
-
-    if operation == 'add_session':
-        return add_session(session_id, user_id, chat_history, title, new_chat_entry)
-    elif operation == 'get_session':
-        return get_session(session_id, user_id)
-    elif operation == 'update_session':
-        return update_session(session_id, user_id, new_chat_entry)
-    elif operation == 'list_sessions_by_user_id':
-        return list_sessions_by_user_id(user_id)
-    elif operation == 'list_all_sessions_by_user_id':
-        return list_sessions_by_user_id(user_id,limit=100)
-    elif operation == 'delete_session':
-        return delete_session(session_id, user_id)
-    elif operation == 'delete_user_sessions':
-        return delete_user_sessions(user_id)
-    else:
-        response = {
-            'statusCode': 400,
-            'headers': {
-                'Access-Control-Allow-Origin': '*'
-            },
-            'body': json.dumps(f'Operation not found/allowed! Operation Sent: {operation}')
-        }
-        return response
\ No newline at end of file
+        logger.info("Operation: %s", operation)
+    # Only the field names, chat entries can be large and hold user content
+    logger.debug("Request fields: %s", sorted(data))
+    return handler(data)
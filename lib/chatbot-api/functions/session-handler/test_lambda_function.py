@@ -0,0 +1,296 @@
+"""
+Tests for the session handler, run from this directory against moto's in-process DynamoDB mock
+(pip install moto):
+
+    python -m unittest test_lambda_function
+
+The table is created like benchmark.py creates it, with the TimeIndex and UntitledIndex.
+"""
+import json
+import os
+import threading
+import unittest
+
+os.environ.setdefault('DDB_TABLE_NAME', 'SessionHandlerTest')
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+os.environ.setdefault('AWS_ACCESS_KEY_ID', 'test')
+os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'test')
+
+import boto3
+from moto import mock_aws
+
+import lambda_function
+from benchmark import chat_entry, create_table
+
+USER_ID = 'test-user'
+
+
+class AtomicRequests:
+    """
+    Runs each request of the wrapped client under one lock. DynamoDB applies every single request
+    atomically but moto does not across threads, while the requests of concurrent writers still
+    interleave freely.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.lock = threading.Lock()
+
+    def __getattr__(self, name):
+        method = getattr(self.client, name)
+
+        def locked(**kwargs):
+            with self.lock:
+                return method(**kwargs)
+        return locked
+
+
+def call(operation, **fields):
+    response = lambda_function.lambda_handler({'body': json.dumps(dict(fields, operation=operation))}, None)
+    return response['statusCode'], json.loads(response['body'])
+
+
+class SessionTestCase(unittest.TestCase):
+    def setUp(self):
+        mock = mock_aws()
+        mock.start()
+        self.addCleanup(mock.stop)
+        client = boto3.client('dynamodb', region_name='us-east-1')
+        create_table(client)
+        original = lambda_function.table
+        lambda_function.table = lambda_function.SessionTable(client, lambda_function.DDB_TABLE_NAME)
+        self.addCleanup(setattr, lambda_function, 'table', original)
+
+    def patch(self, name, value):
+        original = getattr(lambda_function, name)
+        setattr(lambda_function, name, value)
+        self.addCleanup(setattr, lambda_function, name, original)
+
+    def add_session(self, session_id, **fields):
+        status, body = call('add_session', user_id=USER_ID, session_id=session_id, new_chat_entry=chat_entry(0), **fields)
+        self.assertEqual(status, 200, body)
+
+    def get_history(self, session_id):
+        status, body = call('get_session', user_id=USER_ID, session_id=session_id)
+        self.assertEqual(status, 200, body)
+        return body['chat_history']
+
+
+class ConcurrentAppendTest(SessionTestCase):
+    # Turns used to be appended to the header's chat_history with list_append. They are now separate
+    # items numbered by an atomic turn counter, so this covers update_session as it is now.
+    def test_concurrent_updates_keep_every_turn(self):
+        self.patch('table', lambda_function.SessionTable(AtomicRequests(lambda_function.table.client), lambda_function.DDB_TABLE_NAME))
+        self.add_session('session-1')
+        writers, turns_per_writer = 8, 10
+        statuses = []
+
+        def write(writer):
+            for turn in range(turns_per_writer):
+                entry = {'user': f'writer {writer} turn {turn}', 'chatbot': 'answer', 'metadata': '[]'}
+                statuses.append(call('update_session', user_id=USER_ID, session_id='session-1', new_chat_entry=entry)[0])
+
+        threads = [threading.Thread(target=write, args=(writer,)) for writer in range(writers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(statuses, [200] * writers * turns_per_writer)
+        history = self.get_history('session-1')
+        questions = [entry['user'] for entry in history[1:]]
+        self.assertEqual(len(history), 1 + writers * turns_per_writer)
+        self.assertEqual(len(set(questions)), writers * turns_per_writer)
+        # Each writer's own turns keep the order it appended them in
+        for writer in range(writers):
+            own = [question for question in questions if question.startswith(f'writer {writer} ')]
+            self.assertEqual(own, [f'writer {writer} turn {turn}' for turn in range(turns_per_writer)])
+
+    def test_update_of_missing_session_is_404(self):
+        status, _ = call('update_session', user_id=USER_ID, session_id='missing', new_chat_entry=chat_entry(1))
+        self.assertEqual(status, 404)
+        self.assertEqual(lambda_function.table.query(
+            KeyConditionExpression="user_id = :user_id", ExpressionAttributeValues={":user_id": USER_ID})['Items'], [])
+
+
+class AddSessionTest(SessionTestCase):
+    def test_adding_an_existing_session_appends_instead_of_resetting_it(self):
+        self.add_session('session-1', title='First title')
+        status, _ = call('update_session', user_id=USER_ID, session_id='session-1', new_chat_entry=chat_entry(1))
+        self.assertEqual(status, 200)
+        status, _ = call('add_session', user_id=USER_ID, session_id='session-1', new_chat_entry=chat_entry(2), title='Second title')
+        self.assertEqual(status, 200)
+
+        self.assertEqual([turn['user'] for turn in self.get_history('session-1')], ['question 0', 'question 1', 'question 2'])
+        status, body = call('get_session', user_id=USER_ID, session_id='session-1')
+        self.assertEqual(body['title'], 'First title')
+
+
+class StoredFormatTest(SessionTestCase):
+    def test_compressed_and_interned_turns_round_trip(self):
+        entries = [chat_entry(turn) for turn in range(6)]
+        self.add_session('session-1')
+        for entry in entries[1:]:
+            self.assertEqual(call('update_session', user_id=USER_ID, session_id='session-1', new_chat_entry=entry)[0], 200)
+        # chat_entry(0) is random, take the stored one
+        entries[0] = self.get_history('session-1')[0]
+        self.assertEqual(self.get_history('session-1'), entries)
+        status, body = call('get_session_tail', user_id=USER_ID, session_id='session-1', last_n=3)
+        self.assertEqual(body['chat_history'], entries[-3:])
+        turn = lambda_function.table.get_item(Key={'user_id': USER_ID, 'session_id': lambda_function.turn_key('session-1', 1)})['Item']
+        self.assertIsInstance(turn['chat_entry']['chatbot'], bytes)
+        self.assertNotIn('metadata', turn['chat_entry'])
+
+    def test_failed_source_write_does_not_lose_links(self):
+        self.add_session('session-1')
+        entry = chat_entry(1)
+        batch_write_all = lambda_function.batch_write_all
+
+        def fail_on_sources(write_requests):
+            if any(lambda_function.SOURCE_KEY_SEPARATOR in request['PutRequest']['Item']['session_id'] for request in write_requests):
+                raise lambda_function.ClientError({'Error': {'Code': 'InternalServerError', 'Message': 'injected'}}, 'BatchWriteItem')
+            batch_write_all(write_requests)
+        self.patch('batch_write_all', fail_on_sources)
+        self.assertEqual(call('update_session', user_id=USER_ID, session_id='session-1', new_chat_entry=entry)[0], 500)
+        lambda_function.batch_write_all = batch_write_all
+        self.assertEqual(call('update_session', user_id=USER_ID, session_id='session-1', new_chat_entry=entry)[0], 200)
+        self.assertEqual(self.get_history('session-1')[1:], [entry])
+
+
+class RequestValidationTest(SessionTestCase):
+    def test_counts_below_one_are_rejected(self):
+        self.add_session('session-1')
+        for operation, field in (('get_session', 'last_n'), ('get_session_tail', 'last_n'),
+                                 ('list_sessions_by_user_id', 'page_size'), ('list_all_sessions_by_user_id', 'page_size')):
+            for value in (0, '0', -1, '-1'):
+                status, _ = call(operation, user_id=USER_ID, session_id='session-1', **{field: value})
+                self.assertEqual(status, 400, (operation, field, value))
+            status, _ = call(operation, user_id=USER_ID, session_id='session-1', **{field: '1'})
+            self.assertEqual(status, 200, (operation, field))
+
+    def test_bookkeeping_attributes_are_not_returned(self):
+        self.add_session('session-1')
+        self.assertEqual(call('update_session', user_id=USER_ID, session_id='session-1', new_chat_entry=chat_entry(1))[0], 200)
+        for operation in ('get_session', 'get_session_tail'):
+            status, body = call(operation, user_id=USER_ID, session_id='session-1')
+            self.assertEqual(status, 200)
+            self.assertEqual(sorted(body), ['chat_history', 'session_id', 'time_stamp', 'title', 'user_id'])
+            self.assertEqual(body['title'], lambda_function.PLACEHOLDER_TITLE)
+
+
+class PaginationTest(SessionTestCase):
+    SESSIONS = 1000
+
+    def setUp(self):
+        super().setUp()
+        headers = []
+        for i in range(self.SESSIONS):
+            header = lambda_function.new_session_header(f'session-{i:04d}', USER_ID, f'title {i}', 0)
+            header['time_stamp'] = f'2024-01-01 00:{i // 60:02d}:{i % 60:02d}'
+            headers.append({'PutRequest': {'Item': header}})
+        lambda_function.batch_write_all(headers)
+
+    def list_all(self, operation, **fields):
+        pages = []
+        token = None
+        while True:
+            status, body = call(operation, user_id=USER_ID, next_page_token=token, **fields)
+            self.assertEqual(status, 200, body)
+            pages.append(body['sessions'])
+            token = body['next_page_token']
+            if token is None:
+                return pages
+
+    def assert_complete(self, pages, page_size):
+        sessions = [session['session_id'] for page in pages for session in page]
+        self.assertEqual(sessions, [f'session-{i:04d}' for i in reversed(range(self.SESSIONS))])
+        self.assertTrue(all(len(page) == page_size for page in pages[:-1]))
+
+    def test_default_pages_cover_every_session_once(self):
+        self.assert_complete(self.list_all('list_sessions_by_user_id'), 15)
+
+    def test_large_pages_cover_every_session_once(self):
+        pages = self.list_all('list_all_sessions_by_user_id')
+        self.assertEqual(len(pages), self.SESSIONS // lambda_function.MAX_PAGE_SIZE)
+        self.assert_complete(pages, lambda_function.MAX_PAGE_SIZE)
+
+    def test_page_size_is_capped(self):
+        self.assert_complete(self.list_all('list_sessions_by_user_id', page_size=1000), lambda_function.MAX_PAGE_SIZE)
+
+    def test_foreign_and_malformed_tokens_are_rejected(self):
+        _, body = call('list_sessions_by_user_id', user_id=USER_ID)
+        status, _ = call('list_sessions_by_user_id', user_id='someone-else', next_page_token=body['next_page_token'])
+        self.assertEqual(status, 400)
+        status, _ = call('list_sessions_by_user_id', user_id=USER_ID, next_page_token='not a token')
+        self.assertEqual(status, 400)
+
+
+class WriteQueueTest(SessionTestCase):
+    def setUp(self):
+        super().setUp()
+        self.queue = lambda_function.InMemoryWriteQueue()
+
+    def enqueue(self, session_id, question):
+        entry = {'user': question, 'chatbot': 'answer', 'metadata': '[]'}
+        self.assertEqual(lambda_function.enqueue_turn(session_id, USER_ID, entry, queue=self.queue)['statusCode'], 202)
+
+    def deliver(self, records):
+        return lambda_function.lambda_handler({'Records': records}, None)['batchItemFailures']
+
+    def questions(self, session_id):
+        return [entry['user'] for entry in self.get_history(session_id)]
+
+    def test_turns_keep_their_queue_order(self):
+        # Sessions interleave in the queue and their turns are split over several batches
+        for turn in range(12):
+            for session_id in ('a', 'b', 'c'):
+                self.enqueue(session_id, f'{session_id}{turn}')
+        while self.queue.messages:
+            self.assertEqual(self.deliver(self.queue.receive(10)), [])
+        for session_id in ('a', 'b', 'c'):
+            self.assertEqual(self.questions(session_id), [f'{session_id}{turn}' for turn in range(12)])
+
+    def test_redelivered_batch_is_not_appended_twice(self):
+        for turn in range(3):
+            self.enqueue('a', f'a{turn}')
+        records = self.queue.receive(10)
+        self.assertEqual(self.deliver(records), [])
+        # The queue did not get the result and delivers the batch again, with a newer turn added
+        self.enqueue('a', 'a3')
+        self.assertEqual(self.deliver(records + self.queue.receive(10)), [])
+        self.assertEqual(self.questions('a'), ['a0', 'a1', 'a2', 'a3'])
+
+    def test_turns_reserved_by_a_failed_attempt_are_filled_on_retry(self):
+        self.add_session('a')
+        for turn in range(1, 4):
+            self.enqueue('a', f'a{turn}')
+        records = self.queue.receive(10)
+
+        def fail(write_requests):
+            raise lambda_function.ClientError({'Error': {'Code': 'InternalServerError', 'Message': 'injected'}}, 'BatchWriteItem')
+        batch_write_all = lambda_function.batch_write_all
+        self.patch('batch_write_all', fail)
+        # The turn numbers are reserved but the turns are never written
+        self.assertEqual(len(self.deliver(records)), 3)
+        lambda_function.batch_write_all = batch_write_all
+        self.assertEqual(self.deliver(records), [])
+
+        self.enqueue('a', 'a4')
+        self.assertEqual(self.deliver(self.queue.receive(10)), [])
+        self.assertEqual(self.questions('a'), ['question 0', 'a1', 'a2', 'a3', 'a4'])
+
+    def test_unreadable_record_fails_with_the_rest_of_its_group(self):
+        for turn in range(2):
+            self.enqueue('a', f'a{turn}')
+            self.enqueue('b', f'b{turn}')
+        records = self.queue.receive(10)
+        records[0]['body'] = '{"user_id": "test-user"'
+        failures = self.deliver(records)
+        # a0 is unreadable, a1 must wait for it, and session b is saved regardless
+        self.assertEqual(sorted(failure['itemIdentifier'] for failure in failures), [records[0]['messageId'], records[2]['messageId']])
+        self.assertEqual(self.questions('b'), ['b0', 'b1'])
+        self.assertEqual(call('get_session', user_id=USER_ID, session_id='a'), (200, {}))
+
+
+if __name__ == '__main__':
+    unittest.main()
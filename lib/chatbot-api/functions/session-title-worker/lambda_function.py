@@ -0,0 +1,205 @@
+import os
+import boto3
+from boto3.dynamodb.types import Binary
+from botocore.exceptions import ClientError
+import json
+import zlib
+from lambda_logging import get_logger, sample_log_level
+
+
+
+# Retrieve the DynamoDB table name from environment variables
+DDB_TABLE_NAME = os.environ["DDB_TABLE_NAME"]
+# Sparse index holding only the session headers that still wait for a title
+UNTITLED_INDEX_NAME = os.environ.get("UNTITLED_INDEX_NAME", "UntitledIndex")
+# Model used to write titles, and the number of sessions titled per run
+TITLE_MODEL_ID = os.environ.get("TITLE_MODEL_ID", "mistral.mistral-7b-instruct-v0:2")
+TITLE_BATCH_SIZE = int(os.environ.get("TITLE_BATCH_SIZE", 50))
+# Value of title_pending on untitled headers, and the key format of turn items (see session-handler)
+TITLE_PENDING = "1"
+TURN_KEY_SEPARATOR = "#turn#"
+# Titles longer than this are cut, the model sometimes keeps going past the title
+MAX_TITLE_LENGTH = 100
+# Runs that may fail to title a session (an error, an empty answer or no first turn yet) before
+# it leaves the untitled index and keeps its placeholder title
+TITLE_MAX_ATTEMPTS = int(os.environ.get("TITLE_MAX_ATTEMPTS", 3))
+
+# Levels and per-invocation DEBUG sampling come from LOG_LEVEL and LOG_DEBUG_SAMPLE_RATE, see lambda_logging
+logger = get_logger(__name__)
+
+
+dynamodb = boto3.resource("dynamodb", region_name='us-east-1')
+table = dynamodb.Table(DDB_TABLE_NAME)
+
+
+class MistralTitleModel:
+    """Generates titles with a Bedrock Mistral model. Any object with a get_prompted_response method can stand in for it."""
+
+    def __init__(self, model_id=TITLE_MODEL_ID):
+        self.client = boto3.client("bedrock-runtime", region_name='us-east-1')
+        self.model_id = model_id
+
+    def get_prompted_response(self, prompt, max_tokens):
+        payload = {
+            "prompt": prompt,
+            "max_tokens": max_tokens,
+            "temperature": 0,
+            "stop": ["?\n", '?"\n']
+        }
+        response = self.client.invoke_model(
+            modelId=self.model_id,
+            contentType="application/json",
+            body=json.dumps(payload)
+        )
+        return json.loads(response["body"].read())["outputs"][0]["text"]
+
+
+# Created once per container and reused by every run
+title_model = MistralTitleModel()
+
+
+def entry_text(value):
+    # session-handler stores long text fields zlib-compressed as Binary
+    return zlib.decompress(value.value).decode('utf-8') if isinstance(value, Binary) else value
+
+
+def title_prompt(chat_entry):
+    return f"""Generate a concise title for this chat session based on the initial user prompt and response. The title should succinctly capture the essence of the chat's main topic without adding extra content.
+
+      {entry_text(chat_entry.get("user", ""))}
+      {entry_text(chat_entry.get("chatbot", ""))}
+      Here's your session title:"""
+
+
+def clean_title(text):
+    return text.replace('"', '').strip()[:MAX_TITLE_LENGTH]
+
+
+def untitled_sessions(limit):
+    """Read up to limit untitled session headers, oldest first."""
+    sessions = []
+    query_kwargs = {
+        'IndexName': UNTITLED_INDEX_NAME,
+        'KeyConditionExpression': "title_pending = :pending",
+        'ExpressionAttributeValues': {":pending": TITLE_PENDING},
+        'Limit': limit,
+    }
+    while len(sessions) < limit:
+        response = table.query(**query_kwargs)
+        sessions.extend(response.get('Items', []))
+        if 'LastEvaluatedKey' not in response:
+            break
+        query_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+    return sessions[:limit]
+
+
+def first_turn(session_id, user_id):
+    """Read the first chat entry of a session. Returns None if the session has no turns yet."""
+    response = table.get_item(
+        Key={"user_id": user_id, "session_id": f"{session_id}{TURN_KEY_SEPARATOR}{0:06d}"},
+        ProjectionExpression="chat_entry"
+    )
+    if "Item" in response:
+        return response["Item"]["chat_entry"]
+    # Sessions stored before turn items keep their history on the header
+    response = table.get_item(
+        Key={"user_id": user_id, "session_id": session_id},
+        ProjectionExpression="chat_history"
+    )
+    history = response.get("Item", {}).get("chat_history")
+    return history[0] if history else None
+
+
+def save_title(session_id, user_id, title):
+    """Write the title and take the session out of the untitled index. Returns False if the session is gone or already titled."""
+    try:
+        table.update_item(
+            Key={"user_id": user_id, "session_id": session_id},
+            UpdateExpression="SET title = :title REMOVE title_pending",
+            ConditionExpression="title_pending = :pending",
+            ExpressionAttributeValues={":title": title, ":pending": TITLE_PENDING}
+        )
+        return True
+    except ClientError as error:
+        if error.response["Error"]["Code"] == "ConditionalCheckFailedException":
+            return False
+        raise
+
+
+def record_attempt(session_id, user_id):
+    """
+    Count a run that could not title the session. After TITLE_MAX_ATTEMPTS runs the session leaves
+    the untitled index with its placeholder title, so it cannot take up a batch slot forever.
+
+    Returns:
+        bool: True if the session was given up on.
+    """
+    key = {"user_id": user_id, "session_id": session_id}
+    try:
+        response = table.update_item(
+            Key=key,
+            UpdateExpression="ADD title_attempts :one",
+            ConditionExpression="title_pending = :pending",
+            ExpressionAttributeValues={":one": 1, ":pending": TITLE_PENDING},
+            ReturnValues="UPDATED_NEW"
+        )
+        if response["Attributes"]["title_attempts"] < TITLE_MAX_ATTEMPTS:
+            return False
+        table.update_item(
+            Key=key,
+            UpdateExpression="REMOVE title_pending, title_attempts",
+            ConditionExpression="title_pending = :pending",
+            ExpressionAttributeValues={":pending": TITLE_PENDING}
+        )
+        return True
+    except ClientError as error:
+        # The session was titled or deleted in the meantime
+        if error.response["Error"]["Code"] == "ConditionalCheckFailedException":
+            return False
+        raise
+
+
+def generate_titles(model, limit=TITLE_BATCH_SIZE):
+    """
+    Generate titles for up to limit untitled sessions.
+
+    Args:
+        model: Object with a get_prompted_response(prompt, max_tokens) method returning the title text.
+        limit (int): Maximum number of sessions to title in this run.
+
+    Returns:
+        dict: Counts of titled, failed, skipped (no first turn yet) and abandoned sessions.
+    """
+    titled = failed = skipped = abandoned = 0
+    for session in untitled_sessions(limit):
+        session_id, user_id = session["session_id"], session["user_id"]
+        try:
+            chat_entry = first_turn(session_id, user_id)
+            if chat_entry is None:
+                # The header is written before the first turn, wait for the turn instead of titling an empty chat
+                skipped += 1
+            else:
+                title = clean_title(model.get_prompted_response(title_prompt(chat_entry), 25))
+                if title:
+                    if save_title(session_id, user_id, title):
+                        titled += 1
+                    continue
+        except Exception as error:
+            # One failing session should not stop the rest of the batch
+            failed += 1
+            logger.error("Could not title session %s: %s", session_id, error)
+        # An error, an empty answer or a missing first turn: retried on the next runs, up to TITLE_MAX_ATTEMPTS
+        try:
+            if record_attempt(session_id, user_id):
+                abandoned += 1
+                logger.info("Gave up titling session %s after %d attempts", session_id, TITLE_MAX_ATTEMPTS)
+        except ClientError as error:
+            logger.error("Could not record title attempt for session %s: %s", session_id, error)
+    return {"titled": titled, "failed": failed, "skipped": skipped, "abandoned": abandoned}
+
+
+def lambda_handler(event, context):
+    sample_log_level(logger)
+    result = generate_titles(title_model)
+    logger.info("Title worker run: %s", result)
+    return result
@@ -0,0 +1,151 @@
+"""
+Tests for the session title worker, run from this directory against moto's in-process DynamoDB
+mock (pip install moto):
+
+    python -m unittest test_lambda_function
+
+Titles come from a fake model that replays scripted answers, so no Bedrock access is needed.
+"""
+import os
+import unittest
+import zlib
+
+os.environ.setdefault('DDB_TABLE_NAME', 'SessionTitleWorkerTest')
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+os.environ.setdefault('AWS_ACCESS_KEY_ID', 'test')
+os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'test')
+
+import boto3
+from boto3.dynamodb.types import Binary
+from moto import mock_aws
+
+import lambda_function
+
+USER_ID = 'test-user'
+PLACEHOLDER_TITLE = 'New chat'
+
+
+class FakeModel:
+    """Answers prompts with scripted answers in order. An exception in the script is raised instead."""
+
+    def __init__(self, *answers):
+        self.answers = list(answers)
+        self.prompts = []
+
+    def get_prompted_response(self, prompt, max_tokens):
+        self.prompts.append(prompt)
+        answer = self.answers.pop(0) if len(self.answers) > 1 else self.answers[0]
+        if isinstance(answer, Exception):
+            raise answer
+        return answer
+
+
+class TitleWorkerTestCase(unittest.TestCase):
+    def setUp(self):
+        mock = mock_aws()
+        mock.start()
+        self.addCleanup(mock.stop)
+        dynamodb = boto3.resource('dynamodb', region_name='us-east-1')
+        self.table = dynamodb.create_table(
+            TableName=lambda_function.DDB_TABLE_NAME,
+            KeySchema=[{'AttributeName': 'user_id', 'KeyType': 'HASH'}, {'AttributeName': 'session_id', 'KeyType': 'RANGE'}],
+            AttributeDefinitions=[{'AttributeName': name, 'AttributeType': 'S'}
+                                  for name in ('user_id', 'session_id', 'time_stamp', 'title_pending')],
+            GlobalSecondaryIndexes=[{
+                'IndexName': lambda_function.UNTITLED_INDEX_NAME,
+                'KeySchema': [{'AttributeName': 'title_pending', 'KeyType': 'HASH'}, {'AttributeName': 'time_stamp', 'KeyType': 'RANGE'}],
+                'Projection': {'ProjectionType': 'KEYS_ONLY'},
+            }],
+            BillingMode='PAY_PER_REQUEST',
+        )
+        original = lambda_function.table
+        lambda_function.table = self.table
+        self.addCleanup(setattr, lambda_function, 'table', original)
+
+    def add_session(self, session_id, question='How do I apply?', with_turn=True):
+        self.table.put_item(Item={'user_id': USER_ID, 'session_id': session_id, 'title': PLACEHOLDER_TITLE,
+                                  'title_pending': lambda_function.TITLE_PENDING, 'time_stamp': f'2024-01-01 {session_id}',
+                                  'turn_count': 1 if with_turn else 0})
+        if with_turn:
+            self.add_first_turn(session_id, question)
+
+    def add_first_turn(self, session_id, question='How do I apply?'):
+        # session-handler compresses long answers
+        answer = Binary(zlib.compress(('Start with the application form. ' * 50).encode('utf-8')))
+        self.table.put_item(Item={'user_id': USER_ID, 'session_id': f'{session_id}{lambda_function.TURN_KEY_SEPARATOR}000000',
+                                  'chat_entry': {'user': question, 'chatbot': answer, 'metadata': '[]'}})
+
+    def header(self, session_id):
+        return self.table.get_item(Key={'user_id': USER_ID, 'session_id': session_id})['Item']
+
+    def untitled(self):
+        return sorted(session['session_id'] for session in lambda_function.untitled_sessions(100))
+
+
+class GenerateTitlesTest(TitleWorkerTestCase):
+    def test_titles_session_and_leaves_the_index(self):
+        self.add_session('s1', question='Which grants fund new greenhouses?')
+        model = FakeModel('"Greenhouse grants"\n')
+        self.assertEqual(lambda_function.generate_titles(model),
+                         {'titled': 1, 'failed': 0, 'skipped': 0, 'abandoned': 0})
+        header = self.header('s1')
+        self.assertEqual(header['title'], 'Greenhouse grants')
+        self.assertNotIn('title_pending', header)
+        self.assertEqual(self.untitled(), [])
+        self.assertIn('Which grants fund new greenhouses?', model.prompts[0])
+        self.assertIn('Start with the application form.', model.prompts[0])
+
+    def test_failing_session_does_not_stop_the_batch(self):
+        for session_id in ('s1', 's2', 's3'):
+            self.add_session(session_id)
+        model = FakeModel('First', RuntimeError('throttled'), 'Third')
+        self.assertEqual(lambda_function.generate_titles(model),
+                         {'titled': 2, 'failed': 1, 'skipped': 0, 'abandoned': 0})
+        self.assertEqual(self.untitled(), ['s2'])
+        self.assertEqual(self.header('s2')['title_attempts'], 1)
+
+    def test_retried_session_is_titled_later(self):
+        self.add_session('s1')
+        lambda_function.generate_titles(FakeModel(RuntimeError('throttled')))
+        lambda_function.generate_titles(FakeModel('Applying'))
+        header = self.header('s1')
+        self.assertEqual(header['title'], 'Applying')
+        self.assertNotIn('title_pending', header)
+
+    def test_empty_and_failing_answers_are_given_up_after_max_attempts(self):
+        self.add_session('empty')
+        self.add_session('error')
+        for run in range(lambda_function.TITLE_MAX_ATTEMPTS):
+            self.assertEqual(self.untitled(), ['empty', 'error'])
+            result = lambda_function.generate_titles(FakeModel('  ""  ', RuntimeError('model error')))
+        self.assertEqual(result['abandoned'], 2)
+        self.assertEqual(self.untitled(), [])
+        for session_id in ('empty', 'error'):
+            header = self.header(session_id)
+            self.assertEqual(header['title'], PLACEHOLDER_TITLE)
+            self.assertNotIn('title_attempts', header)
+
+    def test_session_without_first_turn_is_skipped_until_it_exists(self):
+        self.add_session('s1', with_turn=False)
+        model = FakeModel('Never asked')
+        self.assertEqual(lambda_function.generate_titles(model),
+                         {'titled': 0, 'failed': 0, 'skipped': 1, 'abandoned': 0})
+        self.assertEqual(model.prompts, [])
+        self.assertEqual(self.untitled(), ['s1'])
+
+        self.add_first_turn('s1')
+        lambda_function.generate_titles(FakeModel('Applying'))
+        self.assertEqual(self.header('s1')['title'], 'Applying')
+
+    def test_legacy_session_uses_its_chat_history(self):
+        self.add_session('legacy', with_turn=False)
+        self.table.update_item(Key={'user_id': USER_ID, 'session_id': 'legacy'}, UpdateExpression='SET chat_history = :history',
+                               ExpressionAttributeValues={':history': [{'user': 'Old question', 'chatbot': 'Old answer'}]})
+        model = FakeModel('Old topic')
+        lambda_function.generate_titles(model)
+        self.assertIn('Old question', model.prompts[0])
+        self.assertEqual(self.header('legacy')['title'], 'Old topic')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,8 +1,9 @@
 import { ApiGatewayManagementApiClient, PostToConnectionCommand, DeleteConnectionCommand } from '@aws-sdk/client-apigatewaymanagementapi';
 import { BedrockAgentRuntimeClient, RetrieveCommand as KBRetrieveCommand } from "@aws-sdk/client-bedrock-agent-runtime";
 import { LambdaClient, InvokeCommand } from "@aws-sdk/client-lambda"
+import { SQSClient, SendMessageCommand } from "@aws-sdk/client-sqs";
+import { randomUUID } from "crypto";
 import ClaudeModel from "./models/claude3Sonnet.mjs";
-import Mistral7BModel from "./models/mistral7b.mjs"
 
 // a lot of the logic for the retrieval will be written here 
 
@@ -11,6 +12,9 @@ import Mistral7BModel from "./models/mistral7b.mjs"
 const ENDPOINT = process.env.WEBSOCKET_API_ENDPOINT;
 const SYS_PROMPT = process.env.PROMPT;
 const wsConnectionClient = new ApiGatewayManagementApiClient({ endpoint: ENDPOINT });
+// When set, chat turns are queued for the session handler instead of saved with two direct invocations
+const SESSION_WRITE_QUEUE_URL = process.env.SESSION_WRITE_QUEUE_URL;
+const sqsClient = new SQSClient({});
 
 // async function processBedrockStream(id, modelStream, model) {
 //   try {
@@ -288,9 +292,29 @@ const getUserResponse = async (id, requestJSON) => {
       console.error("Error sending EOF_STREAM and sources:", e);
     }
 
+    let newChatEntry = { "user": userMessage, "chatbot": modelResponse, "metadata": links };
+
+    if (SESSION_WRITE_QUEUE_URL) {
+      // Write-behind: the session handler appends queued turns in batches. The FIFO message group
+      // keeps the turns of one session in order, and new sessions are created by the handler
+      await sqsClient.send(new SendMessageCommand({
+        QueueUrl: SESSION_WRITE_QUEUE_URL,
+        MessageBody: JSON.stringify({
+          "user_id": userId,
+          "session_id": sessionId,
+          "new_chat_entry": newChatEntry
+        }),
+        MessageGroupId: `${userId}#${sessionId}`,
+        MessageDeduplicationId: randomUUID()
+      }));
+      await wsConnectionClient.send(new DeleteConnectionCommand({ ConnectionId: id }));
+      return;
+    }
+
+    // only ask whether the session exists, the history itself is not needed to save this turn
     const sessionRequest = {
       body: JSON.stringify({
-        "operation": "get_session",
+        "operation": "session_exists",
         "user_id": userId,
         "session_id": sessionId
       })
@@ -327,35 +351,16 @@ const getUserResponse = async (id, requestJSON) => {
     }
 
     // Continue processing the data
-    const retrievedHistory = output.chat_history;
-    let operation = '';
-    let title = ''; // Ensure 'title' is initialized if used later in your code
-
-    // Further logic goes here
-
-    let newChatEntry = { "user": userMessage, "chatbot": modelResponse, "metadata": links };
-    if (retrievedHistory === undefined) {
-      operation = 'add_session';
-      let titleModel = new Mistral7BModel();
-      const CONTEXT_COMPLETION_INSTRUCTIONS =
-        `Generate a concise title for this chat session based on the initial user prompt and response. The title should succinctly capture the essence of the chat's main topic without adding extra content.
-      
-      ${userMessage}
-      ${modelResponse} 
-      Here's your session title:`;
-      title = await titleModel.getPromptedResponse(CONTEXT_COMPLETION_INSTRUCTIONS, 25);
-      title = title.replaceAll(`"`, '');
-    } else {
-      operation = 'update_session';
-    }
+    const sessionExists = output.exists;
+    // New sessions are saved without a title, the session title worker generates one in the background
+    const operation = sessionExists ? 'update_session' : 'add_session';
 
     const sessionSaveRequest = {
       body: JSON.stringify({
         "operation": operation,
         "user_id": userId,
         "session_id": sessionId,
-        "new_chat_entry": newChatEntry,
-        "title": title
+        "new_chat_entry": newChatEntry
       })
     }
 
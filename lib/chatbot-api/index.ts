@@ -114,7 +114,7 @@ export class ChatBotApi extends Construct {
     const feedbackAPIDownloadIntegration = new HttpLambdaIntegration('FeedbackDownloadAPIIntegration', lambdaFunctions.feedbackFunction);
     restBackend.restAPI.addRoutes({
       path: "/user-feedback/download-feedback",
-      methods: [apigwv2.HttpMethod.POST],
+      methods: [apigwv2.HttpMethod.GET, apigwv2.HttpMethod.POST],
       integration: feedbackAPIDownloadIntegration,
       authorizer: httpAuthorizer,
     })
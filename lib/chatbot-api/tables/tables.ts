@@ -22,6 +22,14 @@ export class TableStack extends Stack {
       projectionType: ProjectionType.ALL,
     });
 
+    // Sparse index of session headers still waiting for a generated title (only they carry title_pending)
+    chatHistoryTable.addGlobalSecondaryIndex({
+      indexName: 'UntitledIndex',
+      partitionKey: { name: 'title_pending', type: AttributeType.STRING },
+      sortKey: { name: 'time_stamp', type: AttributeType.STRING },
+      projectionType: ProjectionType.KEYS_ONLY,
+    });
+
     this.historyTable = chatHistoryTable;
 
     // Define the second table (UserFeedbackTable)
@@ -1,5 +1,10 @@
 export const AUTHENTICATION = true;
 
+// save chat turns through an SQS FIFO write-behind queue instead of calling the session handler
+// synchronously from the chat handler. Off by default, because a queued turn is not visible in the
+// session until the session handler has consumed it
+export const SESSION_WRITE_BEHIND: boolean = false;
+
 // change these as needed
 // must be unique globally or the deployment will fail
 export const cognitoDomainName = "eoed-auth"
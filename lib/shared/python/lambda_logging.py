@@ -0,0 +1,27 @@
+"""
+Logging for the Python Lambdas. Each Lambda directory links to this file, and the CDK assets
+follow the link, so every function ships its own copy.
+
+LOG_LEVEL sets the level, and LOG_DEBUG_SAMPLE_RATE (0-1) picks a share of invocations that log
+at DEBUG instead. Messages use %-style arguments so nothing is formatted unless the record is
+actually emitted.
+"""
+import logging
+import os
+import random
+
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+LOG_DEBUG_SAMPLE_RATE = float(os.environ.get('LOG_DEBUG_SAMPLE_RATE', 0))
+
+
+def get_logger(name):
+    """Return the logger of a Lambda module, set to LOG_LEVEL."""
+    logger = logging.getLogger(name)
+    logger.setLevel(LOG_LEVEL)
+    return logger
+
+
+def sample_log_level(logger):
+    """Choose the log level of logger for this invocation, sampling some invocations at DEBUG."""
+    sampled = LOG_DEBUG_SAMPLE_RATE > 0 and random.random() < LOG_DEBUG_SAMPLE_RATE
+    logger.setLevel(logging.DEBUG if sampled else LOG_LEVEL)
@@ -16,15 +16,33 @@ export class SessionsClient {
   constructor(protected _appConfig: AppConfig) {
     this.API = _appConfig.httpEndpoint.slice(0, -1);
   }
-  // Gets all sessions tied to a given user ID
+  // Gets the most recent sessions tied to a given user ID, or every session if all is set
   // Return format: [{"session_id" : "string", "user_id" : "string", "time_stamp" : "dd/mm/yy", "title" : "string"}...]
   async getSessions(
     userId: string,
     all?: boolean
+  ) {
+    let sessions = [];
+    let nextPageToken: string | null = null;
+    /** The API returns one page at a time, keep following the page token when all sessions are requested */
+    do {
+      const page = await this.getSessionsPage(userId, all, nextPageToken);
+      sessions = sessions.concat(page.sessions);
+      nextPageToken = page.next_page_token;
+    } while (all && nextPageToken);
+    return sessions;
+  }
+
+  // Gets one page of sessions tied to a given user ID
+  // Return format: {"sessions" : [...], "next_page_token" : "string" | null}
+  async getSessionsPage(
+    userId: string,
+    all?: boolean,
+    nextPageToken?: string | null
   ) {
     const auth = await Utils.authenticate();
     let validData = false;
-    let output = [];
+    let output = { sessions: [], next_page_token: null };
     let runs = 0;
     let limit = 3;
     let errorMessage = "Could not load sessions"
@@ -36,7 +54,11 @@ export class SessionsClient {
           'Content-Type': 'application/json',
           'Authorization': 'Bearer ' + auth,
         },
-        body: JSON.stringify(all? { "operation": "list_all_sessions_by_user_id", "user_id": userId } : { "operation": "list_sessions_by_user_id", "user_id": userId })
+        body: JSON.stringify({
+          "operation": all ? "list_all_sessions_by_user_id" : "list_sessions_by_user_id",
+          "user_id": userId,
+          ...(nextPageToken ? { "next_page_token": nextPageToken } : {})
+        })
       });
       if (response.status != 200) {
         validData = false;
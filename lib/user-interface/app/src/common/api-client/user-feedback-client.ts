@@ -1,6 +1,9 @@
 import { Utils } from "../utils"
 import { AppConfig } from "../types";
 
+/** Export job status checks before downloadFeedback gives up, 2 seconds apart (15 minutes) */
+const MAX_EXPORT_POLLS = 450;
+
 export class UserFeedbackClient {
 
 
@@ -33,7 +36,7 @@ export class UserFeedbackClient {
   async downloadFeedback(topic: string, startTime?: string, endTime?: string) {
     const auth = await Utils.authenticate();
 
-    /** This fetch call will get a presigned URL for downloading from S3 */
+    /** This fetch call starts an export job, or returns the presigned URL directly if exports run inline */
     const response = await fetch(this.API + '/user-feedback/download-feedback', {
       method: 'POST',
       headers: {
@@ -42,7 +45,26 @@ export class UserFeedbackClient {
       },
       body: JSON.stringify({ topic, startTime, endTime })
     });
-    const result = await response.json();
+    let result = await response.json();
+
+    /** Poll the export job until the worker has written the file and a presigned URL is available */
+    let polls = 0;
+    while (result.job_id && !result.download_url) {
+      if (result.status == "failed") {
+        throw new Error(`Feedback export failed: ${result.error}`);
+      }
+      if (polls++ >= MAX_EXPORT_POLLS) {
+        throw new Error(`Feedback export ${result.job_id} is still running, please try again later`);
+      }
+      await new Promise(resolve => setTimeout(resolve, 2000));
+      const statusResponse = await fetch(this.API + '/user-feedback/download-feedback?' + new URLSearchParams({ jobId: result.job_id }), {
+        method: 'GET',
+        headers: {
+          'Authorization': auth
+        }
+      });
+      result = await statusResponse.json();
+    }
 
     /** Now that we have the presigned URL, we can initiate a download */
     fetch(result.download_url, {
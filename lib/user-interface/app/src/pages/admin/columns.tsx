@@ -40,8 +40,9 @@ const FEEDBACK_COLUMN_DEFINITIONS = [
   {
     id: "createdAt",
     header: "Submission date",
+    // CreatedAt is "<timestamp>#<FeedbackID>", only the timestamp is shown
     cell: (item) =>
-      DateTime.fromISO(new Date(item.CreatedAt).toISOString()).toLocaleString(
+      DateTime.fromISO(new Date(item.CreatedAt.split("#")[0]).toISOString()).toLocaleString(
         DateTime.DATETIME_SHORT
       ),
   },